@@ -0,0 +1,268 @@
+import instructions
+import lisp_parser
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class BatchError(Exception): pass
+
+
+class Batch:
+    """ Runs one assembled controller over many independent register
+        sets (lanes) in lockstep.
+
+        Lanes are kept in groups keyed by their program counter. Each
+        step executes one instruction for every lane of the group with
+        the lowest pc, so lanes that diverge on a branch meet again at
+        the head of the loop they share. Registers are columns, either
+        Python lists or, when any input is a NumPy array, NumPy arrays
+        indexed by arrays of lane numbers.
+
+        vector_ops:
+            Optional dict of ops that take one column per argument
+            (each as long as the group being executed) and return a
+            column. Ops without a vector version are applied lane by
+            lane.
+    """
+    def __init__(self, machine, inputs, vector_ops=None):
+        if machine.memory is not None:
+            raise BatchError("Batch runs cannot use list memory, whose collector only sees the machine's registers")
+        self.machine = machine
+        self.vector_ops = vector_ops or {}
+        sizes = set(len(column) for column in inputs.values())
+        if len(sizes) > 1:
+            raise BatchError("Input columns differ in length")
+        self.size = sizes.pop() if sizes else 0
+        self.numpy = numpy is not None and any(isinstance(column, numpy.ndarray) for column in inputs.values())
+        self.columns = [None] * len(machine.slots)
+        for name, column in inputs.items():
+            slot = machine.register_slot(name)
+            if self.numpy:
+                self.columns[slot] = numpy.array(column)
+            else:
+                self.columns[slot] = list(column)
+        self.stacks = [[] for _ in range(self.size)]
+        self.register_stacks = {}
+        self.groups = {}
+
+    def lane_stacks(self, slot):
+        """ The per-lane stacks that save and restore of register `slot`
+            use, following the machine's stack mode.
+        """
+        if self.machine.register_stacks is None:
+            return self.stacks
+        if slot not in self.register_stacks:
+            self.register_stacks[slot] = [[] for _ in range(self.size)]
+        return self.register_stacks[slot]
+
+    def gather(self, slot, lanes):
+        column = self.columns[slot]
+        if column is None:
+            column = self.columns[slot] = self.new_column(self.machine.slots[slot])
+        if self.numpy:
+            return column[lanes]
+        return [column[i] for i in lanes]
+
+    def scatter(self, slot, lanes, values):
+        column = self.columns[slot]
+        if column is None:
+            if self.numpy:
+                dtype = values.dtype if isinstance(values, numpy.ndarray) else object
+                column = numpy.empty(self.size, dtype=dtype)
+            else:
+                column = [None] * self.size
+            self.columns[slot] = column
+        if self.numpy:
+            column[lanes] = values
+        else:
+            for i, value in zip(lanes, values):
+                column[i] = value
+
+    def new_column(self, value):
+        if self.numpy:
+            column = numpy.empty(self.size, dtype=object)
+            column[:] = [value] * self.size
+            return column
+        return [value] * self.size
+
+    def constant(self, value, lanes):
+        if self.numpy:
+            column = numpy.empty(len(lanes), dtype=type(value) if type(value) in (int, float, bool) else object)
+            column[:] = value
+            return column
+        return [value] * len(lanes)
+
+    def advance(self, lanes, pc):
+        if len(lanes) == 0 or pc >= self.end:
+            return
+        group = self.groups.get(pc)
+        if group is None:
+            self.groups[pc] = lanes
+        elif self.numpy:
+            self.groups[pc] = numpy.concatenate((group, lanes))
+        else:
+            group.extend(lanes)
+
+    def split(self, lanes, flags):
+        """ Split a group into the lanes whose flag is true and the rest. """
+        if self.numpy:
+            mask = numpy.asarray(flags, dtype=bool)
+            return lanes[mask], lanes[~mask]
+        taken = []
+        rest = []
+        for lane, flag in zip(lanes, flags):
+            if flag:
+                taken.append(lane)
+            else:
+                rest.append(lane)
+        return taken, rest
+
+    def run(self, insts_tokens):
+        procedures = make_batch_procedures(insts_tokens, self)
+        self.end = len(procedures)
+        if self.numpy:
+            self.advance(numpy.arange(self.size), 0)
+        else:
+            self.advance(list(range(self.size)), 0)
+        groups = self.groups
+        while groups:
+            pc = min(groups)
+            procedures[pc](groups.pop(pc))
+
+    def output(self, name):
+        column = self.columns[self.machine.register_slot(name)]
+        if column is None:
+            column = self.new_column(self.machine.get_register_value(name))
+        return column
+
+
+def make_batch_procedures(insts_tokens, batch):
+    labels = {}
+    offset = 0
+    for token in insts_tokens:
+        if token.type == "LABEL":
+            labels[token.label] = offset
+        else:
+            offset += 1
+    procedures = []
+    for token in insts_tokens:
+        if token.type != "LABEL":
+            procedures.append(make_batch_procedure(token, labels, batch, len(procedures)))
+    return procedures
+
+
+def make_batch_procedure(inst, labels, batch, offset):
+    machine = batch.machine
+    next_pc = offset + 1
+    t = inst.type
+    if t in ("ASSIGN_REGISTER", "ASSIGN_CONSTANT", "ASSIGN_LABEL", "ASSIGN_OP"):
+        target = machine.register_slot(inst.target_register)
+        if t == "ASSIGN_REGISTER":
+            value = make_batch_primitive_exp(lisp_parser.PrimitiveExpToken("reg", inst.source_register), labels, batch)
+        elif t == "ASSIGN_CONSTANT":
+            value = make_batch_primitive_exp(lisp_parser.PrimitiveExpToken("const", inst.constant), labels, batch)
+        elif t == "ASSIGN_LABEL":
+            value = make_batch_primitive_exp(lisp_parser.PrimitiveExpToken("label", inst.label), labels, batch)
+        else:
+            value = make_batch_operation_exp(inst, labels, batch)
+        def execution(lanes):
+            batch.scatter(target, lanes, value(lanes))
+            batch.advance(lanes, next_pc)
+        return execution
+    elif t == "PERFORM":
+        action = make_batch_operation_exp(inst, labels, batch)
+        def execution(lanes):
+            action(lanes)
+            batch.advance(lanes, next_pc)
+        return execution
+    elif t == "TEST":
+        flag = machine.register_slot("flag")
+        condition = make_batch_operation_exp(inst, labels, batch)
+        def execution(lanes):
+            batch.scatter(flag, lanes, condition(lanes))
+            batch.advance(lanes, next_pc)
+        return execution
+    elif t == "BRANCH":
+        flag = machine.register_slot("flag")
+        target = instructions.lookup_label(labels, inst.label)
+        def execution(lanes):
+            taken, rest = batch.split(lanes, batch.gather(flag, lanes))
+            batch.advance(taken, target)
+            batch.advance(rest, next_pc)
+        return execution
+    elif t == "TEST_BRANCH":
+        flag = machine.register_slot("flag")
+        condition = make_batch_operation_exp(inst, labels, batch)
+        target = instructions.lookup_label(labels, inst.label)
+        def execution(lanes):
+            flags = condition(lanes)
+            batch.scatter(flag, lanes, flags)
+            taken, rest = batch.split(lanes, flags)
+            batch.advance(taken, target)
+            batch.advance(rest, next_pc)
+        return execution
+    elif t == "GOTO_LABEL":
+        target = instructions.lookup_label(labels, inst.label)
+        def execution(lanes):
+            batch.advance(lanes, target)
+        return execution
+    elif t == "GOTO_REGISTER":
+        register = machine.register_slot(inst.register)
+        def execution(lanes):
+            targets = {}
+            for lane, target in zip(lanes, batch.gather(register, lanes)):
+                targets.setdefault(int(target), []).append(lane)
+            for target, group in targets.items():
+                batch.advance(numpy.array(group) if batch.numpy else group, target)
+        return execution
+    elif t == "SAVE":
+        register = machine.register_slot(inst.register)
+        stacks = batch.lane_stacks(register)
+        def execution(lanes):
+            for lane, value in zip(lanes, batch.gather(register, lanes)):
+                stacks[lane].append(value)
+            batch.advance(lanes, next_pc)
+        return execution
+    elif t == "RESTORE":
+        register = machine.register_slot(inst.register)
+        stacks = batch.lane_stacks(register)
+        def execution(lanes):
+            batch.scatter(register, lanes, [stacks[lane].pop() for lane in lanes])
+            batch.advance(lanes, next_pc)
+        return execution
+    raise instructions.ExecutionError("unknown instuction type {}".format(t))
+
+
+def make_batch_operation_exp(inst, labels, batch):
+    aprocs = [make_batch_primitive_exp(arg, labels, batch) for arg in inst.args]
+    if inst.op in batch.vector_ops:
+        vector_op = batch.vector_ops[inst.op]
+        def execution(lanes):
+            return vector_op(*[a(lanes) for a in aprocs])
+        return execution
+    try:
+        op = batch.machine.ops[inst.op]
+    except KeyError:
+        raise instructions.ExecutionError("unknown operation {}".format(inst.op))
+    if not aprocs:
+        return lambda lanes: [op() for _ in lanes]
+    def execution(lanes):
+        return [op(*args) for args in zip(*[a(lanes) for a in aprocs])]
+    return execution
+
+
+def make_batch_primitive_exp(exp, labels, batch):
+    t = exp.type
+    if t == "const":
+        value = exp.value
+        return lambda lanes: batch.constant(value, lanes)
+    elif t == "label":
+        value = instructions.lookup_label(labels, exp.value)
+        return lambda lanes: batch.constant(value, lanes)
+    elif t == "reg":
+        slot = batch.machine.register_slot(exp.value)
+        return lambda lanes: batch.gather(slot, lanes)
+    raise instructions.ExecutionError("unknown type {}".format(t))
@@ -0,0 +1,120 @@
+""" Compare the execution backends of assemble_machine on the GCD and
+    factorial controllers.
+
+    python bench_backends.py [repeat] [builtins]
+
+    With builtins 0 the controllers call the host lambdas in OPS
+    instead of the built-in op library.
+"""
+import sys
+import time
+
+import python_vm
+
+GCD = '''(gcd (test (op =) (reg b) (const 0))
+    (branch (label gcd-done))
+    (assign t (op rem) (reg a) (reg b))
+    (assign a (reg b))
+    (assign b (reg t))
+    (goto (label gcd))
+    gcd-done)'''
+
+FACTORIAL = '''(controller (assign product (const 1))
+    (assign counter (const 1))
+    loop
+    (test (op >) (reg counter) (reg n))
+    (branch (label fact-done))
+    (assign product (op *) (reg counter) (reg product))
+    (assign counter (op +) (reg counter) (const 1))
+    (goto (label loop))
+    fact-done)'''
+
+RECURSIVE_FACTORIAL = '''(controller (assign continue (label fact-done))
+    fact-loop
+    (test (op =) (reg n) (const 1))
+    (branch (label base-case))
+    (save continue)
+    (save n)
+    (assign n (op -) (reg n) (const 1))
+    (assign continue (label after-fact))
+    (goto (label fact-loop))
+    after-fact
+    (restore n)
+    (restore continue)
+    (assign val (op *) (reg n) (reg val))
+    (goto (reg continue))
+    base-case
+    (assign val (const 1))
+    (goto (reg continue))
+    fact-done)'''
+
+OPS = {
+    "=": lambda x, y: x == y,
+    ">": lambda x, y: x > y,
+    "+": lambda x, y: x + y,
+    "-": lambda x, y: x - y,
+    "*": lambda x, y: x * y,
+    "rem": lambda x, y: x % y,
+}
+
+# name, backend and assemble_machine options
+BACKENDS = [
+    ("closure", "closure", {}),
+    ("closure+si", "closure", {"superinstructions": "static"}),
+    ("bytecode", "bytecode", {}),
+    ("python", "python", {}),
+]
+
+
+def run_gcd(machine):
+    for a in range(1, 200):
+        machine.set_register_value("a", 832040 * a)
+        machine.set_register_value("b", 514229)
+        machine.start()
+
+
+def run_factorial(machine):
+    for n in range(0, 300, 3):
+        machine.set_register_value("n", n)
+        machine.start()
+
+
+def run_recursive_factorial(machine):
+    for n in range(1, 300, 3):
+        machine.set_register_value("n", n)
+        machine.start()
+
+
+BENCHMARKS = [
+    ("gcd", ["a", "b", "t"], GCD, run_gcd),
+    ("factorial", ["n", "product", "counter"], FACTORIAL, run_factorial),
+    ("recursive", ["n", "val", "continue"], RECURSIVE_FACTORIAL, run_recursive_factorial),
+]
+
+
+def bench(registers, ops, text, run, backend, options, repeat):
+    machine = python_vm.make_machine(registers, ops)
+    python_vm.assemble_machine(machine, text, backend=backend, **options)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(machine)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main(repeat=5, builtins=1):
+    ops = {} if builtins else OPS
+    for name, registers, text, run in BENCHMARKS:
+        baseline = None
+        for backend_name, backend, options in BACKENDS:
+            elapsed = bench(registers, ops, text, run, backend, options, repeat)
+            if baseline is None:
+                baseline = elapsed
+            print("%-10s %-10s %8.2f ms  %5.2fx" % (name, backend_name, elapsed * 1000, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
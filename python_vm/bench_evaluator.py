@@ -0,0 +1,102 @@
+""" The standard heavy workload: Scheme programs run by the
+    explicit-control evaluator on every backend, reporting wall time and
+    machine instructions executed per second, and, for comparison, the
+    same programs compiled by the compiler module.
+
+    python bench_evaluator.py [repeat] [program ...]
+
+    The instruction count of each program is taken once from a profiled
+    run of the closure backend; every backend executes the same
+    controller instructions, so it is shared by all of them.
+"""
+import sys
+import time
+
+import compiler
+import evaluator
+
+PROGRAMS = [
+    ("fib", '''(define (fib n)
+                 (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))''', "(fib 16)"),
+    ("fact", '''(define (fact n)
+                  (if (= n 0) 1 (* n (fact (- n 1)))))
+                (define (repeat-fact k)
+                  (if (= k 0) 0 (begin (fact 100) (repeat-fact (- k 1)))))''', "(repeat-fact 40)"),
+    ("ackermann", '''(define (ack m n)
+                       (cond ((= m 0) (+ n 1))
+                             ((= n 0) (ack (- m 1) 1))
+                             (else (ack (- m 1) (ack m (- n 1))))))''', "(ack 2 9)"),
+    ("reverse", '''(define (iota n)
+                     (define (loop i acc) (if (= i 0) acc (loop (- i 1) (cons i acc))))
+                     (loop n '()))
+                   (define (reverse l)
+                     (define (loop l acc)
+                       (if (null? l) acc (loop (cdr l) (cons (car l) acc))))
+                     (loop l '()))
+                   (define (reverse-times l k)
+                     (if (= k 0) l (reverse-times (reverse l) (- k 1))))
+                   (define numbers (iota 500))''', "(car (reverse-times numbers 6))"),
+]
+
+# name, backend and assemble_machine options
+BACKENDS = [
+    ("closure", "closure", {}),
+    ("closure+si", "closure", {"superinstructions": "static"}),
+    ("bytecode", "bytecode", {}),
+    ("python", "python", {}),
+]
+
+
+def instruction_count(definitions, expression):
+    ev = evaluator.Evaluator(profile=True)
+    ev.evaluate(definitions)
+    before = sum(ev.profile.instruction_counts)
+    ev.evaluate(expression)
+    return sum(ev.profile.instruction_counts) - before
+
+
+def bench(definitions, expression, backend, options, repeat):
+    ev = evaluator.Evaluator(backend=backend, **options)
+    ev.evaluate(definitions)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = ev.evaluate(expression)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, value
+
+
+def bench_compiled(definitions, expression, backend, repeat):
+    scheme = compiler.Scheme(backend=backend)
+    scheme.evaluate(definitions)
+    start_label = scheme.compile(expression)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = scheme.run(start_label)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, value
+
+
+def main(repeat=3, names=()):
+    print("%-10s %-10s %10s %12s %12s" % ("program", "backend", "ms", "instructions", "M instr/s"))
+    for name, definitions, expression in PROGRAMS:
+        if names and name not in names:
+            continue
+        count = instruction_count(definitions, expression)
+        for backend_name, backend, options in BACKENDS:
+            elapsed, _ = bench(definitions, expression, backend, options, repeat)
+            print("%-10s %-10s %10.1f %12d %12.2f" % (name, backend_name, elapsed * 1000, count, count / elapsed / 1e6))
+        for backend in ("closure", "python"):
+            elapsed, _ = bench_compiled(definitions, expression, backend, repeat)
+            print("%-10s %-10s %10.1f %12s %12s" % (name, "compiled-" + backend[0], elapsed * 1000, "-", "-"))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    repeat = int(args.pop(0)) if args and args[0].isdigit() else 3
+    main(repeat, args)
@@ -0,0 +1,43 @@
+""" Tokenizer throughput, in MB/s of controller text, of the
+    s-expression tokenizer against the rule-based regex lexer.
+
+    python bench_lexer.py [instructions] [repeat]
+"""
+import sys
+import time
+
+import lisp_parser
+from bench_parse_memory import generate_controller
+
+
+def throughput(lexer, text, repeat):
+    best = None
+    for _ in range(repeat):
+        lexer.input(text)
+        start = time.perf_counter()
+        count = 0
+        for _ in lexer.tokens():
+            count += 1
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return count, len(text) / best / 1e6
+
+
+def main(instructions=20000, repeat=3):
+    text = generate_controller(instructions)
+    lexers = [
+        ("regex", lisp_parser.Parser(regex_lexer=True).lexer),
+        ("sexp", lisp_parser.Parser().lexer),
+    ]
+    print("%.1f MB of controller text" % (len(text) / 1e6))
+    baseline = None
+    for name, lexer in lexers:
+        count, rate = throughput(lexer, text, repeat)
+        if baseline is None:
+            baseline = rate
+        print("%-6s %8d tokens %8.2f MB/s  %5.2fx" % (name, count, rate, rate / baseline))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
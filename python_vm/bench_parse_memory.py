@@ -0,0 +1,62 @@
+""" Parse time and memory of a large generated controller.
+
+    python bench_parse_memory.py [instructions]
+
+    Each configuration is measured in a fresh subprocess so that the
+    peak RSS figures do not include the previous runs. The retained
+    size is the memory still allocated once the controller text has
+    been dropped, measured with tracemalloc in a separate run.
+"""
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import lisp_parser
+
+
+def generate_controller(instructions):
+    """ A controller of GCD loops with about `instructions` instructions. """
+    parts = ["("]
+    for i in range(instructions // 7):
+        parts.append(''' loop%d (test (op =) (reg b) (const 0))
+ (branch (label done%d))
+ (assign t (op rem) (reg a) (reg b))
+ (assign a (reg b))
+ (assign b (reg t))
+ (goto (label loop%d))
+ done%d (assign n (const %d))
+''' % (i, i, i, i, i))
+    parts.append(")")
+    return "".join(parts)
+
+
+def measure(instructions, keep_text, traced):
+    text = generate_controller(instructions)
+    if traced:
+        tracemalloc.start()
+    start = time.perf_counter()
+    p = lisp_parser.Parser(keep_text=keep_text)
+    p.parse(text)
+    elapsed = time.perf_counter() - start
+    del text
+    retained = tracemalloc.get_traced_memory()[0] if traced else 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return len(p.instructions), elapsed, retained, rss
+
+
+def main(instructions=100000):
+    print("%-10s %10s %10s %14s %12s" % ("text", "tokens", "parse s", "retained MB", "peak RSS MB"))
+    for keep_text in (True, False):
+        run = [sys.executable, __file__, "--measure", str(instructions), str(int(keep_text))]
+        tokens, elapsed, _, rss = eval(subprocess.check_output(run + ["0"]))
+        _, _, retained, _ = eval(subprocess.check_output(run + ["1"]))
+        print("%-10s %10d %10.2f %14.1f %12.1f" % (keep_text, tokens, elapsed, retained / 1e6, rss / 1024.0))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ["--measure"]:
+        print(repr(measure(int(sys.argv[2]), bool(int(sys.argv[3])), bool(int(sys.argv[4])))))
+    else:
+        main(*[int(arg) for arg in sys.argv[1:]])
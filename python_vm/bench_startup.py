@@ -0,0 +1,44 @@
+""" Time to first instruction of a large generated controller, assembled
+    eagerly and lazily with the closure backend: the time to assemble
+    the parsed controller and run its first block, and the number of
+    blocks built by then.
+
+    python bench_startup.py [instructions] [repeat]
+"""
+import sys
+import time
+
+import python_vm
+from bench_parse_memory import generate_controller
+
+
+def startup(insts_tokens, lazy, repeat):
+    best = None
+    for _ in range(repeat):
+        machine = python_vm.make_machine(["a", "t", "b", "n"], {})
+        machine.set_register_value("a", 21)
+        machine.set_register_value("b", 343)
+        start = time.perf_counter()
+        python_vm.install_controller(machine, insts_tokens, lazy=lazy)
+        machine.start(1)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, machine.lazy_blocks
+
+
+def main(instructions=100000, repeat=3):
+    insts_tokens = python_vm.parse_controller(generate_controller(instructions))
+    print("%d instructions" % len([token for token in insts_tokens if token.type != "LABEL"]))
+    baseline = None
+    for lazy in (False, True):
+        elapsed, blocks = startup(insts_tokens, lazy, repeat)
+        if baseline is None:
+            baseline = elapsed
+        built = "all" if blocks is None else "%d of %d" % (blocks.compiled, blocks.blocks)
+        print("%-6s %10.2f ms  %7.1fx  blocks built: %s" % (
+            "lazy" if lazy else "eager", elapsed * 1000, baseline / elapsed, built))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
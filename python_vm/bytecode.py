@@ -0,0 +1,224 @@
+from array import array
+
+import instructions
+import lisp_parser
+import primitives
+
+
+# Opcodes. Every operand is an index into the machine's register file;
+# the constant pool (constants and label offsets) is loaded into the
+# register file after the named registers, so a constant operand is
+# just a read-only slot.
+ASSIGN = 0          # target source
+ASSIGN_OP1 = 1      # target op a
+ASSIGN_OP2 = 2      # target op a b
+ASSIGN_OPN = 3      # target op n a1 ... an
+TEST1 = 4           # op a
+TEST2 = 5           # op a b
+TESTN = 6           # op n a1 ... an
+PERFORM = 7         # op n a1 ... an
+BRANCH = 8          # target
+GOTO = 9            # target
+GOTO_REG = 10       # register
+SAVE = 11           # register
+RESTORE = 12        # register
+TEST2_BRANCH = 13   # op a b target
+# calls of built-in ops computed by the dispatch loop itself, with the
+# operands of the generic opcode they replace
+TEST_EQ = 14        # op a b
+TEST_LT = 15        # op a b
+TEST_GT = 16        # op a b
+TEST_NULL = 17      # op a
+ASSIGN_ADD = 18     # target op a b
+ASSIGN_SUB = 19     # target op a b
+ASSIGN_MUL = 20     # target op a b
+ASSIGN_CAR = 21     # target op a
+ASSIGN_CDR = 22     # target op a
+
+# the built-in opcode of a call of the op, by generic opcode, used while
+# the op is still the one in primitives.OPS
+BUILTIN_OPCODES = {
+    TEST1: {"null?": TEST_NULL},
+    TEST2: {"=": TEST_EQ, "<": TEST_LT, ">": TEST_GT},
+    ASSIGN_OP1: {"car": ASSIGN_CAR, "cdr": ASSIGN_CDR},
+    ASSIGN_OP2: {"+": ASSIGN_ADD, "-": ASSIGN_SUB, "*": ASSIGN_MUL},
+}
+
+
+class Bytecode:
+    """ A controller lowered to bytecode.
+        code:
+            An array('i') of opcodes, each followed by its operands.
+        words:
+            The code as a list, which the dispatch loop indexes without
+            making an int object of every word it reads.
+        ops:
+            The operation pool, indexed by the op operands.
+        consts:
+            The constant pool, loaded into the register file
+            starting at slot `const_base`.
+    """
+    def __init__(self, code, ops, consts, const_base):
+        self.code = code
+        self.words = code.tolist()
+        self.ops = ops
+        self.consts = consts
+        self.const_base = const_base
+
+
+def instruction_size(token):
+    t = token.type
+    if t in ("ASSIGN_REGISTER", "ASSIGN_CONSTANT", "ASSIGN_LABEL"):
+        return 3
+    elif t == "ASSIGN_OP":
+        n = len(token.args)
+        return 3 + n if n in (1, 2) else 4 + n
+    elif t == "TEST":
+        n = len(token.args)
+        return 2 + n if n in (1, 2) else 3 + n
+    elif t == "PERFORM":
+        return 3 + len(token.args)
+    elif t == "TEST_BRANCH":
+        n = len(token.args)
+        # a fused opcode for two arguments, a test and a branch otherwise
+        return 5 if n == 2 else instruction_size(lisp_parser.TestToken(token.op, token.args)) + 2
+    elif t in ("BRANCH", "GOTO_LABEL", "GOTO_REGISTER", "SAVE", "RESTORE"):
+        return 2
+    raise instructions.ExecutionError("unknown instuction type {}".format(t))
+
+
+class Assembler:
+    def __init__(self, machine):
+        self.machine = machine
+        self.labels = machine.label_pointers
+        self.code = array('i')
+        self.ops = []
+        self.op_index = {}
+        self.consts = []
+        self.const_index = {}
+        self.const_base = len(machine.slots)
+
+    def assemble(self, insts_tokens):
+        # first pass: resolve every label to its offset in the code array
+        offset = 0
+        for token in insts_tokens:
+            if token.type == "LABEL":
+                self.labels[token.label] = offset
+            else:
+                offset += instruction_size(token)
+        for token in insts_tokens:
+            if token.type != "LABEL":
+                self.emit_instruction(token)
+        return Bytecode(self.code, self.ops, self.consts, self.const_base)
+
+    def emit_instruction(self, token):
+        t = token.type
+        emit = self.code.append
+        if t == "ASSIGN_REGISTER":
+            emit(ASSIGN)
+            emit(self.register(token.target_register))
+            emit(self.register(token.source_register))
+        elif t == "ASSIGN_CONSTANT":
+            emit(ASSIGN)
+            emit(self.register(token.target_register))
+            emit(self.constant(token.constant))
+        elif t == "ASSIGN_LABEL":
+            emit(ASSIGN)
+            emit(self.register(token.target_register))
+            emit(self.constant(self.label(token.label)))
+        elif t == "ASSIGN_OP":
+            n = len(token.args)
+            emit(self.opcode({1: ASSIGN_OP1, 2: ASSIGN_OP2}.get(n, ASSIGN_OPN), token.op))
+            emit(self.register(token.target_register))
+            self.emit_operation(token, n not in (1, 2))
+        elif t == "TEST":
+            n = len(token.args)
+            emit(self.opcode({1: TEST1, 2: TEST2}.get(n, TESTN), token.op))
+            self.emit_operation(token, n not in (1, 2))
+        elif t == "PERFORM":
+            emit(PERFORM)
+            self.emit_operation(token, True)
+        elif t == "BRANCH":
+            emit(BRANCH)
+            emit(self.label(token.label))
+        elif t == "TEST_BRANCH":
+            if len(token.args) == 2:
+                emit(TEST2_BRANCH)
+                self.emit_operation(token, False)
+            else:
+                self.emit_instruction(lisp_parser.TestToken(token.op, token.args))
+                emit(BRANCH)
+            emit(self.label(token.label))
+        elif t == "GOTO_LABEL":
+            emit(GOTO)
+            emit(self.label(token.label))
+        elif t == "GOTO_REGISTER":
+            emit(GOTO_REG)
+            emit(self.register(token.register))
+        elif t == "SAVE":
+            emit(SAVE)
+            emit(self.register(token.register))
+        elif t == "RESTORE":
+            emit(RESTORE)
+            emit(self.register(token.register))
+
+    def opcode(self, generic, op):
+        """ The built-in opcode replacing `generic` for a call of `op`,
+            if there is one and `op` is the built-in op, else `generic`.
+        """
+        builtin = BUILTIN_OPCODES.get(generic, {}).get(op)
+        if builtin is not None and primitives.is_builtin(self.machine.ops, op):
+            return builtin
+        return generic
+
+    def emit_operation(self, token, with_count):
+        self.code.append(self.operation(token.op))
+        if with_count:
+            self.code.append(len(token.args))
+        for arg in token.args:
+            self.code.append(self.operand(arg))
+
+    def operand(self, exp):
+        t = exp.type
+        if t == "const":
+            return self.constant(exp.value)
+        elif t == "label":
+            return self.constant(self.label(exp.value))
+        elif t == "reg":
+            return self.register(exp.value)
+        raise instructions.ExecutionError("unknown type {}".format(t))
+
+    def register(self, name):
+        return self.machine.register_slot(name)
+
+    def label(self, name):
+        return instructions.lookup_label(self.labels, name)
+
+    def constant(self, value):
+        key = (type(value), value)
+        try:
+            return self.const_index[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable constants, such as quoted lists, are not shared
+            self.consts.append(value)
+            return self.const_base + len(self.consts) - 1
+        self.const_index[key] = self.const_base + len(self.consts)
+        self.consts.append(value)
+        return self.const_index[key]
+
+    def operation(self, name):
+        if name not in self.op_index:
+            try:
+                op = self.machine.ops[name]
+            except KeyError:
+                raise instructions.ExecutionError("unknown operation {}".format(name))
+            self.op_index[name] = len(self.ops)
+            self.ops.append(op)
+        return self.op_index[name]
+
+
+def update_bytecode(insts_tokens, machine):
+    bytecode = Assembler(machine).assemble(insts_tokens)
+    machine.install_bytecode(bytecode)
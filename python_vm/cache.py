@@ -0,0 +1,93 @@
+import collections
+import hashlib
+import os
+import pickle
+import tempfile
+
+import lisp_parser
+
+# bump when the token classes change so that stale entries are ignored
+CACHE_VERSION = 2
+
+
+class ControllerCache:
+    """ A cache of parsed controllers keyed by a hash of the controller
+        text and the register/op signature of the machine.
+
+        Entries live in an in-memory LRU of at most `maxsize` token
+        lists and, when `directory` is given, as pickled token lists
+        in that directory, so that they survive process restarts.
+    """
+    def __init__(self, directory=None, maxsize=64):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, text, registers=(), ops=()):
+        h = hashlib.sha256()
+        h.update(("%d\0" % CACHE_VERSION).encode())
+        h.update(("\0".join(sorted(registers)) + "\0\0").encode())
+        h.update(("\0".join(sorted(ops)) + "\0\0").encode())
+        h.update(text.encode("utf-8") if isinstance(text, str) else bytes(text))
+        return h.hexdigest()
+
+    def parse(self, text, registers=(), ops=()):
+        """ The token list of `text`, parsing it only on a cache miss.
+        """
+        key = self.key(text, registers, ops)
+        insts_tokens = self.entries.get(key)
+        if insts_tokens is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return insts_tokens
+        insts_tokens = self.load(key)
+        if insts_tokens is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            p = lisp_parser.Parser()
+            p.parse(text)
+            insts_tokens = p.instructions
+            self.store(key, insts_tokens)
+        self.entries[key] = insts_tokens
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return insts_tokens
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def load(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self.path(key), "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return None
+
+    def store(self, key, insts_tokens):
+        if self.directory is None:
+            return
+        # write to a temporary file and rename it so that concurrent
+        # workers never see a partly written entry
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(insts_tokens, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def clear(self):
+        self.entries.clear()
+        if self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.endswith(".pickle"):
+                    os.unlink(os.path.join(self.directory, name))
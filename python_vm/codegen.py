@@ -0,0 +1,279 @@
+import instructions
+import primitives
+
+# the state of a pc that is not at any block
+NO_LABEL = "raise ExecutionError('no label at instruction offset {}'.format(pc))"
+
+
+class CompiledController:
+    """ A controller translated into a single Python function.
+        source:
+            The generated Python source, kept for inspection.
+        function:
+            run(regs, pushes, pops, budget). It loads the registers
+            from the register file `regs` into locals, and the push and
+            pop functions of the stacks, indexed by register slot, of
+            the registers it saves and restores. It runs from the
+            instruction offset held in the pc register, for at most
+            `budget` block entries unless it is None, and writes every
+            register back when it returns or raises. Returns whether
+            it ran to the end of the controller.
+    """
+    def __init__(self, source, function):
+        self.source = source
+        self.function = function
+
+
+class Generator:
+    """ Generates the Python source of a controller.
+        Registers become local variables, every label becomes a state
+        of a `while True` loop and ops are bound as closure constants.
+        The pc register holds instruction offsets, as in the closure
+        backend, so label values agree between the two. Nothing of the
+        machine's run time state is bound, so one compiled controller
+        can run any number of register files at once.
+    """
+    # whether registers are held in locals during a run, which the
+    # collector of a machine's list memory cannot see
+    register_locals = True
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.labels = machine.label_pointers
+        self.lines = []
+        self.closure_names = []
+        self.closure_values = []
+        self.op_names = {}
+        self.stack_names = {}
+        self.stack_locals = []
+
+    def generate(self, insts_tokens):
+        # first pass: resolve labels to instruction offsets and collect
+        # the blocks of instructions that start at each of them
+        blocks = {0: []}
+        offset = 0
+        current = blocks[0]
+        async_ops = self.machine.async_ops
+        for token in insts_tokens:
+            if token.type == "LABEL":
+                self.labels[token.label] = offset
+                current = blocks.setdefault(offset, [])
+            elif getattr(token, "op", None) in async_ops:
+                # a call of an async op is a block of its own, so that
+                # pc is at it when it suspends and a resumed run can
+                # enter at the instruction after it
+                current = blocks.setdefault(offset, [])
+                current.append(token)
+                offset += 1
+                current = blocks.setdefault(offset, [])
+            else:
+                current.append(token)
+                offset += 1
+        end = offset
+        blocks.pop(end, None)
+        entries = sorted(blocks)
+
+        # the stack operations are only known once the blocks are generated
+        if entries:
+            states = self.dispatch(entries, blocks, end)
+        else:
+            # no instructions: only the end check is needed
+            states = [NO_LABEL]
+        registers = sorted(self.machine.register_index.items(), key=lambda item: item[1])
+        pc = self.machine.register_slot("pc")
+        body = []
+        for name, slot in registers:
+            if slot != pc:
+                body.append("r%d = regs[%d]  # %s" % (slot, slot, name))
+        body.append("pc = regs[%d]" % pc)
+        for name, kind, slot in self.stack_locals:
+            body.append("%s = %s[%d]" % (name, "pushes" if kind == "push" else "pops", slot))
+        # a budget of None never counts down to zero
+        body.append("if budget is None:")
+        body.append("    budget = -1")
+        body.append("try:")
+        body.append("    while True:")
+        body.append("        if pc >= %d or not budget:" % end)
+        body.append("            break")
+        body.append("        budget -= 1")
+        for line in states:
+            body.append("        " + line)
+        body.append("finally:")
+        for name, slot in registers:
+            if slot != pc:
+                body.append("    regs[%d] = r%d" % (slot, slot))
+        body.append("    regs[%d] = pc" % pc)
+        body.append("return pc >= %d" % end)
+
+        lines = ["def make_controller(%s):" % ", ".join(self.closure_names)]
+        lines.append("    def controller(regs, pushes, pops, budget=None):")
+        lines.extend("        " + line for line in body)
+        lines.append("    return controller")
+        source = "\n".join(lines) + "\n"
+
+        namespace = {"ExecutionError": instructions.ExecutionError}
+        exec(compile(source, "<controller>", "exec"), namespace)
+        function = namespace["make_controller"](*self.closure_values)
+        return CompiledController(source, function)
+
+    def dispatch(self, entries, blocks, end):
+        """ A binary search over the block entry offsets, so a jump
+            costs O(log n) comparisons in the number of labels.
+        """
+        if len(entries) == 1:
+            offset = entries[0]
+            lines = ["if pc == %d:" % offset]
+            lines.extend("    " + line for line in self.block(offset, blocks[offset], end))
+            lines.append("else:")
+            lines.append("    " + NO_LABEL)
+            return lines
+        middle = len(entries) // 2
+        lines = ["if pc < %d:" % entries[middle]]
+        lines.extend("    " + line for line in self.dispatch(entries[:middle], blocks, end))
+        lines.append("else:")
+        lines.extend("    " + line for line in self.dispatch(entries[middle:], blocks, end))
+        return lines
+
+    def block(self, offset, tokens, end):
+        lines = []
+        for token in tokens:
+            offset += 1
+            lines.extend(self.instruction(token))
+            if token.type in ("GOTO_LABEL", "GOTO_REGISTER"):
+                # the rest of the block is unreachable
+                return lines
+        # fall through into the block of the next label
+        lines.append("pc = %d" % offset)
+        lines.append("continue")
+        return lines
+
+    def instruction(self, token):
+        t = token.type
+        if t == "ASSIGN_REGISTER":
+            return ["%s = %s" % (self.register(token.target_register), self.register(token.source_register))]
+        elif t == "ASSIGN_CONSTANT":
+            return ["%s = %s" % (self.register(token.target_register), self.constant(token.constant))]
+        elif t == "ASSIGN_LABEL":
+            return ["%s = %d" % (self.register(token.target_register), self.label(token.label))]
+        elif t == "ASSIGN_OP":
+            return self.call(self.register(token.target_register), token)
+        elif t == "PERFORM":
+            return self.call(None, token)
+        elif t == "TEST":
+            return self.call(self.register("flag"), token)
+        elif t == "BRANCH":
+            return ["if %s:" % self.register("flag"),
+                    "    pc = %d" % self.label(token.label),
+                    "    continue"]
+        elif t == "TEST_BRANCH":
+            flag = self.register("flag")
+            return self.call(flag, token) + [
+                    "if %s:" % flag,
+                    "    pc = %d" % self.label(token.label),
+                    "    continue"]
+        elif t == "GOTO_LABEL":
+            return ["pc = %d" % self.label(token.label), "continue"]
+        elif t == "GOTO_REGISTER":
+            return ["pc = %s" % self.register(token.register), "continue"]
+        elif t == "SAVE":
+            return ["%s(%s)" % (self.stack_operation(token.register, "push"), self.register(token.register))]
+        elif t == "RESTORE":
+            return ["%s = %s()" % (self.register(token.register), self.stack_operation(token.register, "pop"))]
+        raise instructions.ExecutionError("unknown instuction type {}".format(t))
+
+    def call(self, target, token):
+        """ The lines assigning the result of an op to `target`, if not
+            None. An op of the machine's list memory may collect, which
+            moves pairs, so around it the registers are written back to
+            the register file, where the collector finds and updates
+            them, and loaded again.
+        """
+        expression = self.operation(token)
+        if not (self.register_locals and self.allocates(token)):
+            if target is None:
+                return [expression]
+            return ["%s = %s" % (target, expression)]
+        registers = [slot for name, slot in sorted(self.machine.register_index.items(), key=lambda item: item[1])
+                     if name != "pc"]
+        lines = ["regs[%d] = r%d" % (slot, slot) for slot in registers]
+        lines.append("value = %s" % expression)
+        lines.extend("r%d = regs[%d]" % (slot, slot) for slot in registers)
+        if target is not None:
+            lines.append("%s = value" % target)
+        return lines
+
+    def allocates(self, token):
+        memory = self.machine.memory
+        return memory is not None and token.op in ("cons", "list")
+
+    def operation(self, token):
+        """ A call of the op, a Python expression in its place for the
+            built-in ops of primitives.INLINE, or the value of a pure op
+            whose operands are all constants or labels.
+        """
+        ops = self.machine.ops
+        try:
+            op = ops[token.op]
+        except KeyError:
+            raise instructions.ExecutionError("unknown operation {}".format(token.op))
+        if token.op in self.machine.pure_ops and all(arg.type != "reg" for arg in token.args):
+            try:
+                return self.constant(op(*[self.value(arg) for arg in token.args]))
+            except Exception:
+                # leave the error to happen when the instruction runs
+                pass
+        args = [self.operand(arg) for arg in token.args]
+        template = primitives.inline_template(ops, token.op, len(args))
+        if template is not None:
+            return template % tuple(args)
+        if token.op not in self.op_names:
+            self.op_names[token.op] = self.closure("op", op)
+        return "%s(%s)" % (self.op_names[token.op], ", ".join(args))
+
+    def value(self, exp):
+        if exp.type == "label":
+            return self.label(exp.value)
+        return exp.value
+
+    def stack_operation(self, register, kind):
+        """ The local name of the push or pop function of the stack of
+            `register`, taken from the arguments of the controller.
+        """
+        slot = self.machine.register_slot(register)
+        key = (slot, kind)
+        if key not in self.stack_names:
+            name = self.stack_names[key] = "%s_%d" % (kind, slot)
+            self.stack_locals.append((name, kind, slot))
+        return self.stack_names[key]
+
+    def operand(self, exp):
+        t = exp.type
+        if t == "const":
+            return self.constant(exp.value)
+        elif t == "label":
+            return "%d" % self.label(exp.value)
+        elif t == "reg":
+            return self.register(exp.value)
+        raise instructions.ExecutionError("unknown type {}".format(t))
+
+    def register(self, name):
+        return "r%d" % self.machine.register_slot(name)
+
+    def label(self, name):
+        return instructions.lookup_label(self.labels, name)
+
+    def constant(self, value):
+        if type(value) in (int, str):
+            return repr(value)
+        return self.closure("const", value)
+
+    def closure(self, kind, value):
+        name = "%s_%d" % (kind, len(self.closure_names))
+        self.closure_names.append(name)
+        self.closure_values.append(value)
+        return name
+
+
+def update_compiled(insts_tokens, machine):
+    compiled = Generator(machine).generate(insts_tokens)
+    machine.install_compiled(compiled)
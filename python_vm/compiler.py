@@ -0,0 +1,539 @@
+""" The compiler of section 5.5 of SICP: Scheme expressions translated
+    into instruction tokens for the register machine, which any backend
+    assembles like a parsed controller.
+
+    It compiles the Scheme subset of the evaluator module, with
+
+      * lexical addressing: a variable bound by a lambda is found at its
+        (frame number, displacement) address in an environment of
+        Python lists, computed when it is compiled, and any other
+        variable in a dict of globals. Internal definitions are scanned
+        out into the frame of the procedure body they are in.
+      * register preservation: a save and restore is only emitted around
+        code that modifies a register that the code after it needs.
+      * open coding: calls of the primitives in OPEN_CODED that are
+        not shadowed by a local variable become a single op call.
+
+        scheme = Scheme(backend="python")
+        scheme.evaluate("(define (square x) (* x x)) (square 12)")
+
+    or, for the tokens only:
+
+        tokens = compile_expression(expression, "val", "next")
+"""
+import itertools
+
+import evaluator
+import lisp_parser
+import primitives
+import python_vm
+
+from evaluator import EvaluatorError, Primitive, to_tuple
+
+
+class CompileError(Exception): pass
+
+
+REGISTERS = ["env", "val", "continue", "proc", "argl", "arg1", "arg2"]
+ALL_REGISTERS = frozenset(REGISTERS)
+
+# primitives called directly by compiled code, by number of arguments;
+# their global definitions are assumed never to change
+OPEN_CODED = {
+    "+": 2, "-": 2, "*": 2, "=": 2, "<": 2, ">": 2, "<=": 2, ">=": 2,
+    "remainder": 2, "quotient": 2, "eq?": 2, "cons": 2,
+    "car": 1, "cdr": 1, "null?": 1, "pair?": 1, "not": 1,
+}
+
+
+# instruction sequences
+
+class InstructionSequence:
+    """ Compiled code: its statements, instruction and label tokens, and
+        the registers it needs set before it runs and modifies.
+    """
+    __slots__ = ("needs", "modifies", "statements")
+
+    def __init__(self, needs, modifies, statements):
+        self.needs = frozenset(needs)
+        self.modifies = frozenset(modifies)
+        self.statements = statements
+
+
+EMPTY = InstructionSequence((), (), [])
+
+def append_instruction_sequences(*seqs):
+    needs = set()
+    modifies = set()
+    statements = []
+    for seq in seqs:
+        needs.update(seq.needs - modifies)
+        modifies.update(seq.modifies)
+        statements.extend(seq.statements)
+    return InstructionSequence(needs, modifies, statements)
+
+def preserving(registers, seq1, seq2):
+    """ seq1 followed by seq2, with the registers of `registers` that
+        seq1 modifies and seq2 needs saved around seq1.
+    """
+    saved = [register for register in registers if register in seq1.modifies and register in seq2.needs]
+    if not saved:
+        return append_instruction_sequences(seq1, seq2)
+    statements = [lisp_parser.SaveToken(register) for register in saved]
+    statements.extend(seq1.statements)
+    statements.extend(lisp_parser.RestoreToken(register) for register in reversed(saved))
+    seq1 = InstructionSequence(seq1.needs | set(saved), seq1.modifies - set(saved), statements)
+    return append_instruction_sequences(seq1, seq2)
+
+def tack_on_instruction_sequence(seq, body):
+    return InstructionSequence(seq.needs, seq.modifies, seq.statements + body.statements)
+
+def parallel_instruction_sequences(seq1, seq2):
+    return InstructionSequence(seq1.needs | seq2.needs, seq1.modifies | seq2.modifies,
+                               seq1.statements + seq2.statements)
+
+
+# operands of instructions
+
+def reg(name):
+    return lisp_parser.PrimitiveExpToken("reg", name)
+
+def const(value):
+    return lisp_parser.PrimitiveExpToken("const", value)
+
+def label(name):
+    return lisp_parser.PrimitiveExpToken("label", name)
+
+
+# compile-time environments: a list of frames, innermost first, each the
+# tuple of variables bound in the frame
+
+def find_variable(variable, cenv):
+    """ The lexical address of `variable`, or None for a global. """
+    for depth, frame in enumerate(cenv):
+        if variable in frame:
+            return (depth, frame.index(variable))
+    return None
+
+
+def scan_out_defines(body):
+    """ The variables defined at the top of a procedure body. """
+    names = []
+    for exp in to_tuple(body):
+        if evaluator.is_definition(exp):
+            name = evaluator.definition_variable(exp)
+            if name not in names:
+                names.append(name)
+    return names
+
+
+class Compiler:
+    """ Compiles expressions, numbering the labels it makes so that the
+        code of every expression it compiles can be assembled into one
+        controller.
+    """
+    def __init__(self):
+        self.counter = itertools.count(1)
+
+    def make_label(self, name):
+        return "%s-%d" % (name, next(self.counter))
+
+    def compile(self, exp, target, linkage, cenv=()):
+        """ The InstructionSequence of `exp`, leaving its value in the
+            register `target` and then carrying on as `linkage` says:
+            "next" for the following instruction, "return" for the
+            label in continue, or any other label.
+        """
+        if evaluator.is_self_evaluating(exp) or exp is None:
+            return self.compile_constant(exp, target, linkage)
+        elif evaluator.is_variable(exp):
+            return self.compile_variable(exp, target, linkage, cenv)
+        elif evaluator.is_quoted(exp):
+            return self.compile_constant(evaluator.text_of_quotation(exp), target, linkage)
+        elif evaluator.is_assignment(exp):
+            return self.compile_assignment(exp, target, linkage, cenv)
+        elif evaluator.is_definition(exp):
+            return self.compile_definition(exp, target, linkage, cenv)
+        elif evaluator.is_if(exp):
+            return self.compile_if(exp, target, linkage, cenv)
+        elif evaluator.is_lambda(exp):
+            return self.compile_lambda(exp, target, linkage, cenv)
+        elif evaluator.is_begin(exp):
+            return self.compile_sequence(evaluator.begin_actions(exp), target, linkage, cenv)
+        elif evaluator.is_let(exp):
+            return self.compile(evaluator.let_to_combination(exp), target, linkage, cenv)
+        elif evaluator.is_cond(exp):
+            return self.compile(evaluator.cond_to_if(exp), target, linkage, cenv)
+        elif evaluator.is_application(exp):
+            if self.is_open_coded(exp, cenv):
+                return self.compile_open_coded(exp, target, linkage, cenv)
+            return self.compile_application(exp, target, linkage, cenv)
+        raise CompileError("Unknown expression type {}".format(evaluator.write(exp)))
+
+    def compile_linkage(self, linkage):
+        if linkage == "return":
+            return InstructionSequence(["continue"], [], [lisp_parser.GoToRegisterToken("continue")])
+        elif linkage == "next":
+            return EMPTY
+        return InstructionSequence([], [], [lisp_parser.GoToLabelToken(linkage)])
+
+    def end_with_linkage(self, linkage, seq):
+        return preserving(["continue"], seq, self.compile_linkage(linkage))
+
+    def compile_constant(self, value, target, linkage):
+        return self.end_with_linkage(linkage, InstructionSequence(
+            [], [target], [lisp_parser.AssignConstToken(target, value)]))
+
+    def compile_variable(self, exp, target, linkage, cenv):
+        address = find_variable(exp, cenv)
+        if address is None:
+            seq = InstructionSequence([], [target], [
+                lisp_parser.AssignOpToken(target, "global-ref", [const(exp)])])
+        else:
+            seq = InstructionSequence(["env"], [target], [
+                lisp_parser.AssignOpToken(target, "lexical-address-lookup", [const(address), reg("env")])])
+        return self.end_with_linkage(linkage, seq)
+
+    def compile_assignment(self, exp, target, linkage, cenv):
+        variable = evaluator.assignment_variable(exp)
+        value_code = self.compile(evaluator.assignment_value(exp), "val", "next", cenv)
+        return self.end_with_linkage(linkage, preserving(
+            ["env"], value_code, self.store(variable, "global-set!", target, cenv)))
+
+    def compile_definition(self, exp, target, linkage, cenv):
+        variable = evaluator.definition_variable(exp)
+        value_code = self.compile(evaluator.definition_value(exp), "val", "next", cenv)
+        return self.end_with_linkage(linkage, preserving(
+            ["env"], value_code, self.store(variable, "define-global!", target, cenv)))
+
+    def store(self, variable, global_op, target, cenv):
+        """ Set `variable` to val, a global with the op `global_op`. """
+        address = find_variable(variable, cenv)
+        if address is None:
+            statement = lisp_parser.PerformToken(global_op, [const(variable), reg("val")])
+            needs = ["val"]
+        else:
+            statement = lisp_parser.PerformToken("lexical-address-set!", [const(address), reg("val"), reg("env")])
+            needs = ["env", "val"]
+        return InstructionSequence(needs, [target], [statement, lisp_parser.AssignConstToken(target, "ok")])
+
+    def compile_if(self, exp, target, linkage, cenv):
+        t_branch = self.make_label("true-branch")
+        f_branch = self.make_label("false-branch")
+        after_if = self.make_label("after-if")
+        consequent_linkage = after_if if linkage == "next" else linkage
+        p_code = self.compile(evaluator.if_predicate(exp), "val", "next", cenv)
+        c_code = self.compile(evaluator.if_consequent(exp), target, consequent_linkage, cenv)
+        a_code = self.compile(evaluator.if_alternative(exp), target, linkage, cenv)
+        return preserving(["env", "continue"], p_code, append_instruction_sequences(
+            InstructionSequence(["val"], [], [
+                lisp_parser.TestToken("false?", [reg("val")]),
+                lisp_parser.BranchToken(f_branch)]),
+            parallel_instruction_sequences(
+                append_instruction_sequences(self.labelled(t_branch), c_code),
+                append_instruction_sequences(self.labelled(f_branch), a_code)),
+            self.labelled(after_if)))
+
+    def labelled(self, name):
+        return InstructionSequence([], [], [lisp_parser.LabelToken(name)])
+
+    def compile_sequence(self, seq, target, linkage, cenv):
+        if seq is None:
+            return self.compile_constant(None, target, linkage)
+        if evaluator.is_last_exp(seq):
+            return self.compile(evaluator.first_exp(seq), target, linkage, cenv)
+        return preserving(["env", "continue"],
+                          self.compile(evaluator.first_exp(seq), target, "next", cenv),
+                          self.compile_sequence(evaluator.rest_exps(seq), target, linkage, cenv))
+
+    def compile_lambda(self, exp, target, linkage, cenv):
+        proc_entry = self.make_label("entry")
+        after_lambda = self.make_label("after-lambda")
+        lambda_linkage = after_lambda if linkage == "next" else linkage
+        parameters = evaluator.lambda_parameters(exp)
+        try:
+            parameters = to_tuple(parameters)
+        except (TypeError, IndexError):
+            raise CompileError("Unsupported parameter list {}".format(evaluator.write(parameters)))
+        body = evaluator.lambda_body(exp)
+        internal = [name for name in scan_out_defines(body) if name not in parameters]
+        frame = parameters + tuple(internal)
+        shape = (len(parameters), len(internal))
+        return append_instruction_sequences(
+            tack_on_instruction_sequence(
+                self.end_with_linkage(lambda_linkage, InstructionSequence(["env"], [target], [
+                    lisp_parser.AssignOpToken(target, "make-compiled-procedure",
+                                              [label(proc_entry), const(shape), reg("env")])])),
+                self.compile_lambda_body(body, frame, proc_entry, cenv)),
+            self.labelled(after_lambda))
+
+    def compile_lambda_body(self, body, frame, proc_entry, cenv):
+        return append_instruction_sequences(
+            InstructionSequence(["env", "proc", "argl"], ["env"], [
+                lisp_parser.LabelToken(proc_entry),
+                lisp_parser.AssignOpToken("env", "procedure-frame", [reg("proc"), reg("argl")])]),
+            self.compile_sequence(body, "val", "return", (frame,) + tuple(cenv)))
+
+    def is_open_coded(self, exp, cenv):
+        operator = evaluator.operator(exp)
+        return (type(operator) is str and operator in OPEN_CODED and find_variable(operator, cenv) is None
+                and len(to_tuple(evaluator.operands(exp))) == OPEN_CODED[operator])
+
+    def compile_open_coded(self, exp, target, linkage, cenv):
+        operator = evaluator.operator(exp)
+        operands = to_tuple(evaluator.operands(exp))
+        if len(operands) == 1:
+            code = append_instruction_sequences(
+                self.compile(operands[0], "arg1", "next", cenv),
+                InstructionSequence(["arg1"], [target], [
+                    lisp_parser.AssignOpToken(target, operator, [reg("arg1")])]))
+        else:
+            code = preserving(["env"], self.compile(operands[0], "arg1", "next", cenv), preserving(
+                ["arg1"], self.compile(operands[1], "arg2", "next", cenv),
+                InstructionSequence(["arg1", "arg2"], [target], [
+                    lisp_parser.AssignOpToken(target, operator, [reg("arg1"), reg("arg2")])])))
+        return self.end_with_linkage(linkage, code)
+
+    def compile_application(self, exp, target, linkage, cenv):
+        proc_code = self.compile(evaluator.operator(exp), "proc", "next", cenv)
+        operand_codes = [self.compile(operand, "val", "next", cenv)
+                         for operand in to_tuple(evaluator.operands(exp))]
+        return preserving(["env", "continue"], proc_code, preserving(
+            ["proc", "continue"], self.construct_arglist(operand_codes),
+            self.compile_procedure_call(target, linkage)))
+
+    def construct_arglist(self, operand_codes):
+        """ Code evaluating the operands from left to right, like the
+            evaluator, into argl, which is therefore a list of the
+            arguments in reverse order.
+        """
+        if not operand_codes:
+            return InstructionSequence([], ["argl"], [lisp_parser.AssignConstToken("argl", None)])
+        code_to_get_first_arg = append_instruction_sequences(
+            operand_codes[0],
+            InstructionSequence(["val"], ["argl"], [
+                lisp_parser.AssignOpToken("argl", "cons", [reg("val"), const(None)])]))
+        if len(operand_codes) == 1:
+            return code_to_get_first_arg
+        return preserving(["env"], code_to_get_first_arg, self.code_to_get_rest_args(operand_codes[1:]))
+
+    def code_to_get_rest_args(self, operand_codes):
+        code_for_next_arg = preserving(["argl"], operand_codes[0], InstructionSequence(
+            ["val", "argl"], ["argl"], [
+                lisp_parser.AssignOpToken("argl", "cons", [reg("val"), reg("argl")])]))
+        if len(operand_codes) == 1:
+            return code_for_next_arg
+        return preserving(["env"], code_for_next_arg, self.code_to_get_rest_args(operand_codes[1:]))
+
+    def compile_procedure_call(self, target, linkage):
+        primitive_branch = self.make_label("primitive-branch")
+        compiled_branch = self.make_label("compiled-branch")
+        after_call = self.make_label("after-call")
+        compiled_linkage = after_call if linkage == "next" else linkage
+        return append_instruction_sequences(
+            InstructionSequence(["proc"], [], [
+                lisp_parser.TestToken("primitive-procedure?", [reg("proc")]),
+                lisp_parser.BranchToken(primitive_branch)]),
+            parallel_instruction_sequences(
+                append_instruction_sequences(self.labelled(compiled_branch),
+                                             self.compile_proc_appl(target, compiled_linkage)),
+                append_instruction_sequences(self.labelled(primitive_branch), self.end_with_linkage(
+                    linkage, InstructionSequence(["proc", "argl"], [target], [
+                        lisp_parser.AssignOpToken(target, "apply-primitive-procedure",
+                                                  [reg("proc"), reg("argl")])])))),
+            self.labelled(after_call))
+
+    def compile_proc_appl(self, target, linkage):
+        call = [lisp_parser.AssignOpToken("val", "compiled-procedure-entry", [reg("proc")]),
+                lisp_parser.GoToRegisterToken("val")]
+        if target == "val" and linkage != "return":
+            return InstructionSequence(["proc"], ALL_REGISTERS,
+                                       [lisp_parser.AssignLabelToken("continue", linkage)] + call)
+        elif target != "val" and linkage != "return":
+            proc_return = self.make_label("proc-return")
+            return InstructionSequence(["proc"], ALL_REGISTERS,
+                                       [lisp_parser.AssignLabelToken("continue", proc_return)] + call + [
+                                           lisp_parser.LabelToken(proc_return),
+                                           lisp_parser.AssignRegisterToken(target, "val"),
+                                           lisp_parser.GoToLabelToken(linkage)])
+        elif target == "val":
+            return InstructionSequence(["proc", "continue"], ALL_REGISTERS, call)
+        raise CompileError("return linkage, target not val: {}".format(target))
+
+
+def compile_expression(exp, target="val", linkage="next"):
+    """ The instruction tokens of the expression `exp`. """
+    return Compiler().compile(exp, target, linkage).statements
+
+
+# run time
+
+class CompiledProcedure:
+    __slots__ = ("entry", "shape", "environment")
+
+    def __init__(self, entry, shape, environment):
+        self.entry = entry
+        self.shape = shape
+        self.environment = environment
+
+
+class Unassigned:
+    """ The value of an internal definition before it has run. """
+    def __repr__(self):
+        return "*unassigned*"
+
+UNASSIGNED = Unassigned()
+
+
+# An environment is a (values, enclosing environment) pair, where the
+# values of a frame are a list in the order of the variables of the
+# frame; the globals are not part of it, so the top level environment
+# is None.
+
+def lexical_address_lookup(address, env):
+    depth, offset = address
+    while depth:
+        env = env[1]
+        depth -= 1
+    value = env[0][offset]
+    if value is UNASSIGNED:
+        raise EvaluatorError("Unassigned variable at {}".format(address))
+    return value
+
+def lexical_address_set(address, value, env):
+    depth, offset = address
+    while depth:
+        env = env[1]
+        depth -= 1
+    env[0][offset] = value
+
+def make_compiled_procedure(entry, shape, env):
+    return CompiledProcedure(entry, shape, env)
+
+def compiled_procedure_entry(proc):
+    if type(proc) is not CompiledProcedure:
+        raise EvaluatorError("Unknown procedure type {}".format(evaluator.write(proc)))
+    return proc.entry
+
+def arguments(argl):
+    """ The list of the arguments in the reversed list `argl`. """
+    values = []
+    while argl is not None:
+        values.append(argl[0])
+        argl = argl[1]
+    values.reverse()
+    return values
+
+def procedure_frame(proc, argl):
+    """ The environment of a call of `proc` on the arguments `argl`. """
+    values = arguments(argl)
+    parameters, internal = proc.shape
+    if len(values) != parameters:
+        raise EvaluatorError("{} arguments for {} parameters".format(len(values), parameters))
+    if internal:
+        values.extend([UNASSIGNED] * internal)
+    return (values, proc.environment)
+
+def is_primitive_procedure(proc):
+    return type(proc) is Primitive
+
+def apply_primitive_procedure(proc, argl):
+    return proc.function(*arguments(argl))
+
+def is_false(x):
+    return x is False
+
+
+def global_frame():
+    return evaluator.global_environment()[0]
+
+
+def operations(globals):
+    """ The ops of compiled code, with the dict `globals` of global
+        variables.
+    """
+    def global_ref(name):
+        try:
+            return globals[name]
+        except KeyError:
+            raise EvaluatorError("Unbound variable {}".format(name))
+
+    def global_set(name, value):
+        if name not in globals:
+            raise EvaluatorError("Unbound variable {}".format(name))
+        globals[name] = value
+
+    def define_global(name, value):
+        globals[name] = value
+
+    return {
+        "global-ref": global_ref,
+        "global-set!": global_set,
+        "define-global!": define_global,
+        "lexical-address-lookup": lexical_address_lookup,
+        "lexical-address-set!": lexical_address_set,
+        "make-compiled-procedure": make_compiled_procedure,
+        "compiled-procedure-entry": compiled_procedure_entry,
+        "procedure-frame": procedure_frame,
+        "primitive-procedure?": is_primitive_procedure,
+        "apply-primitive-procedure": apply_primitive_procedure,
+        "false?": is_false,
+    }
+
+
+class Scheme:
+    """ A machine running compiled code, with the globals kept across
+        calls of evaluate. The code of every expression compiled is
+        appended to the controller, so that the entry points of the
+        procedures it made stay valid.
+        backend, options:
+            Passed on to python_vm.install_controller. With the closure
+            backend and no options only the new code is assembled, see
+            python_vm.extend_controller; otherwise the whole controller
+            is assembled again for every compile, which makes a long
+            session quadratic in the code compiled.
+        max_stack_depth:
+            Limit on the machine stack, see python_vm.Machine.
+    """
+    def __init__(self, backend="closure", max_stack_depth=None, **options):
+        self.globals = global_frame()
+        self.machine = python_vm.make_machine(REGISTERS, operations(self.globals), max_stack_depth=max_stack_depth)
+        self.backend = backend
+        self.options = options
+        self.compiler = Compiler()
+        self.code = []
+
+    def compile(self, text):
+        """ Compile the expressions in `text` into the controller and
+            return the label their code starts at. The code returns to
+            the continue register, which run sets to the label done at
+            the end of the controller.
+        """
+        start = self.compiler.make_label("start")
+        # one sequence, so that continue is preserved around the calls
+        # of every expression but the last
+        expressions = primitives.make_list(*evaluator.read(text))
+        code = [lisp_parser.LabelToken(start)]
+        code.extend(self.compiler.compile_sequence(expressions, "val", "return", ()).statements)
+        done = [lisp_parser.LabelToken("done")]
+        if self.code and self.backend == "closure" and not self.options:
+            python_vm.extend_controller(self.machine, code + done)
+        else:
+            python_vm.install_controller(self.machine, self.code + code + done, self.backend, **self.options)
+        self.code.extend(code)
+        return start
+
+    def run(self, start):
+        """ Run the code compiled at label `start` and return the value
+            of its last expression.
+        """
+        machine = self.machine
+        machine.initialise_stacks()
+        machine.set_register_value("env", None)
+        machine.set_register_value("continue", machine.label_pointers["done"])
+        machine.pc.set_contents(machine.label_pointers[start])
+        machine.execute()
+        return machine.get_register_value("val")
+
+    def evaluate(self, text):
+        return self.run(self.compile(text))
@@ -0,0 +1,642 @@
+""" The explicit-control evaluator of section 5.4 of SICP, as a
+    controller for the register machine together with the ops it uses.
+
+    It interprets a Scheme subset: numbers, booleans, variables, quote,
+    if, cond, let, lambda, define, set!, begin and applications of
+    compound procedures and the primitives in PRIMITIVES. Scheme data
+    use the representation of the built-in op library: pairs are
+    [car, cdr] lists, the empty list is None and symbols are strings.
+
+        ev = Evaluator(backend="python")
+        ev.evaluate("(define (square x) (* x x)) (square 12)")
+
+    The controller can also be assembled by hand:
+
+        machine = python_vm.make_machine(REGISTERS, operations())
+        python_vm.assemble_machine(machine, CONTROLLER)
+
+    after which `exp` holds the expression to evaluate and `env` the
+    environment to evaluate it in; the value ends up in `val`.
+"""
+import re
+import sys
+
+import primitives
+import python_vm
+
+
+class EvaluatorError(Exception): pass
+
+
+REGISTERS = ["exp", "env", "val", "continue", "proc", "argl", "unev"]
+
+CONTROLLER = '''(eval-start
+    (assign continue (label eval-done))
+    eval-dispatch
+    (test (op self-evaluating?) (reg exp))
+    (branch (label ev-self-eval))
+    (test (op variable?) (reg exp))
+    (branch (label ev-variable))
+    (test (op quoted?) (reg exp))
+    (branch (label ev-quoted))
+    (test (op assignment?) (reg exp))
+    (branch (label ev-assignment))
+    (test (op definition?) (reg exp))
+    (branch (label ev-definition))
+    (test (op if?) (reg exp))
+    (branch (label ev-if))
+    (test (op lambda?) (reg exp))
+    (branch (label ev-lambda))
+    (test (op begin?) (reg exp))
+    (branch (label ev-begin))
+    (test (op let?) (reg exp))
+    (branch (label ev-let))
+    (test (op cond?) (reg exp))
+    (branch (label ev-cond))
+    (test (op application?) (reg exp))
+    (branch (label ev-application))
+    (goto (label unknown-expression-type))
+
+    ev-self-eval
+    (assign val (reg exp))
+    (goto (reg continue))
+    ev-variable
+    (assign val (op lookup-variable-value) (reg exp) (reg env))
+    (goto (reg continue))
+    ev-quoted
+    (assign val (op text-of-quotation) (reg exp))
+    (goto (reg continue))
+    ev-lambda
+    (assign unev (op lambda-parameters) (reg exp))
+    (assign exp (op lambda-body) (reg exp))
+    (assign val (op make-procedure) (reg unev) (reg exp) (reg env))
+    (goto (reg continue))
+
+    ev-application
+    (save continue)
+    (save env)
+    (assign unev (op operands) (reg exp))
+    (save unev)
+    (assign exp (op operator) (reg exp))
+    (assign continue (label ev-appl-did-operator))
+    (goto (label eval-dispatch))
+    ev-appl-did-operator
+    (restore unev)
+    (restore env)
+    (assign argl (op empty-arglist))
+    (assign proc (reg val))
+    (test (op no-operands?) (reg unev))
+    (branch (label apply-dispatch))
+    (save proc)
+    ev-appl-operand-loop
+    (save argl)
+    (assign exp (op first-operand) (reg unev))
+    (test (op last-operand?) (reg unev))
+    (branch (label ev-appl-last-arg))
+    (save env)
+    (save unev)
+    (assign continue (label ev-appl-accumulate-arg))
+    (goto (label eval-dispatch))
+    ev-appl-accumulate-arg
+    (restore unev)
+    (restore env)
+    (restore argl)
+    (assign argl (op adjoin-arg) (reg val) (reg argl))
+    (assign unev (op rest-operands) (reg unev))
+    (goto (label ev-appl-operand-loop))
+    ev-appl-last-arg
+    (assign continue (label ev-appl-accum-last-arg))
+    (goto (label eval-dispatch))
+    ev-appl-accum-last-arg
+    (restore argl)
+    (assign argl (op adjoin-arg) (reg val) (reg argl))
+    (restore proc)
+    (goto (label apply-dispatch))
+
+    apply-dispatch
+    (test (op primitive-procedure?) (reg proc))
+    (branch (label primitive-apply))
+    (test (op compound-procedure?) (reg proc))
+    (branch (label compound-apply))
+    (goto (label unknown-procedure-type))
+    primitive-apply
+    (assign val (op apply-primitive-procedure) (reg proc) (reg argl))
+    (restore continue)
+    (goto (reg continue))
+    compound-apply
+    (assign unev (op procedure-parameters) (reg proc))
+    (assign env (op procedure-environment) (reg proc))
+    (assign env (op extend-environment) (reg unev) (reg argl) (reg env))
+    (assign unev (op procedure-body) (reg proc))
+    (goto (label ev-sequence))
+
+    ev-begin
+    (assign unev (op begin-actions) (reg exp))
+    (save continue)
+    (goto (label ev-sequence))
+    ev-sequence
+    (assign exp (op first-exp) (reg unev))
+    (test (op last-exp?) (reg unev))
+    (branch (label ev-sequence-last-exp))
+    (save unev)
+    (save env)
+    (assign continue (label ev-sequence-continue))
+    (goto (label eval-dispatch))
+    ev-sequence-continue
+    (restore env)
+    (restore unev)
+    (assign unev (op rest-exps) (reg unev))
+    (goto (label ev-sequence))
+    ev-sequence-last-exp
+    (restore continue)
+    (goto (label eval-dispatch))
+
+    ev-if
+    (save exp)
+    (save env)
+    (save continue)
+    (assign continue (label ev-if-decide))
+    (assign exp (op if-predicate) (reg exp))
+    (goto (label eval-dispatch))
+    ev-if-decide
+    (restore continue)
+    (restore env)
+    (restore exp)
+    (test (op true?) (reg val))
+    (branch (label ev-if-consequent))
+    (assign exp (op if-alternative) (reg exp))
+    (goto (label eval-dispatch))
+    ev-if-consequent
+    (assign exp (op if-consequent) (reg exp))
+    (goto (label eval-dispatch))
+
+    ev-assignment
+    (assign unev (op assignment-variable) (reg exp))
+    (save unev)
+    (assign exp (op assignment-value) (reg exp))
+    (save env)
+    (save continue)
+    (assign continue (label ev-assignment-1))
+    (goto (label eval-dispatch))
+    ev-assignment-1
+    (restore continue)
+    (restore env)
+    (restore unev)
+    (perform (op set-variable-value!) (reg unev) (reg val) (reg env))
+    (assign val (const ok))
+    (goto (reg continue))
+
+    ev-definition
+    (assign unev (op definition-variable) (reg exp))
+    (save unev)
+    (assign exp (op definition-value) (reg exp))
+    (save env)
+    (save continue)
+    (assign continue (label ev-definition-1))
+    (goto (label eval-dispatch))
+    ev-definition-1
+    (restore continue)
+    (restore env)
+    (restore unev)
+    (perform (op define-variable!) (reg unev) (reg val) (reg env))
+    (assign val (const ok))
+    (goto (reg continue))
+
+    ev-let
+    (assign exp (op let->combination) (reg exp))
+    (goto (label eval-dispatch))
+    ev-cond
+    (assign exp (op cond->if) (reg exp))
+    (goto (label eval-dispatch))
+
+    unknown-expression-type
+    (perform (op error) (const unknown-expression-type) (reg exp))
+    unknown-procedure-type
+    (perform (op error) (const unknown-procedure-type) (reg proc))
+    eval-done)'''
+
+
+# reader
+
+TOKEN = re.compile(r"[()']|[^\s()';]+")
+COMMENT = re.compile(r";[^\n]*")
+
+
+def read(text):
+    """ The list of the expressions in `text`. """
+    tokens = TOKEN.findall(COMMENT.sub("", text))
+    expressions = []
+    index = 0
+    while index < len(tokens):
+        expression, index = read_expression(tokens, index)
+        expressions.append(expression)
+    return expressions
+
+
+def read_expression(tokens, index):
+    token = tokens[index]
+    if token == "(":
+        items = []
+        index += 1
+        while True:
+            if index == len(tokens):
+                raise EvaluatorError("Unbalanced (")
+            if tokens[index] == ")":
+                return primitives.make_list(*items), index + 1
+            if tokens[index] == "." and items:
+                tail, index = read_expression(tokens, index + 1)
+                if index == len(tokens) or tokens[index] != ")":
+                    raise EvaluatorError("Expected ) after the tail of a dotted list")
+                for item in reversed(items):
+                    tail = [item, tail]
+                return tail, index + 1
+            item, index = read_expression(tokens, index)
+            items.append(item)
+    elif token == ")":
+        raise EvaluatorError("Unbalanced )")
+    elif token == "'":
+        quoted, index = read_expression(tokens, index + 1)
+        return primitives.make_list("quote", quoted), index
+    return atom(token), index + 1
+
+
+def atom(token):
+    if token == "#t":
+        return True
+    elif token == "#f":
+        return False
+    try:
+        return int(token)
+    except ValueError:
+        return sys.intern(token)
+
+
+def write(value):
+    """ The external representation of a Scheme value. """
+    if value is True:
+        return "#t"
+    elif value is False:
+        return "#f"
+    elif value is None:
+        return "()"
+    elif type(value) is list:
+        items = []
+        while type(value) is list:
+            items.append(write(value[0]))
+            value = value[1]
+        if value is not None:
+            items.append(".")
+            items.append(write(value))
+        return "(" + " ".join(items) + ")"
+    elif isinstance(value, Procedure):
+        return "<compound-procedure>"
+    elif isinstance(value, Primitive):
+        return "<primitive-procedure>"
+    return str(value)
+
+
+def to_tuple(items):
+    result = []
+    while items is not None:
+        result.append(items[0])
+        items = items[1]
+    return tuple(result)
+
+
+# syntax
+
+def is_tagged_list(exp, tag):
+    return type(exp) is list and exp[0] == tag
+
+def is_self_evaluating(exp):
+    return type(exp) is int or type(exp) is bool
+
+def is_variable(exp):
+    return type(exp) is str
+
+def is_quoted(exp):
+    return is_tagged_list(exp, "quote")
+
+def text_of_quotation(exp):
+    return exp[1][0]
+
+def is_assignment(exp):
+    return is_tagged_list(exp, "set!")
+
+def assignment_variable(exp):
+    return exp[1][0]
+
+def assignment_value(exp):
+    return exp[1][1][0]
+
+def is_definition(exp):
+    return is_tagged_list(exp, "define")
+
+def definition_variable(exp):
+    target = exp[1][0]
+    if type(target) is list:
+        return target[0]
+    return target
+
+def definition_value(exp):
+    target = exp[1][0]
+    if type(target) is list:
+        # (define (f . params) body ...)
+        return make_lambda(target[1], exp[1][1])
+    return exp[1][1][0]
+
+def make_lambda(parameters, body):
+    return ["lambda", [parameters, body]]
+
+def is_lambda(exp):
+    return is_tagged_list(exp, "lambda")
+
+def lambda_parameters(exp):
+    return exp[1][0]
+
+def lambda_body(exp):
+    return exp[1][1]
+
+def is_if(exp):
+    return is_tagged_list(exp, "if")
+
+def if_predicate(exp):
+    return exp[1][0]
+
+def if_consequent(exp):
+    return exp[1][1][0]
+
+def if_alternative(exp):
+    rest = exp[1][1][1]
+    if rest is None:
+        return False
+    return rest[0]
+
+def make_if(predicate, consequent, alternative):
+    return primitives.make_list("if", predicate, consequent, alternative)
+
+def is_begin(exp):
+    return is_tagged_list(exp, "begin")
+
+def begin_actions(exp):
+    return exp[1]
+
+def is_last_exp(seq):
+    return seq[1] is None
+
+def first_exp(seq):
+    return seq[0]
+
+def rest_exps(seq):
+    return seq[1]
+
+def sequence_to_exp(seq):
+    if seq is None:
+        return seq
+    elif is_last_exp(seq):
+        return first_exp(seq)
+    return ["begin", seq]
+
+def is_let(exp):
+    return is_tagged_list(exp, "let")
+
+def let_to_combination(exp):
+    bindings = to_tuple(exp[1][0])
+    body = exp[1][1]
+    parameters = primitives.make_list(*[binding[0] for binding in bindings])
+    arguments = primitives.make_list(*[binding[1][0] for binding in bindings])
+    return [make_lambda(parameters, body), arguments]
+
+def is_cond(exp):
+    return is_tagged_list(exp, "cond")
+
+def cond_to_if(exp):
+    return expand_clauses(exp[1])
+
+def expand_clauses(clauses):
+    if clauses is None:
+        return False
+    first = clauses[0]
+    if first[0] == "else":
+        if clauses[1] is not None:
+            raise EvaluatorError("else clause is not last")
+        return sequence_to_exp(first[1])
+    return make_if(first[0], sequence_to_exp(first[1]), expand_clauses(clauses[1]))
+
+def is_application(exp):
+    return type(exp) is list
+
+def operator(exp):
+    return exp[0]
+
+def operands(exp):
+    return exp[1]
+
+def no_operands(ops):
+    return ops is None
+
+def first_operand(ops):
+    return ops[0]
+
+def rest_operands(ops):
+    return ops[1]
+
+def is_last_operand(ops):
+    return ops[1] is None
+
+def empty_arglist():
+    return ()
+
+def adjoin_arg(arg, arglist):
+    return arglist + (arg,)
+
+def is_true(x):
+    return x is not False
+
+
+# procedures and environments
+
+class Procedure:
+    __slots__ = ("parameters", "body", "environment")
+
+    def __init__(self, parameters, body, environment):
+        self.parameters = parameters
+        self.body = body
+        self.environment = environment
+
+
+class Primitive:
+    __slots__ = ("function",)
+
+    def __init__(self, function):
+        self.function = function
+
+
+def make_procedure(parameters, body, env):
+    return Procedure(to_tuple(parameters), body, env)
+
+def is_compound_procedure(proc):
+    return type(proc) is Procedure
+
+def procedure_parameters(proc):
+    return proc.parameters
+
+def procedure_body(proc):
+    return proc.body
+
+def procedure_environment(proc):
+    return proc.environment
+
+def is_primitive_procedure(proc):
+    return type(proc) is Primitive
+
+def apply_primitive_procedure(proc, args):
+    return proc.function(*args)
+
+
+# An environment is a (frame, enclosing environment) pair, where a frame
+# is a dict of variable to value; the empty environment is None.
+
+def extend_environment(variables, values, env):
+    if len(variables) != len(values):
+        raise EvaluatorError("{} arguments for parameters {}".format(len(values), variables))
+    return (dict(zip(variables, values)), env)
+
+def lookup_variable_value(var, env):
+    while env is not None:
+        frame, env = env
+        if var in frame:
+            return frame[var]
+    raise EvaluatorError("Unbound variable {}".format(var))
+
+def set_variable_value(var, value, env):
+    while env is not None:
+        frame, env = env
+        if var in frame:
+            frame[var] = value
+            return
+    raise EvaluatorError("Unbound variable {}".format(var))
+
+def define_variable(var, value, env):
+    env[0][var] = value
+
+def error(message, irritant):
+    raise EvaluatorError("{} {}".format(message, write(irritant)))
+
+
+PRIMITIVES = {
+    "+": primitives.OPS["+"],
+    "-": primitives.OPS["-"],
+    "*": primitives.OPS["*"],
+    "=": primitives.OPS["="],
+    "<": primitives.OPS["<"],
+    ">": primitives.OPS[">"],
+    "<=": primitives.OPS["<="],
+    ">=": primitives.OPS[">="],
+    "remainder": primitives.remainder,
+    "quotient": primitives.quotient,
+    "not": primitives.OPS["not"],
+    "eq?": primitives.eq,
+    "equal?": primitives.equal,
+    "cons": primitives.cons,
+    "car": primitives.car,
+    "cdr": primitives.cdr,
+    "set-car!": primitives.set_car,
+    "set-cdr!": primitives.set_cdr,
+    "null?": primitives.is_null,
+    "pair?": primitives.is_pair,
+    "number?": primitives.is_number,
+    "symbol?": primitives.is_symbol,
+    "list": primitives.make_list,
+}
+
+
+def global_environment():
+    frame = dict((name, Primitive(function)) for name, function in PRIMITIVES.items())
+    frame["true"] = True
+    frame["false"] = False
+    return (frame, None)
+
+
+def operations():
+    """ The ops of the evaluator controller. """
+    return {
+        "self-evaluating?": is_self_evaluating,
+        "variable?": is_variable,
+        "quoted?": is_quoted,
+        "text-of-quotation": text_of_quotation,
+        "assignment?": is_assignment,
+        "assignment-variable": assignment_variable,
+        "assignment-value": assignment_value,
+        "definition?": is_definition,
+        "definition-variable": definition_variable,
+        "definition-value": definition_value,
+        "if?": is_if,
+        "if-predicate": if_predicate,
+        "if-consequent": if_consequent,
+        "if-alternative": if_alternative,
+        "lambda?": is_lambda,
+        "lambda-parameters": lambda_parameters,
+        "lambda-body": lambda_body,
+        "begin?": is_begin,
+        "begin-actions": begin_actions,
+        "let?": is_let,
+        "let->combination": let_to_combination,
+        "cond?": is_cond,
+        "cond->if": cond_to_if,
+        "application?": is_application,
+        "operator": operator,
+        "operands": operands,
+        "no-operands?": no_operands,
+        "first-operand": first_operand,
+        "rest-operands": rest_operands,
+        "last-operand?": is_last_operand,
+        "empty-arglist": empty_arglist,
+        "adjoin-arg": adjoin_arg,
+        "first-exp": first_exp,
+        "rest-exps": rest_exps,
+        "last-exp?": is_last_exp,
+        "true?": is_true,
+        "make-procedure": make_procedure,
+        "compound-procedure?": is_compound_procedure,
+        "procedure-parameters": procedure_parameters,
+        "procedure-body": procedure_body,
+        "procedure-environment": procedure_environment,
+        "primitive-procedure?": is_primitive_procedure,
+        "apply-primitive-procedure": apply_primitive_procedure,
+        "extend-environment": extend_environment,
+        "lookup-variable-value": lookup_variable_value,
+        "set-variable-value!": set_variable_value,
+        "define-variable!": define_variable,
+        "error": error,
+    }
+
+
+class Evaluator:
+    """ A machine running the evaluator controller, with a global
+        environment kept across calls of evaluate.
+        backend, options:
+            Passed on to python_vm.assemble_machine.
+        max_stack_depth:
+            Limit on the machine stack, so that runaway recursion
+            raises python_vm.StackError.
+    """
+    def __init__(self, backend="closure", max_stack_depth=None, profile=False, **options):
+        self.machine = python_vm.make_machine(REGISTERS, operations(), max_stack_depth=max_stack_depth)
+        self.profile = self.machine.enable_profiling() if profile else None
+        python_vm.assemble_machine(self.machine, CONTROLLER, backend=backend, **options)
+        self.environment = global_environment()
+
+    def evaluate(self, text):
+        """ Evaluate the expressions in `text` in turn and return the
+            value of the last one.
+        """
+        machine = self.machine
+        value = None
+        for expression in read(text):
+            machine.initialise_stacks()
+            machine.set_register_value("exp", expression)
+            machine.set_register_value("env", self.environment)
+            machine.start()
+            value = machine.get_register_value("val")
+        return value
@@ -1,168 +1,315 @@
-
 import parser
 import lexer
 
 
 def update_instructions(insts_tokens, machine):
-    pc = machine.lookup_register("pc")
-    flag = machine.lookup_register("flag")
+    instructions = []
+    append_instructions(insts_tokens, machine, instructions)
+    machine.install_instruction_sequence(instructions)
+
+
+def extend_instructions(insts_tokens, machine):
+    """ Like update_instructions, but appends the execution procedures
+        to the instruction sequence already installed, whose offsets
+        and labels stay valid.
+    """
+    append_instructions(insts_tokens, machine, machine.instruction_sequence)
+
+
+def append_instructions(insts_tokens, machine, instructions):
+    regs = machine.slots
+    pc = machine.register_slot("pc")
+    flag = machine.register_slot("flag")
     stack = machine.stack
     ops = machine.ops
-    instructions = []
-    count = 0
-    for i in range(len(insts_tokens) - 1, -1, -1):
-        token = insts_tokens[i]
+    labels = machine.label_pointers
+    # a single pass, so `insts_tokens` may be a stream: every label is
+    # resolved to the offset of the instruction that follows it, and
+    # instructions referring to labels not seen yet are only kept until
+    # the end of the stream
+    pending = []
+    for token in insts_tokens:
         if token.type == "LABEL":
-            machine.label_pointers[token.label] = instructions[::-1]
-        else:
-            instr = make_execution_procedure(token, machine.label_pointers, machine, pc, flag, stack, ops)
+            labels[token.label] = len(instructions)
+        elif all(label in labels for label in referenced_labels(token)):
+            instr = make_execution_procedure(token, labels, machine, regs, pc, flag, stack, ops)
             instructions.append(instr)
-            count += 1
+        else:
+            pending.append((len(instructions), token))
+            instructions.append(None)
+    for offset, token in pending:
+        instructions[offset] = make_execution_procedure(token, labels, machine, regs, pc, flag, stack, ops)
+
+
+class LazyBlocks:
+    """ The blocks of a controller assembled by update_instructions_lazily.
+        blocks:
+            Number of blocks: the instructions from the start of the
+            controller or a label up to the next label.
+        compiled:
+            Number of blocks compiled so far.
+    """
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.compiled = 0
+
+    def __repr__(self):
+        return "<LazyBlocks {} of {} compiled>".format(self.compiled, self.blocks)
+
+
+def update_instructions_lazily(insts_tokens, machine):
+    """ Like update_instructions, but every instruction of a block
+        starts out as a stub, shared by the block, that builds the
+        execution procedures of the whole block the first time control
+        reaches it, puts them in its place and runs the one at pc, so
+        that an error in an instruction, such as an unknown op, only
+        shows when its block first runs. Returns the LazyBlocks of the
+        controller.
+    """
+    regs = machine.slots
+    pc = machine.register_slot("pc")
+    flag = machine.register_slot("flag")
+    stack = machine.stack
+    ops = machine.ops
+    labels = machine.label_pointers
+    tokens = []
+    starts = [0]
+    for token in insts_tokens:
+        if token.type == "LABEL":
+            labels[token.label] = len(tokens)
+            if starts[-1] != len(tokens):
+                starts.append(len(tokens))
+        else:
+            tokens.append(token)
+    if starts[-1] == len(tokens):
+        starts.pop()
+    lazy = LazyBlocks(len(starts))
+    instructions = []
+
+    def make_stub(start, end):
+        def stub():
+            instructions[start:end] = [make_execution_procedure(token, labels, machine, regs, pc, flag, stack, ops)
+                                       for token in tokens[start:end]]
+            lazy.compiled += 1
+            instructions[regs[pc]]()
+        return stub
+
+    for start, end in zip(starts, starts[1:] + [len(tokens)]):
+        instructions.extend([make_stub(start, end)] * (end - start))
     machine.install_instruction_sequence(instructions)
+    return lazy
+
+
+def referenced_labels(inst):
+    t = inst.type
+    if t in ("BRANCH", "GOTO_LABEL", "ASSIGN_LABEL"):
+        return [inst.label]
+    elif t in ("ASSIGN_OP", "PERFORM", "TEST"):
+        return [arg.value for arg in inst.args if arg.type == "label"]
+    elif t == "TEST_BRANCH":
+        return [inst.label] + [arg.value for arg in inst.args if arg.type == "label"]
+    return []
 
         
 class ExecutionError(Exception): pass
 
         
-def make_execution_procedure(inst, labels, machine, pc, flag, stack, ops):
+def make_execution_procedure(inst, labels, machine, regs, pc, flag, stack, ops):
     t = inst.type
     if t == "ASSIGN_REGISTER":
-        return make_assign_register_instruction(inst, machine, labels, ops, pc)
+        return make_assign_register_instruction(inst, machine, labels, ops, regs, pc)
     elif t == "ASSIGN_CONSTANT":
-        return make_assign_constant_instruction(inst, machine, labels, ops, pc)
+        return make_assign_constant_instruction(inst, machine, labels, ops, regs, pc)
     elif t == "ASSIGN_LABEL":
-        return make_assign_label_instruction(inst, machine, labels, ops, pc)
+        return make_assign_label_instruction(inst, machine, labels, ops, regs, pc)
     elif t == "ASSIGN_OP":
-        return make_assign_op_instruction(inst, machine, labels, ops, pc)
+        return make_assign_op_instruction(inst, machine, labels, ops, regs, pc)
     elif t == "PERFORM":
-        return make_perform_instruction(inst, machine, labels, ops ,pc)        
+        return make_perform_instruction(inst, machine, labels, ops, regs, pc)
     elif t == "TEST":
-        return make_test_instruction(inst, machine, labels, ops, flag, pc)
+        return make_test_instruction(inst, machine, labels, ops, regs, flag, pc)
     elif t == "BRANCH":
-        return make_branch_instruction(inst, machine, labels, flag, pc)
+        return make_branch_instruction(inst, machine, labels, regs, flag, pc)
+    elif t == "TEST_BRANCH":
+        return make_test_branch_instruction(inst, machine, labels, ops, regs, flag, pc)
     elif t == "GOTO_LABEL":     
-        return make_goto_label_instruction(inst, machine, labels, pc)
+        return make_goto_label_instruction(inst, machine, labels, regs, pc)
     elif t == "GOTO_REGISTER":
-        return make_goto_register_instruction(inst, machine, labels, pc)
+        return make_goto_register_instruction(inst, machine, labels, regs, pc)
     elif t == "SAVE":
-        return make_save_instruction(inst, machine, stack, pc)
+        return make_save_instruction(inst, machine, stack, regs, pc)
     elif t == "RESTORE":
-        return make_restore_instruction(inst, machine, stack, pc)
+        return make_restore_instruction(inst, machine, stack, regs, pc)
     raise ExecutionError("unknown instuction type {}".format(t)) 
         
 
+# Every execution procedure reads and writes the machine's register
+# file `regs` directly; `pc`, `flag` and the register operands are
+# slot indices resolved once, when the instruction is assembled.
 
-def make_assign_register_instruction(inst, machine, labels, ops, pc):
-    source_register = machine.lookup_register(inst.source_register)
-    target_register = machine.lookup_register(inst.target_register)
+def make_assign_register_instruction(inst, machine, labels, ops, regs, pc):
+    source = machine.register_slot(inst.source_register)
+    target = machine.register_slot(inst.target_register)
     def execution():
-        target_register.set_contents(source_register.get_contents())
-        advance_pc(pc)
+        regs[target] = regs[source]
+        regs[pc] += 1
     return execution
 
-def make_assign_constant_instruction(inst, machine, labels, ops, pc):
-    target_register = machine.lookup_register(inst.target_register)
+def make_assign_constant_instruction(inst, machine, labels, ops, regs, pc):
+    target = machine.register_slot(inst.target_register)
     constant = inst.constant
     def execution():
-        target_register.set_contents(constant)
-        advance_pc(pc)
+        regs[target] = constant
+        regs[pc] += 1
     return execution
 
-def make_assign_label_instruction(inst, machine, labels, ops, pc):
-    target_register = machine.lookup_register(inst.target_register)
-    label = inst.label
+def make_assign_label_instruction(inst, machine, labels, ops, regs, pc):
+    target = machine.register_slot(inst.target_register)
+    offset = lookup_label(labels, inst.label)
     def execution():
-        target_register.set_contents(labels[label])
-        advance_pc(pc)
+        regs[target] = offset
+        regs[pc] += 1
     return execution
 
-def make_assign_op_instruction(inst, machine, labels, ops, pc):
-    target_register = machine.lookup_register(inst.target_register)
-    condition_proc = make_operation_exp(inst, machine, labels, ops)
+def make_assign_op_instruction(inst, machine, labels, ops, regs, pc):
+    target = machine.register_slot(inst.target_register)
+    condition_proc = make_operation_exp(inst, machine, labels, ops, regs)
     def execution():
-        op_result = condition_proc()
-        target_register.set_contents(op_result)
-        advance_pc(pc)
+        regs[target] = condition_proc()
+        regs[pc] += 1
     return execution 
     
-def make_perform_instruction(inst, machine, labels, ops ,pc):
-    action = make_operation_exp(inst, machine, labels, ops)
+def make_perform_instruction(inst, machine, labels, ops, regs, pc):
+    action = make_operation_exp(inst, machine, labels, ops, regs)
     def execution():
         action()
-        advance_pc(pc)
+        regs[pc] += 1
     return execution
   
-def make_test_instruction(inst, machine, labels, ops, flag, pc):
-    condition_proc = make_operation_exp(inst, machine, labels, ops)
+def make_test_instruction(inst, machine, labels, ops, regs, flag, pc):
+    condition_proc = make_operation_exp(inst, machine, labels, ops, regs)
     def execution():
-        af = condition_proc()
-        flag.set_contents(condition_proc())
-        advance_pc(pc)
+        regs[flag] = condition_proc()
+        regs[pc] += 1
     return execution
 
-def make_branch_instruction(inst, machine, labels, flag, pc):
-    branch_dest = inst.label
-    insts = labels[branch_dest]
+def make_branch_instruction(inst, machine, labels, regs, flag, pc):
+    offset = lookup_label(labels, inst.label)
     def execution():
-        f = flag.get_contents()
+        if regs[flag]:
+            regs[pc] = offset
+        else:
+            regs[pc] += 1
+    return execution
+
+def make_test_branch_instruction(inst, machine, labels, ops, regs, flag, pc):
+    condition_proc = make_operation_exp(inst, machine, labels, ops, regs)
+    offset = lookup_label(labels, inst.label)
+    def execution():
+        f = regs[flag] = condition_proc()
         if f:
-            pc.set_contents(insts)
-            advance_pc(pc)
+            regs[pc] = offset
         else:
-            advance_pc(pc)
+            regs[pc] += 1
     return execution
 
-def make_goto_label_instruction(inst, machine, labels, pc):
-    label = inst.label
+def make_goto_label_instruction(inst, machine, labels, regs, pc):
+    offset = lookup_label(labels, inst.label)
     def execution():
-        pc.set_contents(labels[label])
+        regs[pc] = offset
     return execution
     
-def make_goto_register_instruction(inst, machine, labels, pc):
-     register_name = inst.register
-     register = machine.lookup_register(register_name)
+def make_goto_register_instruction(inst, machine, labels, regs, pc):
+     register = machine.register_slot(inst.register)
      def execution():
-         pc.set_contents(register.get_contents())
+         regs[pc] = regs[register]
      return execution
     
-def make_save_instruction(inst, machine, stack, pc):
-    register = inst.register
+def make_save_instruction(inst, machine, stack, regs, pc):
+    register = machine.register_slot(inst.register)
+    push = machine.stack_for(inst.register).push
     def execution():
-        stack.Push(register.get_contents())
-        advance_pc(pc)
+        push(regs[register])
+        regs[pc] += 1
     return execution
 
-def make_restore_instruction(inst, machine, stack, pc):
-    register = inst.register
+def make_restore_instruction(inst, machine, stack, regs, pc):
+    register = machine.register_slot(inst.register)
+    pop = machine.stack_for(inst.register).pop
     def execution():
-        register.set_contents(stack.Pop())
-        advance_pc(pc)
+        regs[register] = pop()
+        regs[pc] += 1
     return execution
         
-def make_operation_exp(inst, machine, labels, ops):
-    op = ops[inst.op]
-    aprocs = []
-    for arg in inst.args:
-        aprocs.append(make_primitive_exp(arg, machine, labels))
+def make_operation_exp(inst, machine, labels, ops, regs):
+    """ A procedure of no arguments calling the op of `inst` on its
+        operands. Calls on one or two operands are specialised on
+        whether each is a register or a value known at assembly time,
+        which is baked into the procedure, so no argument list is built;
+        a pure op on values only is called once, here.
+    """
+    try:
+        op = ops[inst.op]
+    except KeyError:
+        raise ExecutionError("unknown operation {}".format(inst.op))
+    operands = [make_operand(arg, machine, labels) for arg in inst.args]
+    if all(is_reg is False for is_reg, _ in operands) and inst.op in machine.pure_ops:
+        try:
+            value = op(*[v for _, v in operands])
+        except Exception:
+            # leave the error to happen when the instruction runs
+            pass
+        else:
+            return lambda: value
+    if len(operands) == 0:
+        return op
+    if len(operands) == 1:
+        (a_reg, a), = operands
+        if a_reg:
+            return lambda: op(regs[a])
+        return lambda: op(a)
+    if len(operands) == 2:
+        (a_reg, a), (b_reg, b) = operands
+        if a_reg and b_reg:
+            return lambda: op(regs[a], regs[b])
+        elif a_reg:
+            return lambda: op(regs[a], b)
+        elif b_reg:
+            return lambda: op(a, regs[b])
+        return lambda: op(a, b)
+    aprocs = tuple(make_primitive_exp(arg, machine, labels, regs) for arg in inst.args)
     def execution():
-        op_args = []
-        for a in aprocs:
-            op_args.append(a())
-        return op(*op_args)
+        return op(*[a() for a in aprocs])
     return execution
+
+def make_operand(exp, machine, labels):
+    """ (True, slot) for a register operand, (False, value) for a
+        constant or label.
+    """
+    t = exp.type
+    if t == "reg":
+        return True, machine.register_slot(exp.value)
+    elif t == "const":
+        return False, exp.value
+    elif t == "label":
+        return False, lookup_label(labels, exp.value)
+    raise ExecutionError("unknown type {}".format(t))
     
 
-def make_primitive_exp(exp, machine, labels):
+def make_primitive_exp(exp, machine, labels, regs):
     t = exp.type
     if t == "const":
         return lambda: exp.value
-    elif t == "LABEL":
-        return lambda: labels[exp.value]
+    elif t == "label":
+        offset = lookup_label(labels, exp.value)
+        return lambda: offset
     elif t == "reg":
-        register = machine.lookup_register(exp.value)
-        return lambda: register.get_contents()
+        slot = machine.register_slot(exp.value)
+        return lambda: regs[slot]
     raise ExecutionError("unknown type {}".format(t))
 
-def advance_pc(pc):
-    pc.set_contents(pc.get_contents()[1:])
-    
\ No newline at end of file
+def lookup_label(labels, label):
+    try:
+        return labels[label]
+    except KeyError:
+        raise ExecutionError("unknown label {}".format(label))
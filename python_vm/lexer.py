@@ -7,6 +7,7 @@
 # Last modified: March 2009
 #-----------------------------------------------
 #
+import codecs
 import re
 import sys
 
@@ -15,6 +16,8 @@ class Token(object):
     """ A simple Token structure.
         Contains the token type, value and position.
     """
+    __slots__ = ('type', 'val', 'pos')
+
     def __init__(self, type, val, pos):
         self.type = type
         self.val = val
@@ -66,15 +69,100 @@ class Lexer(object):
             self.group_type[groupname] = type
             idx += 1
 
-        self.regex = re.compile('|'.join(regex_parts))
+        self.regex_source = '|'.join(regex_parts)
+        self.regex = re.compile(self.regex_source)
         self.skip_whitespace = skip_whitespace
-        self.re_ws_skip = re.compile('\S')
+        self.re_ws_skip = re.compile(r'\S')
+
+        # bytes flavours of the regexes, compiled on first use
+        # for bytes-like input
+        self.bytes_regex = None
+        self.bytes_re_ws_skip = None
 
-    def input(self, buf):
+    def input(self, buf, encoding='utf-8'):
         """ Initialize the lexer with a buffer as input.
+            buf:
+                A str, or any bytes-like object supported by
+                the re module (bytes, bytearray, memoryview,
+                mmap). The buffer is scanned in place and never
+                copied; for bytes-like input the token values
+                are decoded with `encoding` and the token
+                positions are byte offsets.
         """
+        if isinstance(buf, str):
+            self.cur_regex = self.regex
+            self.cur_ws_skip = self.re_ws_skip
+            self.encoding = None
+        else:
+            if isinstance(buf, memoryview):
+                buf = buf.cast('B')
+            if self.bytes_regex is None:
+                self.bytes_regex = re.compile(self.regex_source.encode('ascii'))
+                self.bytes_re_ws_skip = re.compile(rb'\S')
+            self.cur_regex = self.bytes_regex
+            self.cur_ws_skip = self.bytes_re_ws_skip
+            self.encoding = encoding
         self.buf = buf
+        self.buflen = len(buf)
         self.pos = 0
+        self.base = 0
+        self.chunks = None
+
+    def input_stream(self, source, encoding='utf-8', chunk_size=65536):
+        """ Initialize the lexer with a stream as input.
+            source:
+                A file object (read in pieces of `chunk_size`)
+                or an iterable of str or bytes chunks; bytes are
+                decoded incrementally with `encoding`.
+            Only the unconsumed tail of the input is kept in
+            memory, plus whatever follows the position in
+            `hold`, if it is set. Token positions are offsets
+            from the start of the stream.
+        """
+        self.chunks = self._decoded_chunks(source, encoding, chunk_size)
+        self.exhausted = False
+        self.hold = None
+        self.cur_regex = self.regex
+        self.cur_ws_skip = self.re_ws_skip
+        self.encoding = None
+        self.buf = ''
+        self.pos = 0
+        self.base = 0
+
+    def _decoded_chunks(self, source, encoding, chunk_size):
+        if hasattr(source, 'read'):
+            f = source
+            source = iter(lambda: f.read(chunk_size), f.read(0))
+        decoder = None
+        for chunk in source:
+            if not isinstance(chunk, str):
+                if decoder is None:
+                    decoder = codecs.getincrementaldecoder(encoding)()
+                chunk = decoder.decode(bytes(chunk))
+            yield chunk
+        if decoder is not None:
+            yield decoder.decode(b'', final=True)
+
+    def _read_chunk(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            return
+        # drop the consumed part of the buffer
+        keep = self.pos
+        if self.hold is not None:
+            keep = min(keep, self.hold - self.base)
+        self.buf = self.buf[keep:] + chunk
+        self.base += keep
+        self.pos -= keep
+
+    def source(self, start, end):
+        """ The input text between two token positions.
+        """
+        text = self.buf[start - self.base:end - self.base]
+        if self.encoding is not None:
+            text = bytes(text).decode(self.encoding)
+        return text
 
     def token(self):
         """ Return the next token (a Token object) found in the
@@ -84,28 +172,55 @@ class Lexer(object):
             buffer matches no rule), a LexerError is raised with
             the position of the error.
         """
-        if self.pos >= len(self.buf):
+        if self.chunks is not None:
+            return self._stream_token()
+        if self.pos >= self.buflen:
             return None
         else:
             if self.skip_whitespace:
-                m = self.re_ws_skip.search(self.buf[self.pos:])
+                m = self.cur_ws_skip.search(self.buf, self.pos)
 
                 if m:
-                    self.pos += m.start()
+                    self.pos = m.start()
                 else:
                     return None
 
-            m = self.regex.match(self.buf[self.pos:])
+            m = self.cur_regex.match(self.buf, self.pos)
             if m:
                 groupname = m.lastgroup
                 tok_type = self.group_type[groupname]
-                tok = Token(tok_type, m.group(groupname), self.pos)
-                self.pos += m.end()
+                val = m.group(groupname)
+                if self.encoding is not None:
+                    val = val.decode(self.encoding)
+                tok = Token(tok_type, val, self.pos)
+                self.pos = m.end()
                 return tok
 
             # if we're here, no rule matched
             raise LexerError(self.pos)
 
+    def _stream_token(self):
+        while True:
+            buf = self.buf
+            if self.skip_whitespace:
+                m = self.cur_ws_skip.search(buf, self.pos)
+                self.pos = m.start() if m else len(buf)
+
+            if self.pos < len(buf):
+                m = self.cur_regex.match(buf, self.pos)
+                # a match reaching the end of the buffer might
+                # continue in the next chunk
+                if m and (m.end() < len(buf) or self.exhausted):
+                    groupname = m.lastgroup
+                    tok = Token(self.group_type[groupname], m.group(groupname), self.base + self.pos)
+                    self.pos = m.end()
+                    return tok
+                if not m and self.exhausted:
+                    raise LexerError(self.base + self.pos)
+            elif self.exhausted:
+                return None
+            self._read_chunk()
+
     def tokens(self):
         """ Returns an iterator to the tokens found in the buffer.
         """
@@ -1,9 +1,22 @@
 
+import re
+import sys
+
 import lexer
+import sexp_lexer
+
+# Integer codes of the instruction token types. Each token class
+# carries its type name and code as class attributes, and __slots__,
+# so a parsed instruction costs only its operand fields.
+(ASSIGN_REGISTER, ASSIGN_CONSTANT, ASSIGN_OP, ASSIGN_LABEL, PERFORM, TEST,
+ BRANCH, GOTO_LABEL, GOTO_REGISTER, SAVE, RESTORE, LABEL, TEST_BRANCH) = range(13)
 
 class AssignRegisterToken:
+    __slots__ = ("target_register", "source_register", "text")
+    type = "ASSIGN_REGISTER"
+    code = ASSIGN_REGISTER
+
     def __init__(self, target_register, source_register, text=None):
-        self.type = "ASSIGN_REGISTER"
         self.target_register = target_register
         self.source_register = source_register
         self.text = text
@@ -15,8 +28,11 @@ class AssignRegisterToken:
         return self.__str__()
 
 class AssignConstToken:
+    __slots__ = ("target_register", "constant", "text")
+    type = "ASSIGN_CONSTANT"
+    code = ASSIGN_CONSTANT
+
     def __init__(self, target_register, constant, text=None):
-        self.type = "ASSIGN_CONSTANT"
         self.target_register = target_register
         self.constant = constant
         self.text = text
@@ -28,8 +44,11 @@ class AssignConstToken:
         return self.__str__()
         
 class AssignOpToken:
+    __slots__ = ("target_register", "op", "args", "text")
+    type = "ASSIGN_OP"
+    code = ASSIGN_OP
+
     def __init__(self, target_register, op, args, text=None):
-        self.type = "ASSIGN_OP"
         self.target_register = target_register
         self.op = op
         self.args = args
@@ -43,8 +62,11 @@ class AssignOpToken:
 
         
 class AssignLabelToken:
+    __slots__ = ("target_register", "label", "text")
+    type = "ASSIGN_LABEL"
+    code = ASSIGN_LABEL
+
     def __init__(self, target_register, label, text=None):
-        self.type = "ASSIGN_LABEL"
         self.target_register = target_register
         self.label = label
         self.text = text
@@ -56,8 +78,11 @@ class AssignLabelToken:
         return self.__str__()
 
 class PerformToken:
+    __slots__ = ("op", "args", "text")
+    type = "PERFORM"
+    code = PERFORM
+
     def __init__(self, op, args, text=None):
-        self.type = "PERFORM"
         self.op = op
         self.args = args
         self.text = text
@@ -69,8 +94,11 @@ class PerformToken:
         return self.__str__()
     
 class TestToken:
+    __slots__ = ("op", "args", "text")
+    type = "TEST"
+    code = TEST
+
     def __init__(self, op, args, text=None):
-        self.type = "TEST"
         self.op = op
         self.args = args
         self.text = text
@@ -81,9 +109,31 @@ class TestToken:
     def __repr__(self):
         return self.__str__()
 
+class TestBranchToken:
+    """ A test immediately followed by a branch, fused by the optimizer.
+    """
+    __slots__ = ("op", "args", "label", "text")
+    type = "TEST_BRANCH"
+    code = TEST_BRANCH
+
+    def __init__(self, op, args, label, text=None):
+        self.op = op
+        self.args = args
+        self.label = label
+        self.text = text
+
+    def __str__(self):
+        return "type={}: op={} args={} label={}".format(self.type, self.op, self.args, self.label)
+    
+    def __repr__(self):
+        return self.__str__()
+
 class BranchToken:
+    __slots__ = ("label", "text")
+    type = "BRANCH"
+    code = BRANCH
+
     def __init__(self, label, text=None):
-        self.type = "BRANCH"
         self.label = label
         self.text = text
     
@@ -98,8 +148,11 @@ class BranchToken:
         
         
 class GoToLabelToken:
+    __slots__ = ("label", "text")
+    type = "GOTO_LABEL"
+    code = GOTO_LABEL
+
     def __init__(self, label, text=None):
-        self.type = "GOTO_LABEL"
         self.label = label
         self.text = text
         
@@ -110,14 +163,19 @@ class GoToLabelToken:
         return self.__str__()
 
 class GoToRegisterToken:
+    __slots__ = ("register", "text")
+    type = "GOTO_REGISTER"
+    code = GOTO_REGISTER
+
     def __init__(self, register, text=None):
-        self.type = "GOTO_REGISTER"
         self.register = register
         self.text = text
 
 class PrimitiveExpToken:
+    __slots__ = ("type", "value", "text")
+
     def __init__(self, type, value, text=None):
-        self.type = type
+        self.type = sys.intern(type)
         self.value = value
         self.text = text
 
@@ -128,14 +186,20 @@ class PrimitiveExpToken:
         return self.__str__()
     
 class SaveToken:
+    __slots__ = ("register", "text")
+    type = "SAVE"
+    code = SAVE
+
     def __init__(self, register, text=None):
-        self.type = "SAVE"
         self.register = register
         self.text = text
 
 class LabelToken:
+    __slots__ = ("label", "text")
+    type = "LABEL"
+    code = LABEL
+
     def __init__(self, label, text=None):
-        self.type = "LABEL"
         self.label = label
         self.text = text
         
@@ -149,60 +213,89 @@ class LabelToken:
         return all([self.type == other.type, self.label == other.label])
 
 class RestoreToken:
+    __slots__ = ("register", "text")
+    type = "RESTORE"
+    code = RESTORE
+
     def __init__(self, register, text=None):
-        self.type = "RESTORE"
         self.register = register
         self.text = text
 
 class ParseError(Exception): pass
 
 class Parser:    
-    def __init__(self):
-        lex_rules = [
-            ('assign',             'ASSIGN'),
-            ('const',              'CONST'),
-            ('test',              'TEST'),
-            ('goto',            'GOTO'),
-            ('op',             'OP'),
-            ('perform',          'PERFORM'),
-            ('branch',           'BRANCH'),
-            ('save',             'SAVE'),
-            ('restore',          'RESTORE'),
-            ('reg',          'REGISTER'),
-            ('label',            'LABEL'),
-            ('\d+',             'NUMBER'),
-            ('[a-zA-Z_](\w|-|_)*',    'IDENTIFIER'),
-            ('\*\*',            '**'),
-            ('!=',              '!='),
-            ('==',              '=='),
-            ('>=',              '>='),
-            ('<=',              '<='),
-            ('>>',              '>>'),
-            ('<<',              '<<'),
-            ('&',               '&'),
-            ('\^',              '^'),
-            ('\|',              '|'),
-            ('<',               '<'),
-            ('>',               '>'),
-            ('\+',              '+'),
-            ('\-',              '-'),
-            ('\*',              '*'),
-            ('\/',              '/'),
-            ('\(',              '('),
-            ('\)',              ')'),
-            ('=',               '='),
-        ]
-
-        self.lexer = lexer.Lexer(lex_rules, skip_whitespace=True)
+    keywords = {
+        'assign':   'ASSIGN',
+        'const':    'CONST',
+        'test':     'TEST',
+        'goto':     'GOTO',
+        'op':       'OP',
+        'perform':  'PERFORM',
+        'branch':   'BRANCH',
+        'save':     'SAVE',
+        'restore':  'RESTORE',
+        'reg':      'REGISTER',
+        'label':    'LABEL',
+    }
+
+    # longest first, as the regex lexer tries them in order
+    operators = ["**", "!=", "==", ">=", "<=", ">>", "<<",
+                 "&", "^", "|", "<", ">", "+", "-", "*", "/", "="]
+
+    # token types that can name an operation in (op ...)
+    operation_names = ["IDENTIFIER"] + operators
+
+    def __init__(self, keep_text=True, regex_lexer=False):
+        """ keep_text:
+                Whether instruction tokens keep their source text,
+                which profiling reports use. Dropping it saves a
+                string per instruction.
+            regex_lexer:
+                Use the generic rule-based lexer.Lexer instead of
+                the s-expression tokenizer. It splits identifiers
+                that start with a keyword, such as `operand`.
+        """
+        if regex_lexer:
+            lex_rules = list(self.keywords.items())
+            lex_rules += [
+                (r'\d+',             'NUMBER'),
+                (r'[a-zA-Z_][\w\-?!<>=*/+]*', 'IDENTIFIER'),
+            ]
+            lex_rules += [(re.escape(op), op) for op in self.operators]
+            lex_rules += [
+                (r'\(',              '('),
+                (r'\)',              ')'),
+            ]
+            self.lexer = lexer.Lexer(lex_rules, skip_whitespace=True)
+        else:
+            self.lexer = sexp_lexer.SexpLexer(self.keywords, dict((op, op) for op in self.operators))
         self.cur_token = None
         self.var_table = {}
         self.instructions = []
         self.label_pointers = {}
+        self.keep_text = keep_text
         
     def parse(self, text=None):
         self.lexer.input(text)
         self._get_next_token()
         self._top_level_controller()
+
+    def parse_stream(self, source, encoding='utf-8', chunk_size=65536):
+        """ Parse a controller from a file object or an iterable of
+            text chunks, yielding each label and instruction token as
+            soon as it is complete. Nothing is accumulated in
+            self.instructions.
+        """
+        self.lexer.input_stream(source, encoding, chunk_size)
+        self._get_next_token()
+        self._match("(")
+        while self.cur_token.type != ")":
+            if self.cur_token.type == "IDENTIFIER":
+                label = self._match("IDENTIFIER")
+                yield LabelToken(label, label if self.keep_text else None)
+            else:
+                yield self._bracketed_instruction()
+        self._match(")")
         
     def _error(self, msg):
         raise ParseError(msg)
@@ -215,7 +308,7 @@ class Parser:
         """
 
         if self.cur_token.type in type_list:
-            val = self.cur_token.val
+            val = sys.intern(self.cur_token.val)
             self._get_next_token()
             return val
         else:
@@ -232,6 +325,9 @@ class Parser:
         
         if self.cur_token.type == type:
             val = self.cur_token.val
+            if type == "IDENTIFIER":
+                # register, label and op names repeat throughout a controller
+                val = sys.intern(val)
             self._get_next_token()
             return val
         else:
@@ -259,22 +355,29 @@ class Parser:
                 
     def _controller(self):
         label = self._match("IDENTIFIER")
-        self.instructions.append(LabelToken(label))
+        self.instructions.append(LabelToken(label, label if self.keep_text else None))
         if self.cur_token.type == ")":
             l = len(self.instructions)
             self.label_pointers[label] = [self.instructions[l:], l]
             return
-        self._match("(")
         l = len(self.instructions)
-        instr = self._instruction()
-        self.instructions.append(instr)
-        self._match(")")
+        self.instructions.append(self._bracketed_instruction())
         while self.cur_token.type != "IDENTIFIER" and self.cur_token.type != ")":
-            self._match("(")
-            instr = self._instruction()
-            self.instructions.append(instr)
-            self._match(")")
+            self.instructions.append(self._bracketed_instruction())
         self.label_pointers[label] = [self.instructions[l:], l]
+
+    def _bracketed_instruction(self):
+        start = self.cur_token.pos
+        # keep the instruction's text in the lexer buffer when streaming
+        self.lexer.hold = start
+        self._match("(")
+        instr = self._instruction()
+        end = self.cur_token.pos
+        self._match(")")
+        if self.keep_text:
+            instr.text = self.lexer.source(start, end + 1)
+        self.lexer.hold = None
+        return instr
         
     def _instruction(self):
         t = self.cur_token.type
@@ -330,7 +433,7 @@ class Parser:
     
     def _assign_op(self):
         self._match("OP")
-        op = self._match("IDENTIFIER")
+        op = self._match_from_list(self.operation_names)
         self._match(")")
         args = []
         while self.cur_token.val != ")":
@@ -351,12 +454,13 @@ class Parser:
         self._match("PERFORM")
         self._match("(")
         self._match("OP")
-        op = self._match("IDENTIFIER")
+        op = self._match_from_list(self.operation_names)
         self._match(")")
         args = []
         while self.cur_token.val != ")":
-            arg = self._match("IDENTIFIER")
-            args.append(arg)
+            self._match("(")
+            type, val = self._primitive_exp()
+            args.append(PrimitiveExpToken(type, val))
         return PerformToken(op, args)
         
     # (test (op ⟨operation-name⟩) ⟨input1⟩ . . . ⟨inputn⟩)
@@ -364,7 +468,7 @@ class Parser:
         self._match("TEST")
         self._match("(")
         self._match("OP")
-        op = self._match_from_list(["IDENTIFIER", "="])
+        op = self._match_from_list(self.operation_names)
         self._match(")")
         args = []
         while self.cur_token.val != ")":
@@ -403,7 +507,7 @@ class Parser:
     def _goto_register(self):
         self._match("REGISTER")
         register = self._match("IDENTIFIER")
-        self.match(")")
+        self._match(")")
         return register
     
     def _primitive_exp(self):
@@ -422,6 +526,11 @@ class Parser:
         return type, val
         
     def _const(self):
+        if self.cur_token.type == "(":
+            # the empty list
+            self._match("(")
+            self._match(")")
+            return None
         if self.cur_token.type == "NUMBER":
             val = self._match("NUMBER")
             return int(val)
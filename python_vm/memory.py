@@ -0,0 +1,250 @@
+""" List-structure memory for the register machine, after section 5.3
+    of SICP: pairs live in two preallocated vectors, the-cars and the
+    -cdrs, of tagged 64-bit words, and a stop-and-copy collector frees
+    the pairs that can no longer be reached from the machine's
+    registers and stacks when the vectors fill up.
+"""
+from array import array
+
+import primitives
+
+# the low TAG_BITS of a word are its type tag
+TAG_BITS = 3
+TAG_MASK = (1 << TAG_BITS) - 1
+NUMBER = 0
+PAIR = 1
+EMPTY = 2
+OBJECT = 3
+BROKEN_HEART = 4
+TRUE = 5
+FALSE = 6
+
+# numbers that fit in a word with their tag; larger ones are objects
+MIN_NUMBER = -(1 << (63 - TAG_BITS))
+MAX_NUMBER = (1 << (63 - TAG_BITS)) - 1
+
+
+class HeapError(Exception): pass
+
+
+class Pointer(int):
+    """ A register value pointing to a pair: its index into the-cars
+        and the-cdrs. Pointers are only valid until the next garbage
+        collection, which rewrites the ones held by the machine's
+        registers and stacks.
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return "p%d" % self
+
+
+class ListMemory:
+    """ Pairs stored as words in two typed vectors of `size` entries.
+
+        Register values are Python values: numbers, None for the empty
+        list, Pointer for pairs, and any other object, such as a symbol,
+        which the vectors refer to through an object table.
+
+        roots:
+            A function returning the lists that hold the machine's
+            values, each with the number of leading entries that are
+            live, such as the register file and the stack slots.
+    """
+    def __init__(self, size, roots=None):
+        self.size = size
+        self.the_cars = array('q', bytes(8 * size))
+        self.the_cdrs = array('q', bytes(8 * size))
+        self.free = 0
+        self.objects = []
+        self.object_index = {}
+        self.roots = roots
+        self.collections = 0
+
+    def encode(self, value):
+        t = type(value)
+        if t is int and MIN_NUMBER <= value <= MAX_NUMBER:
+            return value << TAG_BITS
+        elif t is Pointer:
+            return (value << TAG_BITS) | PAIR
+        elif value is None:
+            return EMPTY
+        elif value is True:
+            return TRUE
+        elif value is False:
+            return FALSE
+        return (self.intern(value) << TAG_BITS) | OBJECT
+
+    def decode(self, word):
+        tag = word & TAG_MASK
+        if tag == NUMBER:
+            return word >> TAG_BITS
+        elif tag == PAIR:
+            return Pointer(word >> TAG_BITS)
+        elif tag == EMPTY:
+            return None
+        elif tag == OBJECT:
+            return self.objects[word >> TAG_BITS]
+        elif tag == TRUE:
+            return True
+        elif tag == FALSE:
+            return False
+        raise HeapError("Invalid word {:#x}".format(word))
+
+    def intern(self, value):
+        try:
+            return self.object_index[value]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable objects are not shared
+            self.objects.append(value)
+            return len(self.objects) - 1
+        index = self.object_index[value] = len(self.objects)
+        self.objects.append(value)
+        return index
+
+    def cons(self, x, y):
+        if self.free == self.size:
+            x, y = self.collect((x, y))
+            if self.free == self.size:
+                raise HeapError("List memory exhausted: {} pairs in use".format(self.size))
+        index = self.free
+        self.the_cars[index] = self.encode(x)
+        self.the_cdrs[index] = self.encode(y)
+        self.free = index + 1
+        return Pointer(index)
+
+    def car(self, pair):
+        if type(pair) is not Pointer:
+            raise HeapError("car of a non-pair {!r}".format(pair))
+        return self.decode(self.the_cars[pair])
+
+    def cdr(self, pair):
+        if type(pair) is not Pointer:
+            raise HeapError("cdr of a non-pair {!r}".format(pair))
+        return self.decode(self.the_cdrs[pair])
+
+    def set_car(self, pair, value):
+        if type(pair) is not Pointer:
+            raise HeapError("set-car! of a non-pair {!r}".format(pair))
+        self.the_cars[pair] = self.encode(value)
+
+    def set_cdr(self, pair, value):
+        if type(pair) is not Pointer:
+            raise HeapError("set-cdr! of a non-pair {!r}".format(pair))
+        self.the_cdrs[pair] = self.encode(value)
+
+    def is_pair(self, x):
+        return type(x) is Pointer
+
+    def eq(self, x, y):
+        if type(x) is Pointer:
+            return type(y) is Pointer and x == y
+        return primitives.eq(x, y)
+
+    def equal(self, x, y):
+        return self.to_python(x) == self.to_python(y)
+
+    def make_list(self, *xs):
+        if self.size - self.free < len(xs):
+            # the elements not yet consed must be relocated as well
+            xs = self.collect(xs)
+        result = None
+        for x in reversed(xs):
+            result = self.cons(x, result)
+        return result
+
+    def to_python(self, value):
+        """ The Python list of the elements of a proper list, converted
+            recursively; other values are returned as they are.
+        """
+        if type(value) is not Pointer and value is not None:
+            return value
+        result = []
+        while type(value) is Pointer:
+            result.append(self.to_python(self.car(value)))
+            value = self.cdr(value)
+        return result
+
+    def ops(self):
+        """ The op set replacing the built-in list ops. """
+        return {
+            "cons": self.cons,
+            "car": self.car,
+            "cdr": self.cdr,
+            "set-car!": self.set_car,
+            "set-cdr!": self.set_cdr,
+            "pair?": self.is_pair,
+            "eq?": self.eq,
+            "equal?": self.equal,
+            "list": self.make_list,
+        }
+
+    def collect(self, extra=()):
+        """ Stop-and-copy collection: copy the pairs reachable from the
+            roots and `extra` into fresh vectors, leaving a broken heart
+            and forwarding address in every old pair that was moved,
+            then scan the copies. Returns `extra` relocated.
+        """
+        cars, cdrs = self.the_cars, self.the_cdrs
+        new_cars = array('q', bytes(8 * self.size))
+        new_cdrs = array('q', bytes(8 * self.size))
+        objects = self.objects
+        new_objects = []
+        new_index = {}
+        moved_objects = {}
+        free = 0
+
+        def relocate(word):
+            nonlocal free
+            tag = word & TAG_MASK
+            if tag == PAIR:
+                old = word >> TAG_BITS
+                if cars[old] == BROKEN_HEART:
+                    return cdrs[old]
+                new_cars[free] = cars[old]
+                new_cdrs[free] = cdrs[old]
+                new = (free << TAG_BITS) | PAIR
+                free += 1
+                cars[old] = BROKEN_HEART
+                cdrs[old] = new
+                return new
+            elif tag == OBJECT:
+                old = word >> TAG_BITS
+                index = moved_objects.get(old)
+                if index is None:
+                    value = objects[old]
+                    index = moved_objects[old] = len(new_objects)
+                    new_objects.append(value)
+                    try:
+                        new_index[value] = index
+                    except TypeError:
+                        pass
+                return (index << TAG_BITS) | OBJECT
+            return word
+
+        def relocate_value(value):
+            if type(value) is Pointer:
+                return Pointer(relocate((value << TAG_BITS) | PAIR) >> TAG_BITS)
+            return value
+
+        if self.roots is not None:
+            for values, live in self.roots():
+                for i in range(live):
+                    if type(values[i]) is Pointer:
+                        values[i] = relocate_value(values[i])
+        extra = tuple(relocate_value(value) for value in extra)
+
+        scan = 0
+        while scan < free:
+            new_cars[scan] = relocate(new_cars[scan])
+            new_cdrs[scan] = relocate(new_cdrs[scan])
+            scan += 1
+
+        self.the_cars, self.the_cdrs = new_cars, new_cdrs
+        self.objects = new_objects
+        self.object_index = new_index
+        self.free = free
+        self.collections += 1
+        return extra
@@ -0,0 +1,140 @@
+import lisp_parser as lp
+
+
+class Optimizer:
+    """ Peephole and dataflow passes over a parsed controller, run
+        between the parser and instruction generation.
+
+        ops, pure_ops:
+            The machine's ops and the names of those that have no side
+            effects, whose calls on constant arguments are folded.
+    """
+    def __init__(self, ops=None, pure_ops=()):
+        self.ops = ops or {}
+        self.pure_ops = set(pure_ops)
+
+    def optimize(self, insts_tokens):
+        insts_tokens = list(insts_tokens)
+        insts_tokens = self.fold_constants(insts_tokens)
+        insts_tokens = self.remove_self_assignments(insts_tokens)
+        insts_tokens = self.fold_constant_branches(insts_tokens)
+        insts_tokens = self.thread_jumps(insts_tokens)
+        insts_tokens = self.remove_unreachable(insts_tokens)
+        insts_tokens = self.fuse_test_branches(insts_tokens)
+        return insts_tokens
+
+    def fold_constants(self, insts_tokens):
+        """ (assign x (op f) (const a) ...) becomes (assign x (const (f a ...)))
+            and a test of constants assigns the flag, when f is pure.
+        """
+        result = []
+        for token in insts_tokens:
+            if token.type in ("ASSIGN_OP", "TEST") and self.foldable(token):
+                try:
+                    value = self.ops[token.op](*[arg.value for arg in token.args])
+                except Exception:
+                    # leave the error to happen when the instruction runs
+                    result.append(token)
+                    continue
+                target = token.target_register if token.type == "ASSIGN_OP" else "flag"
+                token = lp.AssignConstToken(target, value, token.text)
+            result.append(token)
+        return result
+
+    def foldable(self, token):
+        return (token.op in self.pure_ops and token.op in self.ops
+                and all(arg.type == "const" for arg in token.args))
+
+    def remove_self_assignments(self, insts_tokens):
+        """ Drops (assign a (reg a)). """
+        return [token for token in insts_tokens
+                if not (token.type == "ASSIGN_REGISTER" and token.target_register == token.source_register)]
+
+    def fold_constant_branches(self, insts_tokens):
+        """ A branch right after a constant flag assignment, with no
+            label in between, becomes a goto or disappears.
+        """
+        result = []
+        for token in insts_tokens:
+            previous = result[-1] if result else None
+            if (token.type == "BRANCH" and previous is not None
+                    and previous.type == "ASSIGN_CONSTANT" and previous.target_register == "flag"):
+                if previous.constant:
+                    result.append(lp.GoToLabelToken(token.label, token.text))
+                continue
+            result.append(token)
+        return result
+
+    def thread_jumps(self, insts_tokens):
+        """ Retargets jumps to a label whose first instruction is a goto
+            to the final destination of the chain of gotos.
+        """
+        first = {}
+        pending = []
+        for token in insts_tokens:
+            if token.type == "LABEL":
+                pending.append(token.label)
+            else:
+                for label in pending:
+                    first[label] = token
+                pending = []
+
+        def destination(label):
+            seen = set()
+            while label not in seen:
+                seen.add(label)
+                token = first.get(label)
+                if token is None or token.type != "GOTO_LABEL":
+                    return label
+                label = token.label
+            # a cycle of gotos: leave the jump alone
+            return label
+
+        # tokens may be shared, with a controller cache for instance,
+        # so retargeted jumps are new tokens
+        result = []
+        for token in insts_tokens:
+            if token.type == "BRANCH":
+                token = lp.BranchToken(destination(token.label), token.text)
+            elif token.type == "GOTO_LABEL":
+                token = lp.GoToLabelToken(destination(token.label), token.text)
+            elif token.type == "TEST_BRANCH":
+                token = lp.TestBranchToken(token.op, token.args, destination(token.label), token.text)
+            result.append(token)
+        return result
+
+    def remove_unreachable(self, insts_tokens):
+        """ Drops the instructions between an unconditional goto and the
+            next label.
+        """
+        result = []
+        reachable = True
+        for token in insts_tokens:
+            if token.type == "LABEL":
+                reachable = True
+            elif not reachable:
+                continue
+            result.append(token)
+            if token.type in ("GOTO_LABEL", "GOTO_REGISTER"):
+                reachable = False
+        return result
+
+    def fuse_test_branches(self, insts_tokens):
+        """ A test immediately followed by a branch becomes one
+            TestBranchToken.
+        """
+        result = []
+        for token in insts_tokens:
+            previous = result[-1] if result else None
+            if token.type == "BRANCH" and previous is not None and previous.type == "TEST":
+                text = None
+                if previous.text is not None and token.text is not None:
+                    text = previous.text + " " + token.text
+                result[-1] = lp.TestBranchToken(previous.op, previous.args, token.label, text)
+            else:
+                result.append(token)
+        return result
+
+
+def optimize(insts_tokens, ops=None, pure_ops=()):
+    return Optimizer(ops, pure_ops).optimize(insts_tokens)
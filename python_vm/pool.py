@@ -0,0 +1,69 @@
+import multiprocessing
+
+import python_vm
+
+
+# the machine owned by a worker process, built once by _init_worker
+_worker_machine = None
+_worker_outputs = None
+# its register file as assembled, restored before every run
+_worker_slots = None
+
+
+def _init_worker(registers, ops, insts_tokens, backend, outputs):
+    global _worker_machine, _worker_outputs, _worker_slots
+    _worker_machine = python_vm.make_machine(registers, ops)
+    python_vm.install_controller(_worker_machine, insts_tokens, backend)
+    _worker_outputs = outputs
+    _worker_slots = list(_worker_machine.slots)
+
+
+def _run_input(inputs):
+    machine = _worker_machine
+    machine.slots[:] = _worker_slots
+    for name, value in inputs.items():
+        machine.set_register_value(name, value)
+    machine.initialise_stacks()
+    machine.start()
+    return dict((name, machine.get_register_value(name)) for name in _worker_outputs)
+
+
+class MachinePool:
+    """ Runs one controller over many independent inputs on a pool of
+        worker processes.
+
+        The controller is parsed once, here, and the token list is
+        shipped to the workers, each of which assembles its own machine
+        once. Ops are sent to the workers too, so they must be picklable
+        (module-level functions rather than lambdas) unless the pool
+        uses the fork start method.
+    """
+    def __init__(self, registers, ops, text, outputs, backend="closure", processes=None, context=None):
+        insts_tokens = python_vm.parse_controller(text)
+        if context is None:
+            context = multiprocessing.get_context()
+        self.processes = processes or context.cpu_count()
+        self.pool = context.Pool(self.processes, _init_worker,
+                                 (list(registers), ops, insts_tokens, backend, list(outputs)))
+
+    def map(self, inputs, chunksize=None):
+        """ Run the controller once per dict of register values in
+            `inputs` and return, in order, a dict of the output
+            registers for each run. Inputs are sent to the workers in
+            chunks of `chunksize`, by default enough for about four
+            chunks per worker.
+        """
+        inputs = list(inputs)
+        if chunksize is None:
+            chunksize = max(1, len(inputs) // (self.processes * 4))
+        return self.pool.map(_run_input, inputs, chunksize)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
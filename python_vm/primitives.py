@@ -0,0 +1,131 @@
+""" The built-in op library installed by python_vm.make_machine.
+
+    Numbers are Python ints, pairs are two-element lists [car, cdr] and
+    the empty list is None. The instruction generators recognise these
+    functions by identity, so an op the host replaces with its own
+    function is called like any other op.
+"""
+import operator
+
+
+def remainder(x, y):
+    """ Scheme's remainder, which takes the sign of the dividend. """
+    r = x % y
+    if r and (x < 0) != (y < 0):
+        r -= y
+    return r
+
+def quotient(x, y):
+    """ Scheme's quotient, which truncates towards zero. """
+    return (x - remainder(x, y)) // y
+
+def cons(x, y):
+    return [x, y]
+
+def car(pair):
+    return pair[0]
+
+def cdr(pair):
+    return pair[1]
+
+def set_car(pair, value):
+    pair[0] = value
+
+def set_cdr(pair, value):
+    pair[1] = value
+
+def is_null(x):
+    return x is None
+
+def is_pair(x):
+    return type(x) is list
+
+def is_number(x):
+    return type(x) is int
+
+def is_symbol(x):
+    return type(x) is str
+
+def make_list(*xs):
+    result = None
+    for x in reversed(xs):
+        result = [x, result]
+    return result
+
+def eq(x, y):
+    """ Identity, except that equal numbers are always eq?. """
+    return x is y or (type(x) is int and type(y) is int and x == y)
+
+def equal(x, y):
+    return x == y
+
+
+OPS = {
+    "=": operator.eq,
+    "<": operator.lt,
+    ">": operator.gt,
+    "<=": operator.le,
+    ">=": operator.ge,
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "rem": remainder,
+    "remainder": remainder,
+    "quotient": quotient,
+    "modulo": operator.mod,
+    "not": operator.not_,
+    "eq?": eq,
+    "equal?": equal,
+    "cons": cons,
+    "car": car,
+    "cdr": cdr,
+    "set-car!": set_car,
+    "set-cdr!": set_cdr,
+    "null?": is_null,
+    "pair?": is_pair,
+    "number?": is_number,
+    "symbol?": is_symbol,
+    "list": make_list,
+}
+
+# ops that neither have side effects nor allocate, so that a call on
+# constants can be evaluated once, when the controller is assembled
+PURE = frozenset(OPS) - {"cons", "set-car!", "set-cdr!", "list"}
+
+# Python expression templates that the code generators substitute for
+# a call, by number of arguments
+INLINE = {
+    2: {
+        "=": "(%s == %s)",
+        "<": "(%s < %s)",
+        ">": "(%s > %s)",
+        "<=": "(%s <= %s)",
+        ">=": "(%s >= %s)",
+        "+": "(%s + %s)",
+        "-": "(%s - %s)",
+        "*": "(%s * %s)",
+        "modulo": "(%s %% %s)",
+        "cons": "[%s, %s]",
+    },
+    1: {
+        "not": "(not %s)",
+        "car": "%s[0]",
+        "cdr": "%s[1]",
+        "null?": "(%s is None)",
+    },
+}
+
+
+def is_builtin(ops, name):
+    """ Whether `name` in the op table `ops` is the built-in op. """
+    return name in OPS and ops.get(name) is OPS[name]
+
+
+def inline_template(ops, name, arity):
+    """ The INLINE template of a call of op `name` on `arity` arguments,
+        or None if the op is not the built-in one or has no template.
+    """
+    template = INLINE.get(arity, {}).get(name)
+    if template is not None and is_builtin(ops, name):
+        return template
+    return None
@@ -0,0 +1,121 @@
+import time
+
+
+class ProfiledStack:
+    """ Wraps a machine stack, counting saves and restores and
+        tracking the maximum depth reached.
+    """
+    def __init__(self, profile, stack):
+        self.profile = profile
+        self.wrapped = stack
+
+    def push(self, value):
+        profile = self.profile
+        profile.saves += 1
+        self.wrapped.push(value)
+        depth = len(self.wrapped)
+        if depth > profile.max_stack_depth:
+            profile.max_stack_depth = depth
+
+    def pop(self):
+        self.profile.restores += 1
+        return self.wrapped.pop()
+
+    def initialise(self):
+        self.wrapped.initialise()
+
+    def __len__(self):
+        return len(self.wrapped)
+
+    @property
+    def stack(self):
+        return self.wrapped.stack
+
+
+class Profile:
+    """ Instruction-level profile of the runs of one machine.
+        Installing a profile replaces the machine's ops with timed
+        wrappers and its stack with a counting one, so it has to be
+        created before the controller is assembled. A machine without
+        a profile pays nothing for it.
+
+        instruction_counts:
+            Execution count per instruction offset.
+        op_calls, op_times:
+            Number of calls and seconds spent per op name.
+        saves, restores, max_stack_depth:
+            Stack operation counts and the deepest stack seen.
+    """
+    def __init__(self, machine):
+        self.machine = machine
+        self.tokens = []
+        self.labels = {}
+        self.instruction_counts = []
+        self.op_calls = {}
+        self.op_times = {}
+        self.saves = 0
+        self.restores = 0
+        self.max_stack_depth = 0
+        machine.ops = dict((name, self.timed_op(name, op)) for name, op in machine.ops.items())
+        machine.stack = ProfiledStack(self, machine.stack)
+        if machine.register_stacks is not None:
+            for name, stack in machine.register_stacks.items():
+                machine.register_stacks[name] = ProfiledStack(self, stack)
+
+    def timed_op(self, name, op):
+        # ops only appear in op_calls and op_times once called, so the
+        # unused part of the built-in op library stays out of reports
+        calls = self.op_calls
+        times = self.op_times
+        clock = time.perf_counter
+        def timed(*args):
+            start = clock()
+            try:
+                return op(*args)
+            finally:
+                times[name] = times.get(name, 0.0) + clock() - start
+                calls[name] = calls.get(name, 0) + 1
+        return timed
+
+    def install(self, insts_tokens, labels):
+        """ Record the assembled instructions so that counts can be
+            mapped back to their source text.
+        """
+        self.tokens = [token for token in insts_tokens if token.type != "LABEL"]
+        self.labels = dict(labels)
+        self.instruction_counts = [0] * len(self.tokens)
+
+    def label_counts(self):
+        """ For every label, the number of times control reached it and
+            the number of instructions executed in its block.
+        """
+        starts = sorted(self.labels.items(), key=lambda item: item[1])
+        counts = {}
+        for i, (label, offset) in enumerate(starts):
+            end = len(self.tokens)
+            for _, next_offset in starts[i + 1:]:
+                if next_offset > offset:
+                    end = next_offset
+                    break
+            entries = self.instruction_counts[offset] if offset < end else 0
+            counts[label] = (entries, sum(self.instruction_counts[offset:end]))
+        return counts
+
+    def report(self, limit=20):
+        lines = ["instructions executed: %d" % sum(self.instruction_counts)]
+        lines.append("")
+        lines.append("%10s  %6s  %s" % ("count", "offset", "instruction"))
+        hot = sorted(range(len(self.tokens)), key=lambda i: -self.instruction_counts[i])
+        for i in hot[:limit]:
+            lines.append("%10d  %6d  %s" % (self.instruction_counts[i], i, self.tokens[i].text))
+        lines.append("")
+        lines.append("%10s  %10s  %s" % ("entries", "executed", "label"))
+        for label, (entries, executed) in sorted(self.label_counts().items(), key=lambda item: -item[1][1]):
+            lines.append("%10d  %10d  %s" % (entries, executed, label))
+        lines.append("")
+        lines.append("%10s  %10s  %s" % ("calls", "seconds", "op"))
+        for name in sorted(self.op_times, key=lambda name: -self.op_times[name]):
+            lines.append("%10d  %10.6f  %s" % (self.op_calls[name], self.op_times[name], name))
+        lines.append("")
+        lines.append("saves: %d  restores: %d  max stack depth: %d" % (self.saves, self.restores, self.max_stack_depth))
+        return "\n".join(lines)
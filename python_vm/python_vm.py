@@ -1,34 +1,115 @@
 
+import asyncio
+import inspect
 import lisp_parser
 import instructions as inst
+import bytecode as bc
+import codegen
+import profiler
+import batch
+import optimizer
+import primitives
+import memory
+import superinstructions as si
+import tracing
+
+class MachineError(Exception): pass
+
+class StackError(MachineError): pass
+
+
+class Suspended(Exception):
+    """ Raised by an async op, in the middle of its instruction, with
+        the awaitable it returned. See MachineState.resume.
+    """
+    def __init__(self, awaitable):
+        Exception.__init__(self, awaitable)
+        self.awaitable = awaitable
+
+
+def suspending(op):
+    """ `op` wrapped to raise Suspended with any awaitable it returns. """
+    def call(*args):
+        result = op(*args)
+        if inspect.isawaitable(result):
+            raise Suspended(result)
+        return result
+    return call
+
 
 class Register:
-    def __init__(self, name):
+    """ A named view onto one slot of a machine's register file.
+    """
+    def __init__(self, name, slots, index):
         self.name = name
-        self.contents = None
+        self.slots = slots
+        self.index = index
         
     def get_contents(self):
-        return self.contents
+        return self.slots[self.index]
     
     def set_contents(self, value):
-        self.contents = value
+        self.slots[self.index] = value
         
         
 class Stack:
-    def __init__(self):
-        self.stack = []
-        
+    """ A machine stack: a preallocated list of slots and an explicit
+        stack pointer `sp`, the number of values on the stack.
+        The slots double when they run out, up to `max_depth` values
+        if given; pushing past it, or popping an empty stack, raises
+        StackError. The bounds are only checked when the slots run
+        out or the pointer reaches zero, so push and pop are a store
+        or a load and a pointer update.
+    """
+    def __init__(self, size=256, max_depth=None):
+        if max_depth is not None:
+            size = min(size, max_depth)
+        if max_depth != 0:
+            # grow doubles the slots, so there must be one to start with
+            size = max(size, 1)
+        self.slots = [None] * size
+        self.sp = 0
+        self.max_depth = max_depth
+
     def push(self, value):
-        self.stack.append(value)
-        
+        sp = self.sp
+        try:
+            self.slots[sp] = value
+        except IndexError:
+            self.grow()
+            self.slots[sp] = value
+        self.sp = sp + 1
+
     def pop(self):
-        if len(self.stack) == 0:
-            return None
-        return self.stack.pop()
-    
+        sp = self.sp - 1
+        if sp < 0:
+            raise StackError("Restore from an empty stack")
+        self.sp = sp
+        return self.slots[sp]
+
+    def grow(self):
+        size = len(self.slots)
+        if self.max_depth is not None:
+            if size >= self.max_depth:
+                raise StackError("Stack overflow: more than {} values".format(self.max_depth))
+            extra = min(size, self.max_depth - size)
+        else:
+            extra = size
+        self.slots.extend([None] * extra)
+
     def initialise(self):
-        self.stack = []
-        
+        # drop the references held by the slots, keeping their size
+        self.slots[:self.sp] = [None] * self.sp
+        self.sp = 0
+
+    @property
+    def stack(self):
+        """ The values on the stack, bottom first. """
+        return self.slots[:self.sp]
+
+    def __len__(self):
+        return self.sp
+
 
 class Instruction:
     def __init__(self, text, func):
@@ -36,53 +117,382 @@ class Instruction:
         self.func = func
 
 
-class Machine:
-    def __init__(self):
-        self.pc = Register("pc")
-        self.flag = Register("flag")
-        self.stack = Stack()
-        self.registers = [self.pc, self.flag]
+class MachineState:
+    """ The run time state of a machine: the register file, holding the
+        registers and, after them, the constant pool of the bytecode
+        backend, and the stacks.
+
+        A MachineState made for a Program is all that one run of the
+        program needs, so any number of them, in as many threads or
+        coroutines, can run the same program at once:
+
+            program = assemble_program(["a", "b", "t"], {}, GCD)
+            state = program.state({"a": 21, "b": 343})
+            state.start()
+            state.get_register_value("a")
+    """
+    def __init__(self, program):
+        self.program = program
+        self.register_index = program.register_index
+        self.slots = list(program.slots)
+        self.max_stack_depth = program.max_stack_depth
+        self.stack = Stack(max_depth=program.max_stack_depth)
+        self.register_stacks = None
+        if program.register_stacks:
+            self.register_stacks = dict((name, Stack(max_depth=program.max_stack_depth))
+                                        for name in program.register_index)
+        self.pc = Register("pc", self.slots, program.register_index["pc"])
+        self.flag = Register("flag", self.slots, program.register_index["flag"])
+        self.label_pointers = program.label_pointers
+        self.resume_points = program.resume_points
+        self.pushes, self.pops = self.stack_operations()
+
+    def stack_for(self, name):
+        """ The stack that save and restore of register `name` use. """
+        if self.register_stacks is None:
+            return self.stack
+        try:
+            return self.register_stacks[name]
+        except KeyError:
+            raise MachineError("Unknown register {}".format(name))
+
+    def stack_operations(self):
+        """ The push and pop method of the stack of every register,
+            indexed by register slot.
+        """
+        names = sorted(self.register_index, key=self.register_index.get)
+        stacks = [self.stack_for(name) for name in names]
+        return [stack.push for stack in stacks], [stack.pop for stack in stacks]
+
+    def initialise_stacks(self):
+        self.stack.initialise()
+        if self.register_stacks is not None:
+            for stack in self.register_stacks.values():
+                stack.initialise()
+
+    def register_slot(self, name):
+        try:
+            return self.register_index[name]
+        except KeyError:
+            raise MachineError("Unknown register {}".format(name))
+
+    def set_register_value(self, name, value):
+        self.slots[self.register_slot(name)] = value
+
+    def get_register_value(self, name):
+        return self.slots[self.register_slot(name)]
+
+    def start(self, budget=None):
+        self.pc.set_contents(0)
+        return self.execute(budget)
+
+    async def run(self, every=1000):
+        """ Start the controller as a coroutine that hands control back
+            to the event loop after every `every` dispatches, counted as
+            for execute, and while it waits for an async op.
+        """
+        self.pc.set_contents(0)
+        while True:
+            try:
+                if self.execute(every):
+                    return
+            except Suspended as suspended:
+                self.resume(await suspended.awaitable)
+            else:
+                await asyncio.sleep(0)
+
+    def resume(self, value):
+        """ Finish the instruction whose async op suspended the machine,
+            with `value` as the result of the op, and move pc past it,
+            so that execute carries on from there.
+        """
+        try:
+            token, following, branches = self.resume_points[self.pc.get_contents()]
+        except (TypeError, KeyError):
+            raise MachineError("The machine is not suspended in an async op")
+        t = token.type
+        if t == "ASSIGN_OP":
+            self.set_register_value(token.target_register, value)
+        elif t in ("TEST", "TEST_BRANCH"):
+            self.flag.set_contents(value)
+        if branches and value:
+            following = self.label_pointers[token.label]
+        self.pc.set_contents(following)
+
+    def execute(self, budget=None):
+        """ See Machine.execute. """
+        program = self.program
+        if program.bytecode is not None:
+            return run_bytecode(program.bytecode, self.slots, self.pushes, self.pops,
+                                self.pc.index, self.flag.index, budget)
+        return program.compiled.function(self.slots, self.pushes, self.pops, budget)
+
+
+class Program:
+    """ A controller assembled once, for the bytecode or python backend,
+        that never changes afterwards and holds no run time state, so
+        that it can be shared by any number of MachineStates.
+
+        Closure instructions are bound to the register file and stacks
+        of the machine they were assembled for, and list memory ops to
+        its list memory, so neither can be made into a program.
+    """
+    def __init__(self, machine):
+        """ The program of the controller assembled into `machine`. """
+        if machine.backend not in ("bytecode", "python"):
+            raise MachineError("Only bytecode and python controllers can be shared, not {}".format(machine.backend))
+        if machine.memory is not None:
+            raise MachineError("A machine with list memory cannot be shared")
+        self.backend = machine.backend
+        self.register_index = dict(machine.register_index)
+        self.label_pointers = dict(machine.label_pointers)
+        self.ops = dict(machine.ops)
+        self.bytecode = machine.bytecode
+        self.compiled = machine.compiled
+        self.insts_tokens = machine.insts_tokens
+        self.resume_points = machine.resume_points
+        self.max_stack_depth = machine.max_stack_depth
+        self.register_stacks = machine.register_stacks is not None
+        # the initial register file: empty registers, then the constants
+        self.slots = tuple([None] * len(self.register_index) + machine.slots[len(self.register_index):])
+
+    def state(self, values=None):
+        """ A new MachineState for the program, with the registers in
+            the dict `values` set.
+        """
+        state = MachineState(self)
+        if values is not None:
+            for name, value in values.items():
+                state.set_register_value(name, value)
+        return state
+
+
+class Machine(MachineState):
+    def __init__(self, max_stack_depth=None, register_stacks=False):
+        """ max_stack_depth:
+                Maximum number of values on a stack, None for no limit.
+            register_stacks:
+                Give every register a stack of its own, so that restore
+                always gets back a value saved from the same register.
+        """
+        self.max_stack_depth = max_stack_depth
+        self.stack = Stack(max_depth=max_stack_depth)
+        self.register_stacks = {} if register_stacks else None
+        # the register file: register contents live in the flat `slots`
+        # list and `register_index` maps each register name to its slot
+        self.slots = []
+        self.register_index = {}
+        self.registers = {}
+        self.pc = self.allocate_register("pc")
+        self.flag = self.allocate_register("flag")
         self.instruction_sequence = []
+        self.bytecode = None
+        self.compiled = None
+        self.profile = None
+        self.tracer = None
+        self.insts_tokens = []
+        self.backend = None
+        self.superinstructions = None
+        self.lazy_blocks = None
         self.ops = {}
+        self.pure_ops = set()
+        self.async_ops = set()
+        # see resume_points
+        self.resume_points = None
+        self.memory = None
         self.label_pointers = {}
         
     def install_instruction_sequence(self, seq):
         self.instruction_sequence = seq
+        self.bytecode = None
+        self.compiled = None
     
-    def allocate_register(self, name):
-        for r in self.registers:
-            if r.name == name:
-                raise "Multiply defined registers {}".format(name)
-        
-        self.registers.append(Register(name))
+    def install_bytecode(self, bytecode):
+        # load the constant pool into the register file after the registers
+        del self.slots[bytecode.const_base:]
+        self.slots.extend(bytecode.consts)
+        self.bytecode = bytecode
+        self.instruction_sequence = []
+        self.compiled = None
+    
+    def install_compiled(self, compiled):
+        self.compiled = compiled
+        self.instruction_sequence = []
+        self.bytecode = None
     
+    def allocate_register(self, name):
+        if name in self.register_index:
+            raise MachineError("Multiply defined registers {}".format(name))
+        index = len(self.slots)
+        self.slots.append(None)
+        self.register_index[name] = index
+        register = Register(name, self.slots, index)
+        self.registers[name] = register
+        if self.register_stacks is not None:
+            self.register_stacks[name] = Stack(max_depth=self.max_stack_depth)
+        return register
+
     def lookup_register(self, name):
-        for r in self.registers:
-            if r.name == name:
-                return r
-        raise "Unknown register {}".format(name)
-        
-    def set_register_value(self, name, value):
-        reg = self.lookup_register(name)
-        reg.set_contents(value)
+        try:
+            return self.registers[name]
+        except KeyError:
+            raise MachineError("Unknown register {}".format(name))
         
-    def get_register_value(self, name):
-        reg = self.lookup_register(name)
-        return reg.get_contents()
-
     def install_operations(self, ops):
         self.ops.update(ops)
+
+    def install_async_operations(self, ops):
+        """ Install ops that may return an awaitable, on which the
+            machine suspends, see MachineState.run. Must be called
+            before the controller is assembled.
+        """
+        if self.instruction_sequence or self.bytecode is not None or self.compiled is not None:
+            raise MachineError("Async ops must be installed before assembly")
+        self.ops.update((name, suspending(op)) for name, op in ops.items())
+        self.async_ops.update(ops)
+        self.pure_ops.difference_update(ops)
+
+    def install_list_memory(self, size):
+        """ Replace the built-in list ops with ones backed by a
+            memory.ListMemory of `size` pairs, whose collector takes
+            the registers and stacks as roots. Must be called before
+            the controller is assembled.
+        """
+        if self.instruction_sequence or self.bytecode is not None or self.compiled is not None:
+            raise MachineError("List memory must be installed before assembly")
+        self.memory = memory.ListMemory(size, self.memory_roots)
+        ops = self.memory.ops()
+        self.install_operations(ops)
+        self.pure_ops.difference_update(ops)
+        return self.memory
+
+    def memory_roots(self):
+        roots = [(self.slots, len(self.register_index))]
+        stacks = [self.stack]
+        if self.register_stacks is not None:
+            stacks.extend(self.register_stacks.values())
+        for stack in stacks:
+            # see through a profiler.ProfiledStack
+            stack = getattr(stack, "wrapped", stack)
+            roots.append((stack.slots, stack.sp))
+        return roots
+
+    def enable_profiling(self):
+        """ Profile every following run of the machine. Must be called
+            before the controller is assembled.
+        """
+        if self.instruction_sequence or self.bytecode is not None or self.compiled is not None:
+            raise MachineError("Profiling must be enabled before assembly")
+        self.profile = profiler.Profile(self)
+        return self.profile
+
+    def enable_tracing(self, threshold=50, max_length=1000):
+        """ Compile the hot loops of the controller as they run, see
+            tracing.Tracer. Must be called before the controller is
+            assembled, which has to be with the closure backend.
+        """
+        if self.instruction_sequence or self.bytecode is not None or self.compiled is not None:
+            raise MachineError("Tracing must be enabled before assembly")
+        self.tracer = tracing.Tracer(self, threshold, max_length)
+        return self.tracer
         
-    def execute(self):
-        instructions = self.pc.get_contents()
-        while len(instructions) != 0:
-            instructions[0]()
-            instructions = self.pc.get_contents()
-
-    def start(self):
-        self.pc.set_contents(self.instruction_sequence)
-        self.execute()
-        
+    def execute(self, budget=None):
+        """ Run from the current pc. Returns True once the controller
+            has run to its end, or False when `budget` ran out first,
+            in which case calling execute again carries on.
+            budget:
+                The number of dispatches to run for. With the closure
+                backend these are instructions, where a superinstruction
+                counts as one, as does a loop iteration that is traced
+                or being recorded. With the bytecode backend they are
+                jumps taken, and with the python backend entries into a
+                block of the controller. None runs to the end.
+        """
+        if self.bytecode is not None:
+            return self.execute_bytecode(budget)
+        if self.compiled is not None:
+            pushes, pops = self.stack_operations()
+            return self.compiled.function(self.slots, pushes, pops, budget)
+        if self.profile is not None:
+            return self.execute_profiled(budget)
+        if self.tracer is not None:
+            return self.execute_tracing(budget)
+        instructions = self.instruction_sequence
+        end = len(instructions)
+        regs = self.slots
+        pc = self.pc.index
+        if budget is None:
+            while regs[pc] < end:
+                instructions[regs[pc]]()
+            return True
+        while regs[pc] < end:
+            if budget <= 0:
+                return False
+            instructions[regs[pc]]()
+            budget -= 1
+        return True
+
+    def execute_profiled(self, budget=None):
+        instructions = self.instruction_sequence
+        counts = self.profile.instruction_counts
+        end = len(instructions)
+        regs = self.slots
+        pc = self.pc.index
+        if budget is None:
+            budget = -1
+        while regs[pc] < end:
+            if budget == 0:
+                return False
+            counts[regs[pc]] += 1
+            instructions[regs[pc]]()
+            budget -= 1
+        return True
+
+    def execute_tracing(self, budget=None):
+        instructions = self.instruction_sequence
+        tracer = self.tracer
+        backward_jumps = tracer.backward_jumps
+        threshold = tracer.threshold
+        end = len(instructions)
+        regs = self.slots
+        pc = self.pc.index
+        if budget is None:
+            budget = -1
+        while regs[pc] < end:
+            if budget == 0:
+                return False
+            offset = regs[pc]
+            instructions[offset]()
+            budget -= 1
+            after = regs[pc]
+            if after <= offset:
+                # the count passes the threshold only once, so a loop
+                # whose recording was given up is not recorded again
+                backward_jumps[after] += 1
+                if backward_jumps[after] == threshold and after not in tracer.traces:
+                    tracer.record(after)
+        return True
+
+    def execute_bytecode(self, budget=None):
+        pushes, pops = self.stack_operations()
+        return run_bytecode(self.bytecode, self.slots, pushes, pops, self.pc.index, self.flag.index, budget)
+
+    def run_batch(self, inputs, outputs, vector_ops=None):
+        """ Run the assembled controller once per lane and return the
+            final value of every register in `outputs` as a column.
+            inputs:
+                Dict of register name to a column (list or NumPy
+                array) of initial values, one entry per lane.
+            vector_ops:
+                Optional column-at-a-time versions of ops.
+            See batch.Batch.
+        """
+        if self.insts_tokens is None:
+            raise MachineError("Batch runs need the parsed controller, which streamed assembly does not keep")
+        run = batch.Batch(self, inputs, vector_ops)
+        run.run(self.insts_tokens)
+        return dict((name, run.output(name)) for name in outputs)
+
     def get_stack(self):
         return self.stack
     
@@ -90,15 +500,344 @@ class Machine:
         return self.ops
 
 
-def make_machine(registers, ops):
-    machine = Machine()
+def run_bytecode(bytecode, regs, pushes, pops, pc_slot, flag, budget=None):
+    """ The dispatch loop of the bytecode backend: run `bytecode` on the
+        register file `regs`, with the push and pop functions of the
+        stacks indexed by register slot, from the offset in the pc slot.
+        See Machine.execute for `budget` and the result.
+    """
+    code = bytecode.words
+    ops = bytecode.ops
+    end = len(code)
+    pc = regs[pc_slot]
+    # opcodes bound to locals for the comparisons below
+    ASSIGN, ASSIGN_OP1, ASSIGN_OP2, ASSIGN_OPN = bc.ASSIGN, bc.ASSIGN_OP1, bc.ASSIGN_OP2, bc.ASSIGN_OPN
+    TEST1, TEST2, TESTN, PERFORM = bc.TEST1, bc.TEST2, bc.TESTN, bc.PERFORM
+    BRANCH, GOTO, GOTO_REG, SAVE, RESTORE = bc.BRANCH, bc.GOTO, bc.GOTO_REG, bc.SAVE, bc.RESTORE
+    TEST2_BRANCH = bc.TEST2_BRANCH
+    TEST_EQ, TEST_LT, TEST_GT, TEST_NULL = bc.TEST_EQ, bc.TEST_LT, bc.TEST_GT, bc.TEST_NULL
+    ASSIGN_ADD, ASSIGN_SUB, ASSIGN_MUL = bc.ASSIGN_ADD, bc.ASSIGN_SUB, bc.ASSIGN_MUL
+    ASSIGN_CAR, ASSIGN_CDR = bc.ASSIGN_CAR, bc.ASSIGN_CDR
+    # the budget is only counted down at jumps, which every loop
+    # takes, and never reaches zero when there is none
+    if budget is None:
+        budget = -1
+    elif budget <= 0:
+        return pc >= end
+    # a binary search over the opcode numbers, so that no opcode is more
+    # than six comparisons away
+    try:
+        while pc < end:
+            op = code[pc]
+            if op < TEST2_BRANCH:
+                if op < TESTN:
+                    if op < ASSIGN_OPN:
+                        if op == ASSIGN:
+                            regs[code[pc + 1]] = regs[code[pc + 2]]
+                            pc += 3
+                        elif op == ASSIGN_OP2:
+                            regs[code[pc + 1]] = ops[code[pc + 2]](regs[code[pc + 3]], regs[code[pc + 4]])
+                            pc += 5
+                        else:
+                            regs[code[pc + 1]] = ops[code[pc + 2]](regs[code[pc + 3]])
+                            pc += 4
+                    elif op == TEST2:
+                        regs[flag] = ops[code[pc + 1]](regs[code[pc + 2]], regs[code[pc + 3]])
+                        pc += 4
+                    elif op == TEST1:
+                        regs[flag] = ops[code[pc + 1]](regs[code[pc + 2]])
+                        pc += 3
+                    else:
+                        n = code[pc + 3]
+                        args = [regs[a] for a in code[pc + 4:pc + 4 + n]]
+                        regs[code[pc + 1]] = ops[code[pc + 2]](*args)
+                        pc += 4 + n
+                elif op < GOTO_REG:
+                    if op == BRANCH:
+                        if regs[flag]:
+                            pc = code[pc + 1]
+                            budget -= 1
+                            if not budget:
+                                break
+                        else:
+                            pc += 2
+                    elif op == GOTO:
+                        pc = code[pc + 1]
+                        budget -= 1
+                        if not budget:
+                            break
+                    elif op == TESTN:
+                        n = code[pc + 2]
+                        args = [regs[a] for a in code[pc + 3:pc + 3 + n]]
+                        regs[flag] = ops[code[pc + 1]](*args)
+                        pc += 3 + n
+                    else:
+                        n = code[pc + 2]
+                        args = [regs[a] for a in code[pc + 3:pc + 3 + n]]
+                        ops[code[pc + 1]](*args)
+                        pc += 3 + n
+                elif op == SAVE:
+                    r = code[pc + 1]
+                    pushes[r](regs[r])
+                    pc += 2
+                elif op == RESTORE:
+                    r = code[pc + 1]
+                    regs[r] = pops[r]()
+                    pc += 2
+                else:
+                    pc = regs[code[pc + 1]]
+                    budget -= 1
+                    if not budget:
+                        break
+            elif op < ASSIGN_ADD:
+                if op == TEST_EQ:
+                    regs[flag] = regs[code[pc + 2]] == regs[code[pc + 3]]
+                    pc += 4
+                elif op == TEST2_BRANCH:
+                    f = regs[flag] = ops[code[pc + 1]](regs[code[pc + 2]], regs[code[pc + 3]])
+                    if f:
+                        pc = code[pc + 4]
+                        budget -= 1
+                        if not budget:
+                            break
+                    else:
+                        pc += 5
+                elif op == TEST_GT:
+                    regs[flag] = regs[code[pc + 2]] > regs[code[pc + 3]]
+                    pc += 4
+                elif op == TEST_LT:
+                    regs[flag] = regs[code[pc + 2]] < regs[code[pc + 3]]
+                    pc += 4
+                else:
+                    regs[flag] = regs[code[pc + 2]] is None
+                    pc += 3
+            elif op < ASSIGN_CAR:
+                if op == ASSIGN_SUB:
+                    regs[code[pc + 1]] = regs[code[pc + 3]] - regs[code[pc + 4]]
+                    pc += 5
+                elif op == ASSIGN_ADD:
+                    regs[code[pc + 1]] = regs[code[pc + 3]] + regs[code[pc + 4]]
+                    pc += 5
+                else:
+                    regs[code[pc + 1]] = regs[code[pc + 3]] * regs[code[pc + 4]]
+                    pc += 5
+            elif op == ASSIGN_CAR:
+                regs[code[pc + 1]] = regs[code[pc + 3]][0]
+                pc += 4
+            elif op == ASSIGN_CDR:
+                regs[code[pc + 1]] = regs[code[pc + 3]][1]
+                pc += 4
+            else:
+                raise inst.ExecutionError("unknown opcode {}".format(op))
+    finally:
+        regs[pc_slot] = pc
+    return pc >= end
+
+
+def make_machine(registers, ops, pure_ops=(), max_stack_depth=None, register_stacks=False,
+                 builtins=True, list_memory=None, async_ops=None):
+    """ ops:
+            Dict of op name to function. These replace built-in ops
+            of the same name.
+        pure_ops:
+            Names of the ops without side effects, whose calls on
+            constants may be evaluated at assembly time.
+        max_stack_depth, register_stacks:
+            See Machine.
+        builtins:
+            Install the op library of primitives.OPS first. The
+            instruction generators specialise calls of these ops.
+        list_memory:
+            Number of pairs of list memory to back the list ops
+            with, see Machine.install_list_memory.
+        async_ops:
+            Dict of op name to function for the ops that may return
+            an awaitable, see Machine.install_async_operations.
+            Coroutine functions in `ops` are installed as async ops
+            too.
+    """
+    machine = Machine(max_stack_depth, register_stacks)
     for register in registers:
         machine.allocate_register(register)
+    if builtins:
+        machine.install_operations(primitives.OPS)
     machine.install_operations(ops)
+    machine.pure_ops.update(name for name in primitives.PURE if primitives.is_builtin(machine.ops, name))
+    machine.pure_ops.update(pure_ops)
+    coroutines = dict((name, op) for name, op in ops.items() if inspect.iscoroutinefunction(op))
+    coroutines.update(async_ops or {})
+    if coroutines:
+        machine.install_async_operations(coroutines)
+    if list_memory is not None:
+        machine.install_list_memory(list_memory)
     return machine
         
-def assemble_machine(machine, text):
+def assemble_program(registers, ops, text, backend="python", pure_ops=(), max_stack_depth=None,
+                     register_stacks=False, builtins=True, cache=None, optimize=False, async_ops=None):
+    """ Assemble the controller `text` once into a Program, see
+        make_machine and assemble_machine for the arguments.
+    """
+    machine = make_machine(registers, ops, pure_ops, max_stack_depth, register_stacks, builtins,
+                           async_ops=async_ops)
+    assemble_machine(machine, text, backend, cache, optimize)
+    return Program(machine)
+
+def resume_points(machine, insts_tokens, backend):
+    """ For every instruction calling an async op of `machine`, its
+        offset in the assembled controller mapped to the instruction,
+        the offset of the following one and whether it also branches,
+        which is all MachineState.resume needs to finish it.
+    """
+    points = {}
+    offset = 0
+    for token in insts_tokens:
+        if token.type == "LABEL":
+            continue
+        size = bc.instruction_size(token) if backend == "bytecode" else 1
+        if getattr(token, "op", None) in machine.async_ops:
+            if token.type == "TEST_BRANCH" and backend == "bytecode" and len(token.args) != 2:
+                # assembled as a test followed by a branch
+                test = lisp_parser.TestToken(token.op, token.args)
+                points[offset] = (token, offset + bc.instruction_size(test), False)
+            else:
+                points[offset] = (token, offset + size, token.type == "TEST_BRANCH")
+        offset += size
+    return points
+
+def parse_controller(text):
+    """ Parse controller text into its list of label and instruction tokens.
+    """
     p = lisp_parser.Parser()
     
     p.parse(text)
-    inst.update_instructions(p.instructions, machine)
+    return p.instructions
+
+def assemble_machine(machine, text, backend="closure", cache=None, optimize=False,
+                     superinstructions=None, lazy=False):
+    """ Assemble the controller `text` into `machine`.
+        backend:
+            "closure" builds one Python closure per instruction,
+            "bytecode" lowers the controller to an array of opcodes
+            run by a single dispatch loop in the machine,
+            "python" translates the whole controller into one
+            generated Python function.
+        cache:
+            An optional cache.ControllerCache; a controller already
+            in it is not parsed again.
+        optimize:
+            Run the optimizer.Optimizer passes over the parsed
+            controller before generating instructions.
+        superinstructions:
+            With the closure backend, fuse straight-line runs of
+            instructions into single execution procedures: "static"
+            fuses every run found in the controller text, a
+            profiler.Profile of an earlier run of the same controller
+            only the runs it saw executed, and a list of (offset,
+            length) pairs those runs.
+        lazy:
+            With the closure backend, only build the instructions of a
+            block when control first reaches it, see
+            instructions.update_instructions_lazily. The machine's
+            lazy_blocks then counts the blocks built.
+    """
+    if cache is not None:
+        insts_tokens = cache.parse(text, machine.register_index, machine.ops)
+    else:
+        insts_tokens = parse_controller(text)
+    install_controller(machine, insts_tokens, backend, optimize, superinstructions, lazy)
+
+def assemble_machine_stream(machine, source, backend="closure", encoding="utf-8", chunk_size=65536):
+    """ Assemble a controller read incrementally from a file object or
+        an iterable of text chunks. With the closure backend the parsed
+        tokens are consumed as they are produced, so neither the whole
+        text nor the whole token list is held in memory; the other
+        backends, profiling, tracing and async ops need the full token
+        list.
+    """
+    insts_tokens = lisp_parser.Parser().parse_stream(source, encoding, chunk_size)
+    if backend == "closure" and machine.profile is None and machine.tracer is None and not machine.async_ops:
+        machine.insts_tokens = None
+        reset_controller(machine, backend)
+        inst.update_instructions(insts_tokens, machine)
+    else:
+        install_controller(machine, list(insts_tokens), backend)
+
+def reset_controller(machine, backend):
+    """ Forget what `machine` knows of the controller assembled into it
+        earlier, before a new one is assembled with `backend`.
+    """
+    machine.backend = backend
+    machine.superinstructions = None
+    machine.lazy_blocks = None
+    machine.resume_points = None
+    # labels of a controller assembled earlier must not resolve
+    machine.label_pointers = {}
+
+def install_controller(machine, insts_tokens, backend="closure", optimize=False,
+                       superinstructions=None, lazy=False):
+    """ Assemble an already parsed controller into `machine`.
+    """
+    if optimize:
+        insts_tokens = optimizer.optimize(insts_tokens, machine.ops, machine.pure_ops)
+    machine.insts_tokens = insts_tokens
+    if machine.profile is not None and backend != "closure":
+        raise MachineError("Profiling is only supported by the closure backend")
+    if machine.tracer is not None:
+        if backend != "closure":
+            raise MachineError("Tracing is only supported by the closure backend")
+        if machine.profile is not None or superinstructions is not None:
+            raise MachineError("A traced machine can neither be profiled nor use superinstructions")
+    if superinstructions is not None:
+        if backend != "closure":
+            raise MachineError("Superinstructions are only supported by the closure backend")
+        if machine.profile is not None:
+            raise MachineError("A profiled machine counts every instruction and cannot use superinstructions")
+    if machine.async_ops and (superinstructions is not None or machine.tracer is not None):
+        raise MachineError("Async ops are supported by neither superinstructions nor tracing")
+    if lazy:
+        if backend != "closure":
+            raise MachineError("Lazy assembly is only supported by the closure backend")
+        if superinstructions is not None:
+            raise MachineError("Superinstructions replace instructions that lazy assembly has not built yet")
+    reset_controller(machine, backend)
+    if machine.async_ops:
+        machine.resume_points = resume_points(machine, insts_tokens, backend)
+    if backend == "closure":
+        if lazy:
+            machine.lazy_blocks = inst.update_instructions_lazily(insts_tokens, machine)
+        else:
+            inst.update_instructions(insts_tokens, machine)
+        if superinstructions is not None:
+            if superinstructions == "static":
+                sequences = si.sequences(insts_tokens)
+            elif isinstance(superinstructions, profiler.Profile):
+                sequences = si.profiled_sequences(insts_tokens, superinstructions)
+            else:
+                sequences = list(superinstructions)
+            si.install(machine, insts_tokens, sequences)
+            machine.superinstructions = sequences
+        if machine.profile is not None:
+            machine.profile.install(insts_tokens, machine.label_pointers)
+        if machine.tracer is not None:
+            machine.tracer.install(insts_tokens)
+    elif backend == "bytecode":
+        bc.update_bytecode(insts_tokens, machine)
+    elif backend == "python":
+        codegen.update_compiled(insts_tokens, machine)
+    else:
+        raise MachineError("Unknown backend {}".format(backend))
+
+def extend_controller(machine, insts_tokens):
+    """ Append an already parsed controller to the one assembled into
+        `machine` with the closure backend, without building the earlier
+        instructions again. Their offsets and labels stay valid; a label
+        of the new code that the earlier code defines too is moved, but
+        only from the point it is defined again.
+    """
+    if (machine.backend != "closure" or machine.insts_tokens is None or machine.superinstructions is not None
+            or machine.lazy_blocks is not None or machine.profile is not None or machine.tracer is not None
+            or machine.async_ops):
+        raise MachineError("Only a plain closure controller can be extended")
+    insts_tokens = list(insts_tokens)
+    machine.insts_tokens = machine.insts_tokens + insts_tokens
+    inst.extend_instructions(insts_tokens, machine)
\ No newline at end of file
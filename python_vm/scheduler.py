@@ -0,0 +1,90 @@
+""" Time-slicing many machines within one thread: each runnable machine
+    in turn executes for a quantum of dispatches and goes to the back of
+    the queue until its controller has run to the end.
+
+        scheduler = Scheduler(quantum=1000)
+        tasks = [scheduler.spawn(machine) for machine in machines]
+        scheduler.run()
+
+    A machine is resumed exactly where its slice stopped, so any machine
+    may be scheduled, whatever its backend. Scheduled machines must not
+    share their stacks or list memory, nor have async ops, which only
+    MachineState.run can wait for.
+"""
+from collections import deque
+
+import python_vm
+
+
+class Task:
+    """ A machine in a Scheduler. `done` is set once the controller has
+        run to the end or raised, in which case the exception is kept in
+        `error`. `slices` counts the quanta it has executed.
+    """
+    def __init__(self, machine):
+        self.machine = machine
+        self.done = False
+        self.error = None
+        self.slices = 0
+
+    def __repr__(self):
+        state = "done" if self.done else "runnable"
+        return "<Task {} after {} slices>".format(state, self.slices)
+
+
+class Scheduler:
+    """ Round-robin over the machines spawned into it.
+        quantum:
+            The budget, in dispatches as counted by Machine.execute, of
+            each slice.
+    """
+    def __init__(self, quantum=1000):
+        self.quantum = quantum
+        self.runnable = deque()
+
+    def spawn(self, machine, start=True):
+        """ Queue `machine` and return its Task. With `start` it runs
+            from the first instruction, otherwise it carries on from its
+            current pc.
+        """
+        if machine.resume_points:
+            raise python_vm.MachineError("A machine with async ops must be run by MachineState.run")
+        if start:
+            machine.pc.set_contents(0)
+        task = Task(machine)
+        self.runnable.append(task)
+        return task
+
+    def step(self):
+        """ Run the machine at the head of the queue for one quantum.
+            Returns False when there was none left to run.
+        """
+        if not self.runnable:
+            return False
+        task = self.runnable.popleft()
+        task.slices += 1
+        try:
+            finished = task.machine.execute(self.quantum)
+        except Exception as e:
+            task.error = e
+            finished = True
+        if finished:
+            task.done = True
+        else:
+            self.runnable.append(task)
+        return True
+
+    def run(self, max_slices=None):
+        """ Step until every machine has finished, or for at most
+            `max_slices` slices. Returns whether every machine finished.
+        """
+        slices = 0
+        while self.runnable:
+            if max_slices is not None and slices >= max_slices:
+                return False
+            self.step()
+            slices += 1
+        return True
+
+    def __len__(self):
+        return len(self.runnable)
@@ -0,0 +1,93 @@
+import re
+
+import lexer
+
+
+class SexpLexer(lexer.Lexer):
+    """ A tokenizer specialised for s-expressions, usable in place of
+        a lexer.Lexer.
+
+        Instead of trying every rule in turn, it scans a whole atom
+        (a run of characters other than whitespace and parentheses)
+        with one regex and classifies it: keywords and operators by
+        dict lookup, then numbers and identifiers. An identifier that
+        starts with a keyword, such as `operand` or `register-a`, is
+        therefore an IDENTIFIER.
+    """
+    def __init__(self, keywords, operators):
+        """ keywords:
+                Dict of keyword to token type.
+            operators:
+                Dict of operator atom to token type.
+        """
+        self.types = dict(operators)
+        self.types.update(keywords)
+        self.regex = re.compile(r'\s*(?:([()])|([^\s()]+))')
+        self.re_ws_skip = re.compile(r'\S')
+        self.re_number = re.compile(r'-?\d+\Z')
+        self.re_identifier = re.compile(r'[a-zA-Z_][\w\-?!<>=*/+]*\Z')
+        self.bytes_regex = None
+        self.bytes_re_ws_skip = None
+        self.skip_whitespace = True
+
+    def input(self, buf, encoding='utf-8'):
+        if not isinstance(buf, str) and self.bytes_regex is None:
+            self.bytes_regex = re.compile(self.regex.pattern.encode('ascii'))
+            self.bytes_re_ws_skip = re.compile(rb'\S')
+        lexer.Lexer.input(self, buf, encoding)
+
+    def classify(self, atom, pos):
+        tok_type = self.types.get(atom)
+        if tok_type is None:
+            if self.re_number.match(atom):
+                tok_type = 'NUMBER'
+            elif self.re_identifier.match(atom):
+                tok_type = 'IDENTIFIER'
+            else:
+                raise lexer.LexerError(pos)
+        return lexer.Token(tok_type, atom, pos)
+
+    def token(self):
+        """ Return the next token found in the input, or None at the
+            end of it. Raises LexerError on an atom that is neither a
+            keyword, an operator, a number nor an identifier.
+        """
+        if self.chunks is not None:
+            return self._stream_token()
+        m = self.cur_regex.match(self.buf, self.pos)
+        if m is None:
+            if self.cur_ws_skip.search(self.buf, self.pos):
+                raise lexer.LexerError(self.pos)
+            self.pos = self.buflen
+            return None
+        self.pos = m.end()
+        paren = m.group(1)
+        if paren is not None:
+            if self.encoding is not None:
+                paren = paren.decode('ascii')
+            return lexer.Token(paren, paren, m.start(1))
+        atom = m.group(2)
+        if self.encoding is not None:
+            atom = atom.decode(self.encoding)
+        return self.classify(atom, m.start(2))
+
+    def _stream_token(self):
+        while True:
+            buf = self.buf
+            m = self.cur_regex.match(buf, self.pos)
+            # an atom reaching the end of the buffer might continue
+            # in the next chunk
+            if m is not None and (m.group(1) is not None or m.end() < len(buf) or self.exhausted):
+                self.pos = m.end()
+                if m.group(1) is not None:
+                    return lexer.Token(m.group(1), m.group(1), self.base + m.start(1))
+                return self.classify(m.group(2), self.base + m.start(2))
+            if self.exhausted:
+                ws = self.cur_ws_skip.search(buf, self.pos)
+                if ws:
+                    raise lexer.LexerError(self.base + ws.start())
+                return None
+            # skip whitespace before reading on, so that it is dropped
+            ws = self.cur_ws_skip.search(buf, self.pos)
+            self.pos = ws.start() if ws else len(buf)
+            self._read_chunk()
@@ -0,0 +1,187 @@
+""" Saving the full state of a machine to a compact binary snapshot and
+    restoring it: the registers, pc and flag, the stacks, the assembled
+    controller and the list memory, if any.
+
+        snapshot.save(machine, "warm.snapshot")
+        machine = snapshot.load("warm.snapshot", ops)
+        machine.execute()   # carries on from the saved pc
+
+    A snapshot is taken between runs, or between the slices of a run
+    with an instruction budget, never from inside an op. It holds the
+    parsed controller rather than the generated instructions, which are
+    rebuilt for the same backend on load. Ops are functions and are not
+    saved: built-in and list memory ops are reinstalled by name, every
+    other op must be given to load.
+
+    File layout, all in native byte order:
+
+        magic    8 bytes
+        header   version, metadata size, list memory size (pairs)
+        metadata pickled dict, padded to a multiple of 8 bytes
+        the-cars list memory size 64-bit words
+        the-cdrs list memory size 64-bit words
+
+    Loading maps the file and copies the two vectors straight out of
+    the mapping.
+"""
+import mmap
+import pickle
+import struct
+import sys
+from array import array
+
+import primitives
+import python_vm
+
+MAGIC = b"PVMSNAP\0"
+VERSION = 1
+HEADER = struct.Struct("=IQQ")
+
+
+class SnapshotError(Exception): pass
+
+
+def dumps(machine):
+    """ The snapshot of `machine` as bytes. """
+    return b"".join(_chunks(machine))
+
+
+def save(machine, path):
+    with open(path, "wb") as f:
+        for chunk in _chunks(machine):
+            f.write(chunk)
+
+
+def loads(data, ops=None):
+    """ A new machine restored from the snapshot `data`, any object
+        supporting the buffer protocol.
+        ops:
+            Dict of op name to function for the ops of the machine that
+            are neither built-in nor list memory ops, async ops
+            included, which are installed as async ops again.
+    """
+    view = memoryview(data)
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        raise SnapshotError("Not a machine snapshot")
+    version, meta_size, memory_size = HEADER.unpack_from(view, len(MAGIC))
+    if version != VERSION:
+        raise SnapshotError("Unsupported snapshot version {}".format(version))
+    offset = len(MAGIC) + HEADER.size
+    meta = pickle.loads(view[offset:offset + meta_size])
+    offset += _padded(meta_size)
+    vectors = []
+    for _ in range(2):
+        vector = array('q')
+        vector.frombytes(view[offset:offset + 8 * memory_size])
+        offset += 8 * memory_size
+        if meta["byteorder"] != sys.byteorder:
+            vector.byteswap()
+        vectors.append(vector)
+    return _restore(meta, vectors, ops or {})
+
+
+def load(path, ops=None):
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return loads(mapped, ops)
+
+
+def _padded(size):
+    return (size + 7) & ~7
+
+
+def _chunks(machine):
+    if machine.insts_tokens is None:
+        raise SnapshotError("A machine assembled from a stream does not keep its controller")
+    if machine.profile is not None:
+        raise SnapshotError("Profiled machines cannot be saved")
+    names = sorted(machine.register_index, key=machine.register_index.get)
+    builtins = [name for name in machine.ops if primitives.is_builtin(machine.ops, name)]
+    heap = machine.memory
+    memory_ops = heap.ops() if heap is not None else {}
+    meta = {
+        "byteorder": sys.byteorder,
+        "registers": names,
+        "values": [machine.slots[machine.register_index[name]] for name in names],
+        "max_stack_depth": machine.max_stack_depth,
+        "stack": machine.stack.stack,
+        "register_stacks": (None if machine.register_stacks is None else
+                            dict((name, stack.stack) for name, stack in machine.register_stacks.items())),
+        "ops": sorted(machine.ops),
+        "builtins": builtins,
+        "memory_ops": sorted(name for name in memory_ops if machine.ops.get(name) == memory_ops[name]),
+        "pure_ops": sorted(machine.pure_ops),
+        "async_ops": sorted(machine.async_ops),
+        "backend": machine.backend,
+        "superinstructions": machine.superinstructions,
+        "lazy": machine.lazy_blocks is not None,
+        "insts_tokens": machine.insts_tokens,
+        "memory": None if heap is None else {
+            "size": heap.size,
+            "free": heap.free,
+            "objects": heap.objects,
+            "collections": heap.collections,
+        },
+    }
+    try:
+        data = pickle.dumps(meta, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        raise SnapshotError("Machine state cannot be saved: {}".format(e))
+    memory_size = heap.size if heap is not None else 0
+    yield MAGIC
+    yield HEADER.pack(VERSION, len(data), memory_size)
+    yield data
+    yield b"\0" * (_padded(len(data)) - len(data))
+    if heap is not None:
+        yield heap.the_cars.tobytes()
+        yield heap.the_cdrs.tobytes()
+
+
+def _restore(meta, vectors, ops):
+    machine = python_vm.Machine(meta["max_stack_depth"], meta["register_stacks"] is not None)
+    for name in meta["registers"]:
+        if name not in machine.register_index:
+            machine.allocate_register(name)
+    machine.install_operations(dict((name, primitives.OPS[name]) for name in meta["builtins"]))
+    machine.install_operations(ops)
+    async_ops = meta.get("async_ops", ())
+    if async_ops:
+        missing = [name for name in async_ops if name not in ops]
+        if missing:
+            raise SnapshotError("Snapshot needs the async ops {}".format(", ".join(missing)))
+        machine.install_async_operations(dict((name, ops[name]) for name in async_ops))
+    if meta["memory"] is not None:
+        saved = meta["memory"]
+        heap = machine.install_list_memory(saved["size"])
+        # only the list memory ops still in use when it was saved
+        for name in list(heap.ops()):
+            if name not in meta["memory_ops"]:
+                machine.ops[name] = ops.get(name, primitives.OPS.get(name))
+        heap.the_cars, heap.the_cdrs = vectors
+        heap.free = saved["free"]
+        heap.objects = saved["objects"]
+        heap.collections = saved["collections"]
+        for index, value in enumerate(heap.objects):
+            try:
+                heap.object_index.setdefault(value, index)
+            except TypeError:
+                pass
+    missing = [name for name in meta["ops"] if machine.ops.get(name) is None]
+    if missing:
+        raise SnapshotError("Snapshot needs the ops {}".format(", ".join(missing)))
+    machine.pure_ops.clear()
+    machine.pure_ops.update(meta["pure_ops"])
+
+    if meta["backend"] is not None:
+        python_vm.install_controller(machine, meta["insts_tokens"], meta["backend"],
+                                     superinstructions=meta["superinstructions"], lazy=meta.get("lazy", False))
+    for name, value in zip(meta["registers"], meta["values"]):
+        machine.set_register_value(name, value)
+    for value in meta["stack"]:
+        machine.stack.push(value)
+    if meta["register_stacks"] is not None:
+        for name, values in meta["register_stacks"].items():
+            stack = machine.stack_for(name)
+            for value in values:
+                stack.push(value)
+    return machine
@@ -0,0 +1,119 @@
+import codegen
+
+# the jumps that may end a superinstruction; every other instruction
+# falls through to the next one
+JUMPS = ("BRANCH", "TEST_BRANCH", "GOTO_LABEL", "GOTO_REGISTER")
+
+
+def sequences(insts_tokens, min_length=2):
+    """ Static analysis of a controller: the (offset, length) of every
+        run of at least `min_length` instructions that can only be
+        entered at its first instruction, that is straight-line
+        instructions with no label between them, optionally ending
+        with a jump. Offsets count instructions, not labels.
+    """
+    result = []
+    start = None
+    offset = 0
+    for token in insts_tokens:
+        t = token.type
+        if t == "LABEL":
+            if start is not None and offset - start >= min_length:
+                result.append((start, offset - start))
+            start = None
+            continue
+        if start is None:
+            start = offset
+        offset += 1
+        if t in JUMPS:
+            if offset - start >= min_length:
+                result.append((start, offset - start))
+            start = None
+    if start is not None and offset - start >= min_length:
+        result.append((start, offset - start))
+    return result
+
+
+def profiled_sequences(insts_tokens, profile, min_count=1, min_length=2):
+    """ The sequences whose first instruction was executed at least
+        `min_count` times in the runs recorded by a profiler.Profile of
+        the same controller.
+    """
+    counts = profile.instruction_counts
+    return [(offset, length) for offset, length in sequences(insts_tokens, min_length)
+            if counts[offset] >= min_count]
+
+
+def install(machine, insts_tokens, sequences):
+    """ Replace the first closure of every sequence of the controller
+        `insts_tokens`, already assembled into `machine` by
+        instructions.update_instructions, with a superinstruction for
+        the whole sequence. The following closures are left in place
+        so that the offsets of the labels do not change.
+    """
+    tokens = [token for token in insts_tokens if token.type != "LABEL"]
+    functions = Generator(machine).generate(tokens, sequences)
+    for (offset, _), function in zip(sequences, functions):
+        machine.instruction_sequence[offset] = function
+
+
+class Generator(codegen.Generator):
+    """ Generates the Python source of one execution procedure per
+        sequence, all compiled together. Unlike a compiled controller
+        a superinstruction reads and writes the register file directly
+        and updates the pc register once, at its end. If an instruction
+        of the sequence raises, pc is left at the start of the sequence.
+    """
+    register_locals = False
+
+    def generate(self, tokens, sequences):
+        pc = self.register("pc")
+        self.closure_names.append("regs")
+        self.closure_values.append(self.machine.slots)
+        body = []
+        names = []
+        for offset, length in sequences:
+            name = "superinstruction_%d" % offset
+            names.append(name)
+            body.append("def %s():" % name)
+            for token in tokens[offset:offset + length - 1]:
+                body.extend("    " + line for line in self.instruction(token))
+            body.extend("    " + line for line in self.last(tokens[offset + length - 1], offset + length, pc))
+
+        lines = ["def make_superinstructions(%s):" % ", ".join(self.closure_names)]
+        lines.extend("    " + line for line in body)
+        lines.append("    return [%s]" % ", ".join(names))
+        source = "\n".join(lines) + "\n"
+        namespace = {}
+        exec(compile(source, "<superinstructions>", "exec"), namespace)
+        return namespace["make_superinstructions"](*self.closure_values)
+
+    def last(self, token, after, pc):
+        t = token.type
+        if t in ("BRANCH", "TEST_BRANCH"):
+            lines = []
+            if t == "TEST_BRANCH":
+                lines.extend(self.call(self.register("flag"), token))
+            lines.extend(["if %s:" % self.register("flag"),
+                          "    %s = %d" % (pc, self.label(token.label)),
+                          "else:",
+                          "    %s = %d" % (pc, after)])
+            return lines
+        elif t == "GOTO_LABEL":
+            return ["%s = %d" % (pc, self.label(token.label))]
+        elif t == "GOTO_REGISTER":
+            return ["%s = %s" % (pc, self.register(token.register))]
+        return self.instruction(token) + ["%s = %d" % (pc, after)]
+
+    def stack_operation(self, register, kind):
+        """ The closure name of the push or pop method of the stack
+            of `register`, bound when the sequences are generated.
+        """
+        stack = self.machine.stack_for(register)
+        key = (id(stack), kind)
+        if key not in self.stack_names:
+            self.stack_names[key] = self.closure("stack_" + kind, getattr(stack, kind))
+        return self.stack_names[key]
+
+    def register(self, name):
+        return "regs[%d]" % self.machine.register_slot(name)
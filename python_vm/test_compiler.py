@@ -0,0 +1,94 @@
+import unittest
+import compiler
+import evaluator
+import test_evaluator
+
+
+def compile_text(text):
+    return compiler.compile_expression(evaluator.read(text)[0])
+
+
+class TestCompiledScheme(test_evaluator.TestEvaluator):
+    evaluator_class = compiler.Scheme
+
+    def test_internal_definitions(self):
+        value = self.ev.evaluate('''(define (f x)
+              (define (square y) (* y y))
+              (define z (+ x 1))
+              (set! z (+ z 1))
+              (+ (square x) z))
+            (f 4)''')
+        self.assertEqual(value, 22)
+        self.assertRaises(evaluator.EvaluatorError, self.ev.evaluate, "(define (g) (define a b) (define b 1) a) (g)")
+
+    def test_shadowed_primitive(self):
+        value = self.ev.evaluate("(define (f + a b) (+ a b)) (f * 3 4)")
+        self.assertEqual(value, 12)
+
+    def test_procedures_survive(self):
+        self.ev.evaluate("(define (adder n) (lambda (x) (+ x n)))")
+        self.ev.evaluate("(define add3 (adder 3))")
+        self.assertEqual(self.ev.evaluate("(add3 4)"), 7)
+        self.assertEqual(self.ev.evaluate("(add3 (add3 0))"), 6)
+
+    def test_call_before_last_expression(self):
+        self.assertEqual(self.ev.evaluate("(define (f x) x) (define y (f 3)) y"), 3)
+        self.assertEqual(self.ev.evaluate("(f 1) 5"), 5)
+        self.assertIsNone(self.ev.evaluate(""))
+
+    def test_run_earlier_code(self):
+        start = self.ev.compile("(define n 1) (+ n 1)")
+        self.ev.evaluate("(define n 5)")
+        self.assertEqual(self.ev.run(start), 2)
+        self.assertEqual(self.ev.evaluate("n"), 1)
+
+
+class TestBytecodeCompiledScheme(TestCompiledScheme):
+    backend = "bytecode"
+
+
+class TestPythonCompiledScheme(TestCompiledScheme):
+    backend = "python"
+
+
+class TestCompiler(unittest.TestCase):
+
+    def test_lexical_addresses(self):
+        tokens = compile_text("(lambda (a b) (lambda (c) (list a b c)))")
+        lookups = [token.args[0].value for token in tokens
+                   if token.type == "ASSIGN_OP" and token.op == "lexical-address-lookup"]
+        self.assertEqual(lookups, [(1, 0), (1, 1), (0, 0)])
+        globals = [token.args[0].value for token in tokens if token.type == "ASSIGN_OP" and token.op == "global-ref"]
+        self.assertEqual(globals, ["list"])
+
+    def test_tail_call_preserves_nothing(self):
+        tokens = compile_text("(define (loop n) (if (= n 0) 'done (loop (- n 1))))")
+        self.assertFalse([token for token in tokens if token.type in ("SAVE", "RESTORE")])
+
+    def test_preserving(self):
+        tokens = compile_text("(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))")
+        saved = sorted(token.register for token in tokens if token.type == "SAVE")
+        # continue and env around the first call, arg1 around the second
+        self.assertEqual(saved, ["arg1", "continue", "env"])
+
+    def test_open_coded(self):
+        tokens = compile_text("(lambda (x) (+ (* x x) 1))")
+        ops = [token.op for token in tokens if token.type == "ASSIGN_OP"]
+        self.assertEqual(ops, ["make-compiled-procedure", "procedure-frame", "lexical-address-lookup",
+                               "lexical-address-lookup", "*", "+"])
+
+    def test_extend(self):
+        scheme = compiler.Scheme()
+        scheme.evaluate("(define (square x) (* x x))")
+        instructions = list(scheme.machine.instruction_sequence)
+        self.assertEqual(scheme.evaluate("(square 5)"), 25)
+        # only the new code is assembled
+        self.assertEqual(scheme.machine.instruction_sequence[:len(instructions)], instructions)
+
+    def test_unknown_expression(self):
+        self.assertRaises(compiler.CompileError, compiler.compile_expression, 1.5)
+        self.assertRaises(compiler.CompileError, compile_text, "(lambda args 1)")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+import evaluator
+import python_vm
+
+FIB = '''(define (fib n)
+  (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))'''
+
+
+class TestEvaluator(unittest.TestCase):
+    backend = "closure"
+    options = {}
+    evaluator_class = evaluator.Evaluator
+
+    def setUp(self):
+        self.ev = self.evaluator_class(backend=self.backend, **self.options)
+
+    def test_fib(self):
+        self.ev.evaluate(FIB)
+        self.assertEqual(self.ev.evaluate("(fib 10)"), 55)
+
+    def test_special_forms(self):
+        value = self.ev.evaluate('''(define x 1)
+            (define (f y)
+              (set! x (+ x y))
+              (let ((a x) (b 2))
+                (cond ((> a 10) 'big)
+                      ((= a 3) (begin 'three))
+                      (else (* a b)))))
+            (list (f 2) (f 1) (f 20) ((lambda (x) x) #f) (if #f 1))''')
+        self.assertEqual(evaluator.write(value), "(three 8 big #f #f)")
+
+    def test_lists(self):
+        value = self.ev.evaluate('''(define (rev l acc)
+              (if (null? l) acc (rev (cdr l) (cons (car l) acc))))
+            (rev '(1 (2 3) x) '())''')
+        self.assertEqual(evaluator.write(value), "(x (2 3) 1)")
+
+    def test_benchmark_programs(self):
+        import bench_evaluator
+        for name, definitions, expression in bench_evaluator.PROGRAMS:
+            self.ev.evaluate(definitions)
+        self.assertEqual(self.ev.evaluate("(fib 16)"), 987)
+        self.assertEqual(self.ev.evaluate("(fact 20)"), 2432902008176640000)
+        self.assertEqual(self.ev.evaluate("(ack 2 3)"), 9)
+        self.assertEqual(self.ev.evaluate("(car (reverse-times (iota 10) 3))"), 10)
+
+    def test_errors(self):
+        self.assertRaises(evaluator.EvaluatorError, self.ev.evaluate, "(undefined 1)")
+        self.assertRaises(evaluator.EvaluatorError, self.ev.evaluate, "(1 2)")
+        self.assertRaises(evaluator.EvaluatorError, self.ev.evaluate, "((lambda (x) x))")
+        # the evaluator is still usable afterwards
+        self.assertEqual(self.ev.evaluate("(+ 1 2)"), 3)
+
+    def test_stack_limit(self):
+        ev = self.evaluator_class(backend=self.backend, max_stack_depth=100, **self.options)
+        ev.evaluate(FIB)
+        self.assertEqual(ev.evaluate("(fib 5)"), 5)
+        self.assertRaises(python_vm.StackError, ev.evaluate, "(define (loop n) (+ 1 (loop n))) (loop 1)")
+
+
+class TestSuperinstructionEvaluator(TestEvaluator):
+    options = {"superinstructions": "static"}
+
+
+class TestBytecodeEvaluator(TestEvaluator):
+    backend = "bytecode"
+
+
+class TestPythonEvaluator(TestEvaluator):
+    backend = "python"
+
+
+class TestReader(unittest.TestCase):
+
+    def test_read(self):
+        expressions = evaluator.read("""; a comment
+            (a 'b (c . d)) 12 #t
+            -3 ; trailing""")
+        self.assertEqual([evaluator.write(e) for e in expressions],
+                         ["(a (quote b) (c . d))", "12", "#t", "-3"])
+
+    def test_unbalanced(self):
+        self.assertRaises(evaluator.EvaluatorError, evaluator.read, "(a (b)")
+        self.assertRaises(evaluator.EvaluatorError, evaluator.read, "a)")
+
+
+if __name__ == '__main__':
+    unittest.main()
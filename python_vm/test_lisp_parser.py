@@ -1,5 +1,8 @@
 
+import io
 import lisp_parser
+import mmap
+import tempfile
 import unittest
 
 
@@ -58,6 +61,85 @@ class TestStringMethods(unittest.TestCase):
         self.parser.parse(gcd_command)
         self.assertEqual(self.parser.instructions, [lisp_parser.LabelToken("bla"), lisp_parser.BranchToken("haha")])
 
+    def test_instruction_text(self):
+        command = b"(bla (test (op =) (reg b) (const 0))\n  (branch (label bla)))"
+        self.parser.parse(command)
+        self.assertEqual([instr.text for instr in self.parser.instructions],
+                         ["bla", "(test (op =) (reg b) (const 0))", "(branch (label bla))"])
+
+    def test_bytes_input(self):
+        command = b"(bla (assign t (op rem) (reg a) (const 10)))"
+        for buf in (command, bytearray(command), memoryview(command)):
+            parser = lisp_parser.Parser()
+            parser.parse(buf)
+            instr = parser.instructions[1]
+            self.assertEqual("ASSIGN_OP", instr.type)
+            self.assertEqual("t", instr.target_register)
+            self.assertEqual("rem", instr.op)
+            self.assertEqual("a", instr.args[0].value)
+            self.assertEqual(10, instr.args[1].value)
+
+    def test_mmap_input(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b"(bla (branch (label haha)))")
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                self.parser.parse(buf)
+        self.assertEqual(self.parser.instructions, [lisp_parser.LabelToken("bla"), lisp_parser.BranchToken("haha")])
+
+    def test_lexer_positions(self):
+        self.parser.lexer.input("  (bla\n (save a))")
+        positions = [(tok.type, tok.pos) for tok in self.parser.lexer.tokens()]
+        self.assertEqual(positions, [("(", 2), ("IDENTIFIER", 3), ("(", 8), ("SAVE", 9), ("IDENTIFIER", 14), (")", 15), (")", 16)])
+
+    def test_parse_stream(self):
+        command = "(bla (test (op =) (reg b) (const 0))\n (branch (label done)) (assign t (op rem) (reg a) (reg b)) done)"
+        self.parser.parse(command)
+        expected = [str(instr) for instr in self.parser.instructions]
+        texts = [instr.text for instr in self.parser.instructions]
+        for source in (io.StringIO(command), io.BytesIO(command.encode())):
+            tokens = list(lisp_parser.Parser().parse_stream(source, chunk_size=1))
+            self.assertEqual([str(instr) for instr in tokens], expected)
+            self.assertEqual([instr.text for instr in tokens], texts)
+
+    def test_parse_stream_is_incremental(self):
+        chunks = iter(["(first (assign a (const 1))", " second (assign b (const 2))", ")"])
+        tokens = lisp_parser.Parser().parse_stream(chunks)
+        self.assertEqual(next(tokens).label, "first")
+        self.assertEqual(next(tokens).constant, 1)
+        # the second chunk has been read but not the last one
+        self.assertEqual(next(chunks), ")")
+
+    def test_parse_stream_error(self):
+        tokens = lisp_parser.Parser().parse_stream(["(bla (assign t (reg a)) ", "(assign ?)"])
+        self.assertRaises(lisp_parser.ParseError, list, tokens)
+
+    def test_keyword_prefixed_identifiers(self):
+        command = "(test-counter (assign operand (reg register-a)) (goto (label test-counter)))"
+        self.parser.parse(command)
+        self.assertEqual(self.parser.instructions[0].label, "test-counter")
+        self.assertEqual(self.parser.instructions[1].target_register, "operand")
+        self.assertEqual(self.parser.instructions[1].source_register, "register-a")
+        self.assertEqual(self.parser.instructions[2].label, "test-counter")
+
+    def test_same_tokens_as_regex_lexer(self):
+        command = "(gcd (test (op =) (reg b) (const 0)) (branch (label gcd-done))\n (assign t (op rem) (reg a) (reg b))\n (assign a (op <=) (const 12) (label gcd)) gcd-done)"
+        regex_lexer = lisp_parser.Parser(regex_lexer=True).lexer
+        for buf in (command, command.encode()):
+            self.parser.lexer.input(buf)
+            regex_lexer.input(buf)
+            self.assertEqual([str(tok) for tok in self.parser.lexer.tokens()],
+                             [str(tok) for tok in regex_lexer.tokens()])
+
+    def test_negative_constant(self):
+        self.parser.parse("(bla (assign t (const -3)))")
+        self.assertEqual(-3, self.parser.instructions[1].constant)
+
+    def test_lexer_error(self):
+        self.assertRaises(lisp_parser.ParseError, self.parser.parse, "(bla (assign t (const 3x)))")
+        tokens = lisp_parser.Parser().parse_stream(["(bla (assign t (con", "st #)))"])
+        self.assertRaises(lisp_parser.ParseError, list, tokens)
+
 
 if __name__ == '__main__': 
     unittest.main() 
\ No newline at end of file
@@ -0,0 +1,95 @@
+import unittest
+import lisp_parser
+import optimizer
+
+OPS = {"=": lambda x, y: x == y, "+": lambda x, y: x + y, "rem": lambda x, y: x % y,
+       "print": print}
+
+def parse(text):
+    p = lisp_parser.Parser()
+    p.parse(text)
+    return p.instructions
+
+def texts(insts_tokens):
+    return [token.label if token.type == "LABEL" else token.text for token in insts_tokens]
+
+
+class TestOptimizer(unittest.TestCase):
+    def optimize(self, text, pure_ops=("=", "+", "rem")):
+        return optimizer.optimize(parse(text), OPS, pure_ops)
+
+    def test_fold_constants(self):
+        insts_tokens = self.optimize('''(start (assign a (op +) (const 1) (const 2))
+            (assign b (op +) (reg a) (const 1)))''')
+        self.assertEqual(insts_tokens[1].type, "ASSIGN_CONSTANT")
+        self.assertEqual((insts_tokens[1].target_register, insts_tokens[1].constant), ("a", 3))
+        self.assertEqual(insts_tokens[2].type, "ASSIGN_OP")
+
+    def test_fold_only_pure_ops(self):
+        insts_tokens = self.optimize('''(start (assign a (op +) (const 1) (const 2)))''', pure_ops=())
+        self.assertEqual(insts_tokens[1].type, "ASSIGN_OP")
+
+    def test_fold_error_left_to_run_time(self):
+        insts_tokens = self.optimize('''(start (assign a (op rem) (const 1) (const 0)))''')
+        self.assertEqual(insts_tokens[1].type, "ASSIGN_OP")
+
+    def test_remove_self_assignments(self):
+        insts_tokens = self.optimize('''(start (assign a (reg a)) (assign a (reg b)))''')
+        self.assertEqual(texts(insts_tokens), ["start", "(assign a (reg b))"])
+
+    def test_fold_constant_branches(self):
+        insts_tokens = self.optimize('''(start (test (op =) (const 1) (const 1))
+            (branch (label done))
+            (assign a (const 1))
+            done
+            (test (op =) (const 1) (const 2))
+            (branch (label start))
+            (assign a (const 2)))''')
+        types = [token.type for token in insts_tokens]
+        self.assertEqual(types, ["LABEL", "ASSIGN_CONSTANT", "GOTO_LABEL",
+                                 "LABEL", "ASSIGN_CONSTANT", "ASSIGN_CONSTANT"])
+
+    def test_thread_jumps(self):
+        insts_tokens = self.optimize('''(start (test (op =) (reg a) (const 0))
+            (branch (label one))
+            (goto (label one))
+            one
+            (goto (label two))
+            two
+            (assign a (const 1)))''')
+        self.assertEqual(insts_tokens[1].type, "TEST_BRANCH")
+        self.assertEqual(insts_tokens[1].label, "two")
+        self.assertEqual(insts_tokens[2].label, "two")
+
+    def test_goto_cycle(self):
+        insts_tokens = self.optimize('''(one (goto (label two)) two (goto (label one)))''')
+        self.assertEqual(len(insts_tokens), 4)
+
+    def test_remove_unreachable(self):
+        insts_tokens = self.optimize('''(start (goto (reg continue))
+            (assign a (const 1))
+            (perform (op print) (reg a))
+            after
+            (assign a (const 2)))''')
+        self.assertEqual(texts(insts_tokens), ["start", "(goto (reg continue))", "after", "(assign a (const 2))"])
+
+    def test_fuse_test_branches(self):
+        insts_tokens = self.optimize('''(start (test (op =) (reg a) (const 0))
+            (branch (label start)))''')
+        self.assertEqual(len(insts_tokens), 2)
+        token = insts_tokens[1]
+        self.assertEqual((token.type, token.op, token.label), ("TEST_BRANCH", "=", "start"))
+        self.assertEqual(token.text, "(test (op =) (reg a) (const 0)) (branch (label start))")
+
+    def test_tokens_not_mutated(self):
+        insts_tokens = parse('''(start (test (op =) (reg a) (const 0))
+            (branch (label one))
+            one
+            (goto (label start)))''')
+        before = [(token.type, getattr(token, "label", None)) for token in insts_tokens]
+        optimizer.optimize(insts_tokens, OPS, ("=",))
+        self.assertEqual([(token.type, getattr(token, "label", None)) for token in insts_tokens], before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,186 @@
+import asyncio
+import io
+import math
+import operator
+import os
+import tempfile
+import threading
+import time
 import unittest
+import cache
+import pool
+import primitives
+import memory
 import python_vm
+import superinstructions
+import bytecode as bc
+
+FACTORIAL = '''(controller (assign product (const 1))
+    (assign counter (const 1))
+    loop
+    (test (op >) (reg counter) (reg n))
+    (branch (label fact-done))
+    (assign product (op *) (reg counter) (reg product))
+    (assign counter (op +) (reg counter) (const 1))
+    (goto (label loop))
+    fact-done)'''
+
+RECURSIVE_FACTORIAL = '''(controller (assign continue (label fact-done))
+    fact-loop
+    (test (op =) (reg n) (const 1))
+    (branch (label base-case))
+    (save continue)
+    (save n)
+    (assign n (op -) (reg n) (const 1))
+    (assign continue (label after-fact))
+    (goto (label fact-loop))
+    after-fact
+    (restore n)
+    (restore continue)
+    (assign val (op *) (reg n) (reg val))
+    (goto (reg continue))
+    base-case
+    (assign val (const 1))
+    (goto (reg continue))
+    fact-done)'''
+
+# builds the list (n ... 1) and reverses it `rounds` times, leaving
+# most of the pairs built garbage
+REVERSE = '''(start (assign x (const ()))
+    build
+    (test (op =) (reg n) (const 0))
+    (branch (label reverse))
+    (assign x (op cons) (reg n) (reg x))
+    (assign n (op -) (reg n) (const 1))
+    (goto (label build))
+    reverse
+    (test (op =) (reg rounds) (const 0))
+    (branch (label done))
+    (assign y (const ()))
+    reverse-loop
+    (test (op null?) (reg x))
+    (branch (label reversed))
+    (assign t (op car) (reg x))
+    (save t)
+    (assign x (op cdr) (reg x))
+    (restore t)
+    (assign y (op cons) (reg t) (reg y))
+    (goto (label reverse-loop))
+    reversed
+    (assign x (reg y))
+    (assign rounds (op -) (reg rounds) (const 1))
+    (goto (label reverse))
+    done)'''
 
 class TestGCDInstructions(unittest.TestCase):
+    backend = "closure"
+
+    def assemble(self, machine, text):
+        python_vm.assemble_machine(machine, text, backend=self.backend)
 
     def test_gcd(self):
         machine = python_vm.make_machine(["a", "t", "b"], {"=": lambda x, y: x == y, "rem": lambda x, y: x%y})
-        python_vm.assemble_machine(machine, '''(bla (test (op =) (reg b) (const 0))
+        self.assemble(machine, '''(bla (test (op =) (reg b) (const 0))
+            (branch (label gcd-done))
+            (assign t (op rem) (reg a) (reg b))
+            (assign a (reg b))
+            (assign b (reg t))
+            (goto (label bla))
+            gcd-done)''')
+        machine.set_register_value("a", 21)
+        machine.set_register_value("b", 343)
+        machine.start()
+        self.assertEqual(machine.get_register_value("a"), 7)
+
+    def test_factorial(self):
+        machine = python_vm.make_machine(["n", "product", "counter"],
+                                         {">": lambda x, y: x > y, "*": lambda x, y: x * y, "+": lambda x, y: x + y})
+        self.assemble(machine, FACTORIAL)
+        machine.set_register_value("n", 10)
+        machine.start()
+        self.assertEqual(machine.get_register_value("product"), 3628800)
+
+    def test_branch_into_label(self):
+        machine = python_vm.make_machine(["n", "r"], {"=": lambda x, y: x == y, "dec": lambda x: x - 1})
+        self.assemble(machine, '''(loop (test (op =) (reg n) (const 0))
+            (branch (label done))
+            (assign n (op dec) (reg n))
+            (goto (label loop))
+            done
+            (assign r (const 1)))''')
+        machine.set_register_value("n", 5)
+        machine.start()
+        self.assertEqual(machine.get_register_value("n"), 0)
+        self.assertEqual(machine.get_register_value("r"), 1)
+
+    def test_goto_register(self):
+        machine = python_vm.make_machine(["continue", "r"], {})
+        self.assemble(machine, '''(start (assign continue (label after))
+            (goto (reg continue))
+            (assign r (const 1))
+            after
+            (assign r (const 2)))''')
+        machine.start()
+        self.assertEqual(machine.get_register_value("continue"), machine.label_pointers["after"])
+        self.assertEqual(machine.get_register_value("r"), 2)
+
+    def test_perform(self):
+        printed = []
+        machine = python_vm.make_machine(["a"], {"print": lambda *xs: printed.append(xs), "list": lambda *xs: list(xs)})
+        self.assemble(machine, '''(start (assign a (op list) (const 1) (const 2) (const 3))
+            (perform (op print) (reg a))
+            (perform (op print) (const done) (label start)))''')
+        machine.start()
+        self.assertEqual(printed, [([1, 2, 3],), ("done", machine.label_pointers["start"])])
+
+    def test_assemble_stream(self):
+        machine = python_vm.make_machine(["a", "t", "b"], {"=": lambda x, y: x == y, "rem": lambda x, y: x%y})
+        python_vm.assemble_machine_stream(machine, io.StringIO(GCD), backend=self.backend, chunk_size=7)
+        machine.set_register_value("a", 21)
+        machine.set_register_value("b", 343)
+        machine.start()
+        self.assertEqual(machine.get_register_value("a"), 7)
+
+    def test_reassemble(self):
+        first = "(s (assign a (const 1)) (assign a (const 2)) (assign a (const 3)) done)"
+        second = "(s (goto (label done)) (assign a (const 9)) done (assign a (const 5)))"
+        for assemble in [self.assemble,
+                         lambda machine, text: python_vm.assemble_machine_stream(machine, io.StringIO(text),
+                                                                                 backend=self.backend)]:
+            machine = python_vm.make_machine(["a"], {})
+            assemble(machine, first)
+            assemble(machine, second)
+            machine.start()
+            self.assertEqual(machine.get_register_value("a"), 5)
+            self.assertEqual(sorted(machine.label_pointers), ["done", "s"])
+
+    def test_empty_controller(self):
+        machine = python_vm.make_machine([], {})
+        self.assemble(machine, "(done)")
+        self.assertTrue(machine.start())
+
+    def test_label_offsets(self):
+        machine = python_vm.make_machine(["n"], {"=": lambda x, y: x == y})
+        self.assemble(machine, '''(loop (test (op =) (reg n) (const 0))
+            (branch (label done))
+            (goto (label loop))
+            done)''')
+        self.assertEqual(machine.label_pointers, {"loop": 0, "done": 3})
+
+    def test_register_file(self):
+        machine = python_vm.make_machine(["a", "b"], {})
+        self.assertEqual(machine.register_slot("pc"), 0)
+        self.assertEqual(machine.register_slot("flag"), 1)
+        self.assertEqual(machine.register_slot("b"), 3)
+        machine.lookup_register("b").set_contents(4)
+        self.assertEqual(machine.get_register_value("b"), 4)
+        self.assertRaises(python_vm.MachineError, machine.allocate_register, "a")
+        self.assertRaises(python_vm.MachineError, machine.get_register_value, "c")
+
+    def test_profile(self):
+        machine = python_vm.make_machine(["a", "t", "b"], {"=": lambda x, y: x == y, "rem": lambda x, y: x%y})
+        profile = machine.enable_profiling()
+        self.assemble(machine, '''(bla (test (op =) (reg b) (const 0))
             (branch (label gcd-done))
             (assign t (op rem) (reg a) (reg b))
             (assign a (reg b))
@@ -16,3 +191,814 @@ class TestGCDInstructions(unittest.TestCase):
         machine.set_register_value("b", 343)
         machine.start()
         self.assertEqual(machine.get_register_value("a"), 7)
+        self.assertEqual(profile.instruction_counts, [4, 4, 3, 3, 3, 3])
+        self.assertEqual(profile.op_calls, {"=": 4, "rem": 3})
+        self.assertEqual(profile.label_counts(), {"bla": (4, 20), "gcd-done": (0, 0)})
+        self.assertIn("(assign t (op rem) (reg a) (reg b))", profile.report())
+
+    def test_save_restore(self):
+        machine = python_vm.make_machine(["n", "val", "continue"], {"=": operator.eq, "-": operator.sub, "*": operator.mul})
+        self.assemble(machine, RECURSIVE_FACTORIAL)
+        machine.set_register_value("n", 10)
+        machine.start()
+        self.assertEqual(machine.get_register_value("val"), 3628800)
+        self.assertEqual(len(machine.stack), 0)
+
+    def test_max_stack_depth(self):
+        machine = python_vm.make_machine(["n", "val", "continue"], {"=": operator.eq, "-": operator.sub, "*": operator.mul},
+                                         max_stack_depth=10)
+        self.assemble(machine, RECURSIVE_FACTORIAL)
+        machine.set_register_value("n", 6)
+        machine.start()
+        self.assertEqual(machine.get_register_value("val"), 720)
+        machine.set_register_value("n", 7)
+        self.assertRaises(python_vm.StackError, machine.start)
+
+    def test_register_stacks(self):
+        text = '''(start (save a)
+            (save b)
+            (assign a (const 0))
+            (restore a)
+            (assign b (const 0)))'''
+        machine = python_vm.make_machine(["a", "b"], {})
+        self.assemble(machine, text)
+        machine.set_register_value("a", 1)
+        machine.set_register_value("b", 2)
+        machine.start()
+        self.assertEqual(machine.get_register_value("a"), 2)
+        machine = python_vm.make_machine(["a", "b"], {}, register_stacks=True)
+        self.assemble(machine, text)
+        machine.set_register_value("a", 1)
+        machine.set_register_value("b", 2)
+        machine.start()
+        self.assertEqual(machine.get_register_value("a"), 1)
+        self.assertEqual(machine.stack_for("b").stack, [2])
+        machine.initialise_stacks()
+        self.assertEqual(len(machine.stack_for("b")), 0)
+
+    def test_builtins(self):
+        machine = python_vm.make_machine(["x", "n", "r", "t"], {})
+        self.assemble(machine, '''(start (assign x (op list) (const 1) (const 2) (const 3))
+            (assign n (const 0))
+            loop
+            (test (op null?) (reg x))
+            (branch (label done))
+            (assign t (op car) (reg x))
+            (assign n (op +) (reg n) (reg t))
+            (assign x (op cdr) (reg x))
+            (goto (label loop))
+            done
+            (assign r (op cons) (reg n) (const 7))
+            (assign x (op rem) (const -7) (const 2))
+            (assign n (op quotient) (reg n) (const -4)))''')
+        machine.start()
+        self.assertEqual(machine.get_register_value("r"), [6, 7])
+        self.assertEqual(machine.get_register_value("x"), -1)
+        self.assertEqual(machine.get_register_value("n"), -1)
+
+    def test_builtin_replaced(self):
+        machine = python_vm.make_machine(["a"], {"+": lambda x, y: x * y})
+        self.assemble(machine, '''(start (assign a (op +) (reg a) (const 3)))''')
+        machine.set_register_value("a", 5)
+        machine.start()
+        self.assertEqual(machine.get_register_value("a"), 15)
+
+    def test_operand_shapes(self):
+        machine = python_vm.make_machine(["a", "b", "c", "d", "e"], {"sum": lambda *xs: sum(xs)})
+        self.assemble(machine, '''(start (assign b (op -) (const 10) (reg a))
+            (assign c (op -) (reg a) (const 1))
+            (assign d (op sum) (reg a) (const 1) (reg b))
+            (assign e (op -) (const 10) (const 1)))''')
+        machine.set_register_value("a", 3)
+        machine.start()
+        self.assertEqual([machine.get_register_value(r) for r in "bcde"], [7, 2, 11, 9])
+
+    def test_list_memory(self):
+        machine = python_vm.make_machine(["n", "rounds", "x", "y", "t"], {}, list_memory=25)
+        self.assemble(machine, REVERSE)
+        machine.set_register_value("n", 10)
+        machine.set_register_value("rounds", 5)
+        machine.start()
+        self.assertEqual(machine.memory.to_python(machine.get_register_value("x")), list(range(10, 0, -1)))
+        self.assertGreater(machine.memory.collections, 0)
+
+    def test_optimize(self):
+        machine = python_vm.make_machine(["a", "t", "b"], {"=": lambda x, y: x == y, "rem": lambda x, y: x%y},
+                                         pure_ops=["=", "rem"])
+        python_vm.assemble_machine(machine, GCD, backend=self.backend, optimize=True)
+        self.assertEqual(machine.insts_tokens[1].type, "TEST_BRANCH")
+        machine.set_register_value("a", 21)
+        machine.set_register_value("b", 343)
+        machine.start()
+        self.assertEqual(machine.get_register_value("a"), 7)
+
+    def test_budget(self):
+        machine = python_vm.make_machine(["n", "product", "counter"], {})
+        self.assemble(machine, FACTORIAL)
+        machine.set_register_value("n", 10)
+        slices = 1
+        finished = machine.start(3)
+        while not finished:
+            finished = machine.execute(3)
+            slices += 1
+        self.assertGreater(slices, 3)
+        self.assertEqual(machine.get_register_value("product"), 3628800)
+        self.assertTrue(machine.execute(3))
+
+    def test_run(self):
+        machine = python_vm.make_machine(["a", "t", "b"], {})
+        self.assemble(machine, GCD)
+        machine.set_register_value("a", 21)
+        machine.set_register_value("b", 343)
+        asyncio.run(machine.run(every=2))
+        self.assertEqual(machine.get_register_value("a"), 7)
+
+
+class TestPrimitives(unittest.TestCase):
+
+    def test_remainder(self):
+        for x in (-7, 7):
+            for y in (-2, 2):
+                self.assertEqual(primitives.remainder(x, y), int(math.fmod(x, y)))
+                self.assertEqual(primitives.quotient(x, y), int(x / y))
+
+    def test_list(self):
+        self.assertEqual(primitives.make_list(1, 2), [1, [2, None]])
+        self.assertTrue(primitives.eq(1000, 10 ** 3))
+
+    def test_fold_pure(self):
+        calls = []
+        def plus(x, y):
+            calls.append((x, y))
+            return x + y
+        machine = python_vm.make_machine(["a", "b"], {"plus": plus}, pure_ops=["plus"])
+        python_vm.assemble_machine(machine, '''(start (assign a (op plus) (const 1) (const 2))
+            (assign b (op cons) (const 1) (const 2)))''')
+        self.assertEqual(calls, [(1, 2)])
+        machine.start()
+        self.assertEqual(calls, [(1, 2)])
+        self.assertEqual(machine.get_register_value("a"), 3)
+        # cons allocates, so every run gets a fresh pair
+        pair = machine.get_register_value("b")
+        machine.start()
+        self.assertIsNot(machine.get_register_value("b"), pair)
+
+    def test_fold_error_left_to_run_time(self):
+        machine = python_vm.make_machine(["a"], {})
+        python_vm.assemble_machine(machine, '''(start (goto (label done))
+            (assign a (op quotient) (const 1) (const 0))
+            done
+            (assign a (const 1)))''')
+        machine.start()
+        self.assertEqual(machine.get_register_value("a"), 1)
+        machine.pc.set_contents(1)
+        self.assertRaises(ZeroDivisionError, machine.execute)
+
+    def test_inlined(self):
+        machine = python_vm.make_machine(["a", "b"], {})
+        python_vm.assemble_machine(machine, '''(start (assign a (op +) (reg a) (const 1))
+            (assign b (op null?) (reg b)))''', backend="python")
+        self.assertIn("r2 = (r2 + 1)", machine.compiled.source)
+        self.assertIn("r3 = (r3 is None)", machine.compiled.source)
+
+
+class TestListMemory(unittest.TestCase):
+
+    def test_values(self):
+        heap = memory.ListMemory(10)
+        values = [0, -5, 2 ** 70, [], True, False, "sym", 1.5, (1,)]
+        pair = heap.make_list(*[None if value == [] else value for value in values])
+        self.assertEqual(heap.to_python(pair), values)
+        self.assertEqual(heap.free, len(values))
+        self.assertTrue(heap.eq(heap.car(heap.cdr(pair)), -5))
+        self.assertTrue(heap.eq(heap.cdr(pair), heap.cdr(pair)))
+        self.assertRaises(memory.HeapError, heap.car, None)
+
+    def test_collect(self):
+        registers = [None, None]
+        heap = memory.ListMemory(4, lambda: [(registers, 2)])
+        registers[0] = heap.make_list("a", "b")
+        heap.make_list("x", "y")
+        # full: this cons collects the garbage list (x y)
+        registers[1] = heap.make_list(registers[0])
+        self.assertEqual(heap.collections, 1)
+        self.assertEqual(heap.free, 3)
+        self.assertEqual(sorted(heap.objects), ["a", "b"])
+        heap.set_car(registers[0], "d")
+        pair = heap.cons(registers[1], None)
+        self.assertEqual(heap.to_python(pair), [[["d", "b"]]])
+        self.assertEqual(heap.to_python(registers[0]), ["d", "b"])
+        self.assertTrue(heap.eq(heap.car(registers[1]), registers[0]))
+
+    def test_collect_in_list(self):
+        machine = python_vm.make_machine(["p", "x", "junk"], {}, list_memory=4)
+        python_vm.assemble_machine(machine, '''(start (assign junk (op cons) (const 3) (const 4))
+            (assign p (op cons) (const 1) (const 2))
+            (assign junk (op cons) (const 5) (const 6))
+            (assign junk (op cons) (const 7) (const 8))
+            (assign junk (const 0))
+            (assign x (op list) (reg p) (const 5)))''')
+        machine.start()
+        heap = machine.memory
+        self.assertEqual(heap.collections, 1)
+        x = machine.get_register_value("x")
+        self.assertTrue(heap.eq(heap.car(x), machine.get_register_value("p")))
+        self.assertEqual((heap.car(heap.car(x)), heap.cdr(heap.car(x))), (1, 2))
+        self.assertEqual(heap.car(heap.cdr(x)), 5)
+
+    def test_exhausted(self):
+        registers = [None]
+        heap = memory.ListMemory(3, lambda: [(registers, 1)])
+        for i in range(3):
+            registers[0] = heap.cons(i, registers[0])
+        self.assertRaises(memory.HeapError, heap.cons, 3, registers[0])
+
+    def test_install_after_assembly(self):
+        machine = python_vm.make_machine([], {})
+        python_vm.assemble_machine(machine, "(start (perform (op list)))")
+        self.assertRaises(python_vm.MachineError, machine.install_list_memory, 10)
+
+    def test_batch(self):
+        machine = python_vm.make_machine(["a"], {}, list_memory=10)
+        python_vm.assemble_machine(machine, "(start (assign a (op list)))")
+        self.assertRaises(python_vm.batch.BatchError, machine.run_batch, {"a": [1]}, ["a"])
+
+
+class TestStack(unittest.TestCase):
+
+    def test_push_pop(self):
+        stack = python_vm.Stack(size=2)
+        for i in range(5):
+            stack.push(i)
+        self.assertEqual(stack.stack, [0, 1, 2, 3, 4])
+        self.assertEqual([stack.pop() for _ in range(5)], [4, 3, 2, 1, 0])
+        self.assertRaises(python_vm.StackError, stack.pop)
+
+    def test_max_depth(self):
+        stack = python_vm.Stack(size=2, max_depth=3)
+        for i in range(3):
+            stack.push(i)
+        self.assertRaises(python_vm.StackError, stack.push, 3)
+        self.assertEqual(stack.stack, [0, 1, 2])
+
+    def test_zero_depth(self):
+        self.assertRaises(python_vm.StackError, python_vm.Stack(max_depth=0).push, 1)
+        machine = python_vm.make_machine(["a"], {}, max_stack_depth=0)
+        python_vm.assemble_machine(machine, "(start (save a))")
+        self.assertRaises(python_vm.StackError, machine.start)
+
+    def test_initialise(self):
+        stack = python_vm.Stack()
+        stack.push([1])
+        stack.initialise()
+        self.assertEqual(len(stack), 0)
+        self.assertEqual(stack.slots[0], None)
+
+
+GCD = '''(gcd (test (op =) (reg b) (const 0))
+    (branch (label gcd-done))
+    (assign t (op rem) (reg a) (reg b))
+    (assign a (reg b))
+    (assign b (reg t))
+    (goto (label gcd))
+    gcd-done)'''
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.machine = python_vm.make_machine(["a", "t", "b"], {"=": lambda x, y: x == y, "rem": lambda x, y: x%y})
+        python_vm.assemble_machine(self.machine, GCD)
+
+    def test_lists(self):
+        result = self.machine.run_batch({"a": [21, 12, 5, 0], "b": [343, 18, 0, 7]}, ["a", "b"])
+        self.assertEqual(result["a"], [7, 6, 5, 7])
+        self.assertEqual(result["b"], [0, 0, 0, 0])
+
+    def test_vector_ops(self):
+        calls = []
+        def rem(x, y):
+            calls.append(len(x))
+            return [p % q for p, q in zip(x, y)]
+        result = self.machine.run_batch({"a": [21, 12], "b": [343, 6]}, ["a"], {"rem": rem})
+        self.assertEqual(result["a"], [7, 6])
+        # both lanes share the first remainder, only 21/343 needs the others
+        self.assertEqual(calls, [2, 1, 1])
+
+    def test_stack_and_goto_register(self):
+        machine = python_vm.make_machine(["n", "continue"], {"dec": lambda x: x - 1})
+        python_vm.assemble_machine(machine, '''(start (save n)
+            (assign continue (label after))
+            (assign n (op dec) (reg n))
+            (goto (reg continue))
+            after
+            (restore n))''')
+        result = machine.run_batch({"n": [1, 2, 3]}, ["n"])
+        self.assertEqual(result["n"], [1, 2, 3])
+
+    def test_register_stacks(self):
+        machine = python_vm.make_machine(["a", "b"], {}, register_stacks=True)
+        python_vm.assemble_machine(machine, '''(start (save a)
+            (save b)
+            (restore a))''')
+        result = machine.run_batch({"a": [1, 2], "b": [3, 4]}, ["a"])
+        self.assertEqual(result["a"], [1, 2])
+
+    @unittest.skipIf(python_vm.batch.numpy is None, "numpy is not installed")
+    def test_numpy(self):
+        numpy = python_vm.batch.numpy
+        a = numpy.array([21, 12, 5, 0])
+        b = numpy.array([343, 18, 0, 7])
+        result = self.machine.run_batch({"a": a, "b": b}, ["a"],
+                                        {"=": numpy.equal, "rem": numpy.remainder})
+        self.assertEqual(list(result["a"]), [7, 6, 5, 7])
+
+    def test_mismatched_inputs(self):
+        self.assertRaises(python_vm.batch.BatchError, self.machine.run_batch, {"a": [1], "b": [1, 2]}, ["a"])
+
+
+SUM_FETCHED = '''(start (assign total (const 0))
+    loop
+    (test (op fetch-done?) (reg n))
+    (branch (label done))
+    (assign x (op fetch) (reg n))
+    (perform (op log) (reg x))
+    (assign total (op +) (reg total) (reg x))
+    (assign n (op -) (reg n) (const 1))
+    (goto (label loop))
+    done)'''
+
+
+class TestAsyncOps(unittest.TestCase):
+    backend = "closure"
+
+    def machine(self, log):
+        async def fetch(n):
+            await asyncio.sleep(0.01)
+            return n * 2
+
+        def fetch_done(n):
+            # a plain value the first time, an awaitable afterwards
+            if n % 2:
+                return n == 0
+            return asyncio.sleep(0, n == 0)
+
+        async_ops = {"log": log.append, "fetch-done?": fetch_done}
+        machine = python_vm.make_machine(["n", "x", "total"], {"fetch": fetch}, async_ops=async_ops)
+        python_vm.assemble_machine(machine, SUM_FETCHED, backend=self.backend, optimize=True)
+        return machine
+
+    def test_run(self):
+        log = []
+        machine = self.machine(log)
+        machine.set_register_value("n", 5)
+        asyncio.run(machine.run())
+        self.assertEqual(machine.get_register_value("total"), 30)
+        self.assertEqual(log, [10, 8, 6, 4, 2])
+
+    def test_overlapping_waits(self):
+        machines = [self.machine([]) for _ in range(50)]
+        for machine in machines:
+            machine.set_register_value("n", 4)
+
+        async def run_all():
+            await asyncio.gather(*[machine.run(every=5) for machine in machines])
+
+        start = time.perf_counter()
+        asyncio.run(run_all())
+        # 50 machines waiting 4 times 10ms each, all at once
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertEqual([machine.get_register_value("total") for machine in machines], [20] * 50)
+
+    def test_stream(self):
+        machine = python_vm.make_machine(["n", "x", "total"], {}, async_ops={
+            "fetch": lambda n: asyncio.sleep(0, n), "fetch-done?": lambda n: n == 0, "log": abs})
+        python_vm.assemble_machine_stream(machine, io.StringIO(SUM_FETCHED), backend=self.backend)
+        self.assertTrue(machine.resume_points)
+        machine.set_register_value("n", 3)
+        asyncio.run(machine.run())
+        self.assertEqual(machine.get_register_value("total"), 6)
+
+    def test_suspended(self):
+        machine = self.machine([])
+        machine.set_register_value("n", 1)
+        machine.pc.set_contents(0)
+        with self.assertRaises(python_vm.Suspended) as raised:
+            machine.execute()
+        raised.exception.awaitable.close()
+        machine.resume(7)
+        self.assertEqual(machine.get_register_value("x"), 7)
+        with self.assertRaises(python_vm.Suspended) as raised:
+            machine.execute()
+        raised.exception.awaitable.close()
+        machine.resume(True)
+        self.assertTrue(machine.execute())
+        self.assertEqual(machine.get_register_value("total"), 7)
+        machine.pc.set_contents(0)
+        self.assertRaises(python_vm.MachineError, machine.resume, 0)
+
+    def test_unsupported(self):
+        machine = python_vm.make_machine(["n", "x", "total"], {}, async_ops={"fetch": abs, "fetch-done?": abs})
+        self.assertRaises(python_vm.MachineError, python_vm.assemble_machine, machine, SUM_FETCHED,
+                          superinstructions="static")
+
+
+class TestBytecodeAsyncOps(TestAsyncOps):
+    backend = "bytecode"
+
+
+class TestPythonAsyncOps(TestAsyncOps):
+    backend = "python"
+
+
+class TestLazyAssembly(unittest.TestCase):
+
+    def test_blocks(self):
+        machine = python_vm.make_machine(["n", "product", "counter"], {})
+        python_vm.assemble_machine(machine, FACTORIAL, lazy=True)
+        self.assertEqual((machine.lazy_blocks.blocks, machine.lazy_blocks.compiled), (2, 0))
+        machine.set_register_value("n", 0)
+        machine.start(1)
+        self.assertEqual(machine.lazy_blocks.compiled, 1)
+        machine.execute()
+        self.assertEqual(machine.lazy_blocks.compiled, 2)
+        self.assertEqual(machine.get_register_value("product"), 1)
+        machine.set_register_value("n", 6)
+        machine.start()
+        self.assertEqual(machine.lazy_blocks.compiled, 2)
+        self.assertEqual(machine.get_register_value("product"), 720)
+
+    def test_only_reached_blocks(self):
+        machine = python_vm.make_machine(["a", "t", "b", "n"], {})
+        text = "(" + "".join("""loop%d (test (op =) (reg b) (const 0))
+            (branch (label done%d))
+            (assign t (op rem) (reg a) (reg b))
+            (assign a (reg b))
+            (assign b (reg t))
+            (goto (label loop%d))
+            done%d (goto (label end))
+            """ % (i, i, i, i) for i in range(50)) + "end)"
+        python_vm.assemble_machine(machine, text, lazy=True)
+        machine.set_register_value("a", 21)
+        machine.set_register_value("b", 343)
+        machine.start()
+        self.assertEqual(machine.get_register_value("a"), 7)
+        self.assertEqual(machine.lazy_blocks.blocks, 100)
+        self.assertEqual(machine.lazy_blocks.compiled, 2)
+
+    def test_errors_when_reached(self):
+        machine = python_vm.make_machine([], {})
+        python_vm.assemble_machine(machine, "(start (goto (label ok)) bad (perform (op missing)) ok)", lazy=True)
+        machine.start()
+        machine.pc.set_contents(1)
+        self.assertRaises(python_vm.inst.ExecutionError, machine.execute)
+
+    def test_unsupported(self):
+        machine = python_vm.make_machine(["a", "t", "b"], {})
+        self.assertRaises(python_vm.MachineError, python_vm.assemble_machine, machine, GCD, "bytecode", lazy=True)
+        self.assertRaises(python_vm.MachineError, python_vm.assemble_machine, machine, GCD,
+                          superinstructions="static", lazy=True)
+
+
+class TestTracing(unittest.TestCase):
+
+    def machine(self, registers, text, threshold=5):
+        machine = python_vm.make_machine(registers, {})
+        machine.enable_tracing(threshold)
+        python_vm.assemble_machine(machine, text)
+        return machine
+
+    def test_loop(self):
+        machine = self.machine(["a", "t", "b"], GCD)
+        machine.set_register_value("a", 1346269 * 7)
+        machine.set_register_value("b", 832040 * 7)
+        machine.start()
+        self.assertEqual(machine.get_register_value("a"), 7)
+        self.assertEqual(list(machine.tracer.traces), [0])
+        self.assertEqual(machine.tracer.traces[0].offsets, [0, 1, 2, 3, 4, 5])
+
+    def test_guards(self):
+        machine = self.machine(["n", "product", "counter"], FACTORIAL)
+        for n in (20, 3, 30, 0):
+            machine.set_register_value("n", n)
+            machine.start()
+            self.assertEqual(machine.get_register_value("product"), math.factorial(n))
+        self.assertEqual(list(machine.tracer.traces), [2])
+
+    def test_goto_register(self):
+        machine = self.machine(["n", "val", "continue"], RECURSIVE_FACTORIAL, threshold=2)
+        for n in range(1, 15):
+            machine.set_register_value("n", n)
+            machine.start()
+            self.assertEqual(machine.get_register_value("val"), math.factorial(n))
+        self.assertTrue(machine.tracer.traces)
+
+    def test_budget(self):
+        machine = self.machine(["n", "product", "counter"], FACTORIAL)
+        machine.set_register_value("n", 40)
+        finished = machine.start(4)
+        while not finished:
+            finished = machine.execute(4)
+        self.assertEqual(machine.get_register_value("product"), math.factorial(40))
+
+    def test_errors(self):
+        machine = python_vm.make_machine(["a", "t", "b"], {})
+        machine.enable_tracing()
+        self.assertRaises(python_vm.MachineError, python_vm.assemble_machine, machine, GCD, "bytecode")
+        self.assertRaises(python_vm.MachineError, python_vm.assemble_machine, machine, GCD,
+                          superinstructions="static")
+        python_vm.assemble_machine(machine, GCD)
+        self.assertRaises(python_vm.MachineError, machine.enable_tracing)
+
+
+class TestProgram(unittest.TestCase):
+    backend = "python"
+
+    def setUp(self):
+        self.program = python_vm.assemble_program(["n", "val", "continue"], {}, RECURSIVE_FACTORIAL,
+                                                  backend=self.backend)
+
+    def factorial(self, n):
+        state = self.program.state({"n": n})
+        state.start()
+        return state.get_register_value("val")
+
+    def test_states(self):
+        self.assertEqual([self.factorial(n) for n in (1, 5, 10)], [1, 120, 3628800])
+
+    def test_interleaved(self):
+        states = [self.program.state({"n": n}) for n in range(1, 30)]
+        running = [state for state in states if not state.start(2)]
+        while running:
+            running = [state for state in running if not state.execute(2)]
+        self.assertEqual([state.get_register_value("val") for state in states],
+                         [math.factorial(n) for n in range(1, 30)])
+
+    def test_threads(self):
+        results = {}
+
+        def run(n):
+            for _ in range(20):
+                results[n] = self.factorial(n)
+
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(1, 17)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, dict((n, math.factorial(n)) for n in range(1, 17)))
+
+    def test_coroutines(self):
+        states = [self.program.state({"n": n}) for n in range(1, 10)]
+
+        async def run_all():
+            await asyncio.gather(*[state.run(every=3) for state in states])
+
+        asyncio.run(run_all())
+        self.assertEqual([state.get_register_value("val") for state in states],
+                         [math.factorial(n) for n in range(1, 10)])
+
+    def test_empty_controller(self):
+        program = python_vm.assemble_program([], {}, "(done)", backend=self.backend)
+        self.assertTrue(program.state().start())
+
+    def test_reassemble_from_stream(self):
+        machine = python_vm.make_machine(["a"], {})
+        python_vm.assemble_machine(machine, "(s (assign a (const 1)))", backend=self.backend)
+        python_vm.assemble_machine_stream(machine, io.StringIO("(s (assign a (const 2)))"))
+        self.assertEqual(machine.backend, "closure")
+        self.assertRaises(python_vm.MachineError, python_vm.Program, machine)
+        machine.start()
+        self.assertEqual(machine.get_register_value("a"), 2)
+
+    def test_async_ops(self):
+        async def fetch(n):
+            await asyncio.sleep(0)
+            return n * 2
+
+        program = python_vm.assemble_program(["n", "x", "total"], {"fetch": fetch}, SUM_FETCHED,
+                                             backend=self.backend,
+                                             async_ops={"fetch-done?": lambda n: n == 0, "log": abs})
+        states = [program.state({"n": n}) for n in range(10)]
+
+        async def run_all():
+            await asyncio.gather(*[state.run() for state in states])
+
+        asyncio.run(run_all())
+        self.assertEqual([state.get_register_value("total") for state in states], [n * (n + 1) for n in range(10)])
+
+    def test_register_stacks(self):
+        program = python_vm.assemble_program(["n", "val", "continue"], {}, RECURSIVE_FACTORIAL,
+                                             backend=self.backend, register_stacks=True)
+        state = program.state({"n": 6})
+        state.start()
+        self.assertEqual(state.get_register_value("val"), 720)
+        self.assertIsNot(state.stack_for("n"), program.state().stack_for("n"))
+
+    def test_unshareable(self):
+        machine = python_vm.make_machine(["a", "t", "b"], {})
+        python_vm.assemble_machine(machine, GCD)
+        self.assertRaises(python_vm.MachineError, python_vm.Program, machine)
+        machine = python_vm.make_machine(["a", "t", "b"], {}, list_memory=10)
+        python_vm.assemble_machine(machine, GCD, backend=self.backend)
+        self.assertRaises(python_vm.MachineError, python_vm.Program, machine)
+
+
+class TestBytecodeProgram(TestProgram):
+    backend = "bytecode"
+
+
+class TestMachinePool(unittest.TestCase):
+
+    def test_map(self):
+        inputs = [{"a": a, "b": 343} for a in range(1, 50)]
+        with pool.MachinePool(["a", "t", "b"], {"=": operator.eq, "rem": operator.mod}, GCD, ["a"],
+                              backend="bytecode", processes=2) as machines:
+            results = machines.map(inputs, chunksize=8)
+        self.assertEqual(results, [{"a": math.gcd(a, 343)} for a in range(1, 50)])
+
+    def test_fresh_registers(self):
+        text = "(start (test (op =) (reg a) (const 0)) (branch (label done)) (assign r (reg a)) done)"
+        with pool.MachinePool(["a", "r"], {}, text, ["r"], processes=1) as machines:
+            results = machines.map([{"a": 5}, {"a": 0}])
+        self.assertEqual(results, [{"r": 5}, {"r": None}])
+
+
+class TestControllerCache(unittest.TestCase):
+
+    def run_gcd(self, controllers):
+        machine = python_vm.make_machine(["a", "t", "b"], {"=": operator.eq, "rem": operator.mod})
+        python_vm.assemble_machine(machine, GCD, cache=controllers)
+        machine.set_register_value("a", 21)
+        machine.set_register_value("b", 343)
+        machine.start()
+        return machine.get_register_value("a")
+
+    def test_memory(self):
+        controllers = cache.ControllerCache(maxsize=1)
+        self.assertEqual(self.run_gcd(controllers), 7)
+        self.assertEqual(self.run_gcd(controllers), 7)
+        self.assertEqual((controllers.misses, controllers.hits), (1, 1))
+        controllers.parse("(other)")
+        self.assertEqual(len(controllers.entries), 1)
+        self.assertEqual(self.run_gcd(controllers), 7)
+        self.assertEqual(controllers.misses, 3)
+
+    def test_signature(self):
+        controllers = cache.ControllerCache()
+        self.assertNotEqual(controllers.key(GCD, ["a", "b"], ["rem"]), controllers.key(GCD, ["a", "b"], ["mod"]))
+        self.assertEqual(controllers.key(GCD, ["a", "b"]), controllers.key(GCD.encode(), ["b", "a"]))
+
+    def test_disk(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(self.run_gcd(cache.ControllerCache(directory)), 7)
+            controllers = cache.ControllerCache(directory)
+            self.assertEqual(self.run_gcd(controllers), 7)
+            self.assertEqual((controllers.misses, controllers.disk_hits), (0, 1))
+            controllers.clear()
+            self.assertEqual(os.listdir(directory), [])
+
+
+class TestBytecodeInstructions(TestGCDInstructions):
+    backend = "bytecode"
+
+    def test_assemble_stream(self):
+        machine = python_vm.make_machine(["a", "t", "b"], {"=": lambda x, y: x == y, "rem": lambda x, y: x%y})
+        python_vm.assemble_machine_stream(machine, io.StringIO(GCD), backend=self.backend, chunk_size=7)
+        machine.set_register_value("a", 21)
+        machine.set_register_value("b", 343)
+        machine.start()
+        self.assertEqual(machine.get_register_value("a"), 7)
+
+    def test_label_offsets(self):
+        machine = python_vm.make_machine(["n"], {"=": lambda x, y: x == y})
+        self.assemble(machine, '''(loop (test (op =) (reg n) (const 0))
+            (branch (label done))
+            (goto (label loop))
+            done)''')
+        # test2 takes 4 code words, branch and goto 2 each
+        self.assertEqual(machine.label_pointers, {"loop": 0, "done": 8})
+
+    def test_builtin_opcodes(self):
+        text = '''(start (test (op =) (reg n) (const 0))
+            (test (op null?) (reg x))
+            (assign n (op *) (reg n) (reg n))
+            (assign x (op cdr) (reg x)))'''
+        machine = python_vm.make_machine(["n", "x"], {})
+        self.assemble(machine, text)
+        code = machine.bytecode.code
+        self.assertEqual([code[0], code[4], code[7], code[12]],
+                         [bc.TEST_EQ, bc.TEST_NULL, bc.ASSIGN_MUL, bc.ASSIGN_CDR])
+        machine.set_register_value("n", 3)
+        machine.set_register_value("x", [1, [2, None]])
+        machine.start()
+        self.assertEqual(machine.get_register_value("n"), 9)
+        self.assertEqual(machine.get_register_value("x"), [2, None])
+        self.assertFalse(machine.get_register_value("flag"))
+        # host ops replacing the built-in ones are called
+        machine = python_vm.make_machine(["n", "x"], {"*": operator.add, "cdr": len})
+        self.assemble(machine, text)
+        code = machine.bytecode.code
+        self.assertEqual([code[0], code[4], code[7], code[12]], [bc.TEST_EQ, bc.TEST_NULL, bc.ASSIGN_OP2, bc.ASSIGN_OP1])
+        machine.set_register_value("n", 3)
+        machine.set_register_value("x", [1, [2, None]])
+        machine.start()
+        self.assertEqual(machine.get_register_value("n"), 6)
+        self.assertEqual(machine.get_register_value("x"), 2)
+
+    def test_profile(self):
+        machine = python_vm.make_machine([], {})
+        machine.enable_profiling()
+        self.assertRaises(python_vm.MachineError, self.assemble, machine, "(start)")
+
+    def test_unknown_backend(self):
+        machine = python_vm.make_machine([], {})
+        self.assertRaises(python_vm.MachineError, python_vm.assemble_machine, machine, "(start)", "jit")
+
+
+class TestPythonInstructions(TestGCDInstructions):
+    backend = "python"
+
+    def test_profile(self):
+        machine = python_vm.make_machine([], {})
+        machine.enable_profiling()
+        self.assertRaises(python_vm.MachineError, self.assemble, machine, "(start)")
+
+    def test_registers_synced_on_error(self):
+        machine = python_vm.make_machine(["a", "b"], {"fail": lambda x: 1 // x})
+        self.assemble(machine, '''(start (assign a (const 5))
+            (assign b (op fail) (const 0)))''')
+        self.assertRaises(ZeroDivisionError, machine.start)
+        self.assertEqual(machine.get_register_value("a"), 5)
+
+    def test_jump_to_non_label(self):
+        machine = python_vm.make_machine(["a"], {})
+        self.assemble(machine, '''(start (assign a (const 5))
+            (assign a (const 6)))''')
+        machine.set_register_value("pc", 1)
+        self.assertRaises(python_vm.inst.ExecutionError, machine.execute)
+
+
+class TestSuperinstructions(TestGCDInstructions):
+
+    def assemble(self, machine, text):
+        python_vm.assemble_machine(machine, text, backend=self.backend, superinstructions="static")
+
+    def test_profile(self):
+        machine = python_vm.make_machine([], {})
+        machine.enable_profiling()
+        self.assertRaises(python_vm.MachineError, self.assemble, machine, "(start)")
+
+    def test_sequences(self):
+        insts_tokens = python_vm.parse_controller(FACTORIAL)
+        self.assertEqual(superinstructions.sequences(insts_tokens), [(0, 2), (2, 2), (4, 3)])
+        self.assertEqual(superinstructions.sequences(insts_tokens, min_length=3), [(4, 3)])
+
+    def test_profiled_sequences(self):
+        machine = python_vm.make_machine(["n", "product", "counter"],
+                                         {">": lambda x, y: x > y, "*": lambda x, y: x * y, "+": lambda x, y: x + y})
+        profile = machine.enable_profiling()
+        python_vm.assemble_machine(machine, FACTORIAL)
+        machine.set_register_value("n", 0)
+        machine.start()
+        insts_tokens = python_vm.parse_controller(FACTORIAL)
+        # the loop body never ran
+        self.assertEqual(superinstructions.profiled_sequences(insts_tokens, profile), [(0, 2), (2, 2)])
+
+        fused = python_vm.make_machine(["n", "product", "counter"], machine.ops)
+        python_vm.assemble_machine(fused, FACTORIAL, superinstructions=profile)
+        fused.set_register_value("n", 10)
+        fused.start()
+        self.assertEqual(fused.get_register_value("product"), 3628800)
+
+    def test_label_offsets_kept(self):
+        machine = python_vm.make_machine(["continue", "r"], {})
+        self.assemble(machine, '''(start (assign continue (label after))
+            (assign r (const 1))
+            (goto (reg continue))
+            (assign r (const 2))
+            after)''')
+        self.assertEqual(machine.label_pointers, {"start": 0, "after": 4})
+        self.assertEqual(len(machine.instruction_sequence), 4)
+        machine.start()
+        self.assertEqual(machine.get_register_value("pc"), 4)
+        self.assertEqual(machine.get_register_value("r"), 1)
+
+    def test_save_assign_goto(self):
+        machine = python_vm.make_machine(["n", "continue"], {"dec": lambda x: x - 1})
+        self.assemble(machine, '''(start (save n)
+            (assign continue (label after))
+            (assign n (op dec) (reg n))
+            (goto (reg continue))
+            after
+            (restore n)
+            (assign continue (const 0)))''')
+        machine.set_register_value("n", 3)
+        machine.start()
+        self.assertEqual(machine.get_register_value("n"), 3)
+        self.assertEqual(machine.stack.stack, [])
+
+    def test_other_backends(self):
+        machine = python_vm.make_machine([], {})
+        self.assertRaises(python_vm.MachineError, python_vm.assemble_machine, machine, "(start)",
+                          "bytecode", superinstructions="static")
+
@@ -0,0 +1,77 @@
+import io
+import unittest
+import python_vm
+import scheduler
+
+COUNTDOWN = '''(loop (test (op =) (reg n) (const 0))
+    (branch (label done))
+    (assign n (op -) (reg n) (const 1))
+    (assign total (op +) (reg total) (const 1))
+    (goto (label loop))
+    done)'''
+
+
+def countdown(n, backend="closure"):
+    machine = python_vm.make_machine(["n", "total"], {})
+    python_vm.assemble_machine(machine, COUNTDOWN, backend=backend)
+    machine.set_register_value("n", n)
+    machine.set_register_value("total", 0)
+    return machine
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_round_robin(self):
+        s = scheduler.Scheduler(quantum=10)
+        tasks = [s.spawn(countdown(n, backend)) for n in (5, 50, 500) for backend in ("closure", "bytecode", "python")]
+        self.assertTrue(s.run())
+        for task, n in zip(tasks, [5] * 3 + [50] * 3 + [500] * 3):
+            self.assertTrue(task.done)
+            self.assertIsNone(task.error)
+            self.assertEqual(task.machine.get_register_value("total"), n)
+        # the short machines finished before the long ones got far
+        self.assertLess(tasks[0].slices, tasks[3].slices)
+        self.assertLess(tasks[3].slices, tasks[6].slices)
+        self.assertEqual(len(s), 0)
+
+    def test_many(self):
+        s = scheduler.Scheduler(quantum=7)
+        tasks = [s.spawn(countdown(n % 20)) for n in range(2000)]
+        s.run()
+        self.assertEqual([t.machine.get_register_value("total") for t in tasks], [n % 20 for n in range(2000)])
+
+    def test_max_slices(self):
+        s = scheduler.Scheduler(quantum=1)
+        task = s.spawn(countdown(100))
+        self.assertFalse(s.run(max_slices=5))
+        self.assertEqual(task.slices, 5)
+        self.assertFalse(task.done)
+        self.assertTrue(s.run())
+        self.assertEqual(task.machine.get_register_value("total"), 100)
+
+    def test_error(self):
+        s = scheduler.Scheduler()
+        machine = countdown(3)
+        machine.set_register_value("total", "x")
+        bad = s.spawn(machine)
+        good = s.spawn(countdown(3))
+        s.run()
+        self.assertTrue(bad.done)
+        self.assertIsInstance(bad.error, TypeError)
+        self.assertEqual(good.machine.get_register_value("total"), 3)
+
+    def test_async_ops(self):
+        async def fetch(n):
+            return n
+
+        machine = python_vm.make_machine(["n"], {"fetch": fetch})
+        python_vm.assemble_machine(machine, "(start (assign n (op fetch) (reg n)))")
+        self.assertRaises(python_vm.MachineError, scheduler.Scheduler().spawn, machine)
+        program = python_vm.assemble_program(["n"], {"fetch": fetch}, "(start (assign n (op fetch) (reg n)))")
+        self.assertRaises(python_vm.MachineError, scheduler.Scheduler().spawn, program.state())
+        python_vm.assemble_machine_stream(machine, io.StringIO("(start (assign n (op fetch) (reg n)))"))
+        self.assertRaises(python_vm.MachineError, scheduler.Scheduler().spawn, machine)
+
+
+if __name__ == '__main__':
+    unittest.main()
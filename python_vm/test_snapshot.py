@@ -0,0 +1,121 @@
+import asyncio
+import os
+import tempfile
+import unittest
+import python_vm
+import snapshot
+from test_python_vm import GCD, REVERSE
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def test_backends(self):
+        for backend, options in [("closure", {}), ("closure", {"superinstructions": "static"}),
+                                 ("bytecode", {}), ("python", {})]:
+            machine = python_vm.make_machine(["a", "t", "b"], {})
+            python_vm.assemble_machine(machine, GCD, backend=backend, **options)
+            machine.set_register_value("a", 21)
+            machine.set_register_value("b", 343)
+            data = snapshot.dumps(machine)
+            restored = snapshot.loads(data)
+            self.assertEqual(restored.backend, backend)
+            self.assertEqual(restored.superinstructions, machine.superinstructions)
+            restored.start()
+            self.assertEqual(restored.get_register_value("a"), 7)
+            # the original is untouched
+            self.assertEqual(machine.get_register_value("a"), 21)
+
+    def test_lazy(self):
+        machine = python_vm.make_machine(["a", "t", "b"], {})
+        python_vm.assemble_machine(machine, GCD, lazy=True)
+        restored = snapshot.loads(snapshot.dumps(machine))
+        self.assertEqual(restored.lazy_blocks.compiled, 0)
+        restored.set_register_value("a", 21)
+        restored.set_register_value("b", 343)
+        restored.start()
+        self.assertEqual(restored.get_register_value("a"), 7)
+        self.assertEqual(restored.lazy_blocks.compiled, restored.lazy_blocks.blocks)
+
+    def test_resume(self):
+        machine = python_vm.make_machine(["a"], {})
+        python_vm.assemble_machine(machine, '''(start (save a)
+            (assign a (const 0))
+            (goto (label done))
+            resume
+            (restore a)
+            done)''')
+        machine.set_register_value("a", 5)
+        machine.start()
+        self.assertEqual(machine.stack.stack, [5])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "machine.snapshot")
+            snapshot.save(machine, path)
+            restored = snapshot.load(path)
+        self.assertEqual(restored.stack.stack, [5])
+        self.assertEqual(restored.get_register_value("a"), 0)
+        restored.set_register_value("pc", restored.label_pointers["resume"])
+        restored.execute()
+        self.assertEqual(restored.get_register_value("a"), 5)
+
+    def test_register_stacks(self):
+        machine = python_vm.make_machine(["a", "b"], {}, max_stack_depth=4, register_stacks=True)
+        python_vm.assemble_machine(machine, "(start (save a) (save b))")
+        machine.set_register_value("a", 1)
+        machine.set_register_value("b", 2)
+        machine.start()
+        restored = snapshot.loads(snapshot.dumps(machine))
+        self.assertEqual(restored.stack_for("a").stack, [1])
+        self.assertEqual(restored.stack_for("b").stack, [2])
+        self.assertEqual(restored.stack_for("b").max_depth, 4)
+
+    def test_list_memory(self):
+        machine = python_vm.make_machine(["n", "rounds", "x", "y", "t"], {}, list_memory=25)
+        python_vm.assemble_machine(machine, REVERSE)
+        machine.set_register_value("n", 10)
+        machine.set_register_value("rounds", 1)
+        machine.start()
+        restored = snapshot.loads(snapshot.dumps(machine))
+        heap = restored.memory
+        self.assertEqual(heap.to_python(restored.get_register_value("x")), list(range(10, 0, -1)))
+        self.assertEqual(heap.free, machine.memory.free)
+        # carry on in the restored memory, collecting as it fills
+        restored.set_register_value("rounds", 3)
+        restored.set_register_value("pc", restored.label_pointers["reverse"])
+        restored.execute()
+        self.assertEqual(heap.to_python(restored.get_register_value("x")), list(range(1, 11)))
+        self.assertGreater(heap.collections, machine.memory.collections)
+
+    def test_host_ops(self):
+        machine = python_vm.make_machine(["a"], {"double": lambda x: 2 * x, "+": lambda x, y: x - y})
+        python_vm.assemble_machine(machine, "(start (assign a (op double) (reg a)) (assign a (op +) (reg a) (const 1)))")
+        data = snapshot.dumps(machine)
+        self.assertRaises(snapshot.SnapshotError, snapshot.loads, data)
+        restored = snapshot.loads(data, {"double": lambda x: 2 * x, "+": lambda x, y: x - y})
+        restored.set_register_value("a", 3)
+        restored.start()
+        self.assertEqual(restored.get_register_value("a"), 5)
+
+    def test_async_ops(self):
+        async def double(x):
+            return 2 * x
+
+        machine = python_vm.make_machine(["a"], {"double": double})
+        python_vm.assemble_machine(machine, "(start (assign a (op double) (reg a)) (assign a (op +) (reg a) (const 1)))")
+        data = snapshot.dumps(machine)
+        self.assertRaises(snapshot.SnapshotError, snapshot.loads, data)
+        restored = snapshot.loads(data, {"double": double})
+        self.assertEqual(restored.async_ops, {"double"})
+        restored.set_register_value("a", 3)
+        asyncio.run(restored.run())
+        self.assertEqual(restored.get_register_value("a"), 7)
+
+    def test_errors(self):
+        self.assertRaises(snapshot.SnapshotError, snapshot.loads, b"not a snapshot at all")
+        machine = python_vm.make_machine([], {})
+        machine.enable_profiling()
+        python_vm.assemble_machine(machine, "(start)")
+        self.assertRaises(snapshot.SnapshotError, snapshot.dumps, machine)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+""" A tracing JIT for the closure backend. The machine counts the
+    backward jumps to every instruction; once one has been jumped back
+    to `threshold` times it is the head of a hot loop, and the next
+    iteration is run instruction by instruction and recorded. The
+    recorded trace, one iteration along the branch directions that were
+    actually taken, is compiled into a single Python function that
+    replaces the closure of the loop head: each branch becomes a guard
+    that leaves the trace, setting pc to the direction not recorded, so
+    that the regular instructions carry on from there.
+
+        machine.enable_tracing()
+        python_vm.assemble_machine(machine, text)
+        machine.start()
+        machine.tracer.traces   # loop head offset -> Trace
+
+    If an op raises inside a trace, pc is left at the head of the loop.
+"""
+import superinstructions
+
+
+class Trace:
+    """ A compiled loop trace.
+        offsets:
+            The instruction offsets of the recorded iteration.
+        source:
+            The generated Python source, kept for inspection.
+    """
+    def __init__(self, offsets, source, function):
+        self.offsets = offsets
+        self.source = source
+        self.function = function
+
+
+class Tracer:
+    """ The tracing state of one machine, which has to be created
+        before the controller is assembled, like a profiler.Profile.
+        threshold:
+            Number of backward jumps to an instruction after which the
+            loop it heads is traced.
+        max_length:
+            Longest iteration, in instructions, that is compiled;
+            longer recordings are given up.
+
+        traces:
+            Dict of loop head offset to its Trace.
+        aborted:
+            Offsets of the loop heads whose recording was given up.
+    """
+    def __init__(self, machine, threshold=50, max_length=1000):
+        self.machine = machine
+        self.threshold = threshold
+        self.max_length = max_length
+        self.tokens = []
+        self.backward_jumps = []
+        self.traces = {}
+        self.aborted = set()
+
+    def install(self, insts_tokens):
+        """ Reset the counts and traces for a newly assembled controller. """
+        self.tokens = [token for token in insts_tokens if token.type != "LABEL"]
+        self.backward_jumps = [0] * len(self.tokens)
+        self.traces = {}
+        self.aborted = set()
+
+    def record(self, head):
+        """ Run one iteration of the loop at `head`, where pc is, and
+            compile it if it comes back to `head`. Returns the number of
+            instructions executed.
+        """
+        machine = self.machine
+        instructions = machine.instruction_sequence
+        regs = machine.slots
+        pc = machine.pc.index
+        end = len(instructions)
+        entries = []
+        offset = head
+        while True:
+            if offset in self.traces or len(entries) == self.max_length:
+                # a loop nested in this one is compiled already, or the
+                # iteration is too long to be worth compiling
+                self.aborted.add(head)
+                return len(entries)
+            instructions[offset]()
+            after = regs[pc]
+            entries.append((offset, after))
+            if after == head:
+                break
+            if after >= end:
+                self.aborted.add(head)
+                return len(entries)
+            offset = after
+        trace = TraceGenerator(machine).generate(head, entries, self.tokens)
+        self.traces[head] = trace
+        instructions[head] = trace.function
+        return len(entries)
+
+
+class TraceGenerator(superinstructions.Generator):
+    """ Generates the Python source of a trace, which, like a
+        superinstruction, reads and writes the register file directly
+        and only updates the pc register when it returns.
+    """
+    def generate(self, head, entries, tokens):
+        pc = self.register("pc")
+        self.closure_names.append("regs")
+        self.closure_values.append(self.machine.slots)
+        body = []
+        for offset, after in entries:
+            body.extend(self.traced(tokens[offset], offset + 1, after, pc))
+        body.append("%s = %d" % (pc, head))
+
+        lines = ["def make_trace(%s):" % ", ".join(self.closure_names)]
+        lines.append("    def trace_%d():" % head)
+        lines.extend("        " + line for line in body)
+        lines.append("    return trace_%d" % head)
+        source = "\n".join(lines) + "\n"
+        namespace = {}
+        exec(compile(source, "<trace %d>" % head, "exec"), namespace)
+        function = namespace["make_trace"](*self.closure_values)
+        return Trace([offset for offset, _ in entries], source, function)
+
+    def traced(self, token, following, after, pc):
+        """ The lines of one recorded instruction, with a jump replaced
+            by a guard on the direction it took.
+        """
+        t = token.type
+        if t in ("BRANCH", "TEST_BRANCH"):
+            lines = []
+            if t == "TEST_BRANCH":
+                lines.extend(self.call(self.register("flag"), token))
+            label = self.label(token.label)
+            if label == following:
+                return lines
+            if after == label:
+                lines.extend(["if not %s:" % self.register("flag"),
+                              "    %s = %d" % (pc, following),
+                              "    return"])
+            else:
+                lines.extend(["if %s:" % self.register("flag"),
+                              "    %s = %d" % (pc, label),
+                              "    return"])
+            return lines
+        elif t == "GOTO_LABEL":
+            return []
+        elif t == "GOTO_REGISTER":
+            target = self.register(token.register)
+            return ["if %s != %d:" % (target, after),
+                    "    %s = %s" % (pc, target),
+                    "    return"]
+        return self.instruction(token)